@@ -0,0 +1,66 @@
+import numpy as np
+
+
+def read_only(a):
+    a = a.view()
+    a.flags.writeable = False
+    return a
+
+
+class ChunkCache:
+    """
+    Memoizes a per-sample quantity in fixed-size chunks so overlapping windows reuse earlier work.
+
+    compute(start, stop) must return the quantity for samples start:stop as an array. All chunks
+    are dropped whenever the key passed to get differs from the previous one. Once every sample
+    has been requested (or primed) windows are sliced from the full array and the chunks are
+    dropped. get returns read-only arrays, since they may share memory with the cached data.
+    """
+    chunk_size: int
+    samples_computed: int # Number of samples passed to compute, for profiling
+
+    def __init__(self, compute, chunk_size=256):
+        self.compute = compute
+        self.chunk_size = chunk_size
+        self.samples_computed = 0
+        self.key = None
+        self.chunks = {}
+        self.full = None
+
+    def clear(self):
+        self.chunks = {}
+        self.full = None
+
+    def prime(self, full, key):
+        """
+        Seeds the cache with the quantity for every sample, e.g. loaded from the result cache.
+        """
+        self.clear()
+        self.key = key
+        self.full = read_only(full)
+
+    def get(self, start, stop, length, key):
+        if key != self.key:
+            self.clear()
+            self.key = key
+
+        if self.full is not None:
+            return self.full[start:stop]
+        if stop <= start:
+            return read_only(self.compute(start, start))
+
+        first, last = start // self.chunk_size, (stop - 1) // self.chunk_size
+        parts = []
+        for chunk in range(first, last + 1):
+            if chunk not in self.chunks:
+                lo, hi = chunk * self.chunk_size, min((chunk + 1) * self.chunk_size, length)
+                self.chunks[chunk] = self.compute(lo, hi)
+                self.samples_computed += hi - lo
+            parts.append(self.chunks[chunk])
+
+        offset = first * self.chunk_size
+        res = read_only(np.concatenate(parts)[start - offset:stop - offset])
+        if start == 0 and stop == length:
+            self.full = res
+            self.chunks = {}
+        return res
@@ -1,100 +1,604 @@
-from ..tools.simulator import TensorTechSimulation
-from ..tools.convert import mrp2quat
-from ..tools.calculate import georef, vec_diff, mag, interpolate_orbit, interpolate_attitude, interpolate_dates
-from datetime import datetime
+from ..tools.simulator import TensorTechSimulation, DATA_TYPES, pivot_columns, pivot_records
+from ..tools.convert import mrp2quat_array, lla2ecef
+from ..tools.adaptive import adaptive_indices, reconstruct_llar, segment_rates
+from ..tools.calculate import georef_array, grid_index, grid_times, interpolate_keyframes, interpolation_times, quat_between, slerp_attitude
+from ..tools.cache import ResultCache, default_cache
+from ..tools.sun import sun_angle, sun_position_ecef, sunlight_fraction
+from ..tools.export import write_aem, write_stk_attitude, write_stk_ephemeris
+from ..tools.instrument import count, span, traced
+from .chunk_cache import ChunkCache
+from functools import cached_property
+import numpy as np
+
+LLAR_DTYPE = np.dtype([("lat", "f8"), ("lon", "f8"), ("alt", "f8"), ("roll", "f8"), ("valid", "?")])
+
+
+def make_llar(llar, valid):
+    """
+    Packs an (N,4) lat, lon, alt, roll array and its validity mask into a LLAR_DTYPE array.
+    """
+    res = np.empty(len(llar), dtype=LLAR_DTYPE)
+    for i, field in enumerate(("lat", "lon", "alt", "roll")):
+        res[field] = llar[:, i]
+    res["valid"] = valid
+    return res
+
+
+IMAGING_DTYPE = np.dtype([("q", "f8", (4,)), ("visible", "?")])
+
+SUN_DTYPE = np.dtype([
+    ("vector", "f8", (3,)), # ECEF unit vector
+    ("sunlight", "f8"), # Visible fraction of the sun's disk: 1 in sunlight, 0 in umbra
+    ("star_tracker_angle", "f8"), # Between the star tracker boresight and the sun, degrees
+])
+
+
+def frozen(a):
+    """
+    Read-only view of a, so in-place edits can't bypass the derived data caches.
+    """
+    if a is None:
+        return None
+    a = a.view()
+    a.flags.writeable = False
+    return a
+
+
+class SimulationChunk:
+    """
+    Samples start:start + size of a streamed Simulation (see Simulation.stream), with the same
+    derived quantities as the Simulation. The arrays hold one sample past the chunk when there is
+    one, so velocities are continuous across chunk boundaries, and one before it (offset) when
+    there is one, so the last sample of the run can reuse the previous displacement.
+    """
+    start: int # Index of the first sample in the whole stream
+    size: int
+    offset: int # Position of the first sample of the chunk in the arrays
+
+    def __init__(self, start, size, time_ns, attitude, orbit, orbit_velocity_mps=None, offset=0):
+        self.start = start
+        self.size = size
+        self.offset = offset
+        self._time_ns = time_ns
+        self._attitude = attitude
+        self._orbit = orbit
+        self._orbit_velocity_mps = orbit_velocity_mps
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def _samples(self):
+        return slice(self.offset, self.offset + self.size)
+
+    @property
+    def time_ns(self):
+        return self._time_ns[self._samples]
+
+    @property
+    def times(self):
+        return self.time_ns.view("datetime64[ns]")
+
+    @property
+    def attitude(self):
+        return self._attitude[self._samples]
+
+    @property
+    def orbit(self):
+        return self._orbit[self._samples]
+
+    @property
+    def orbit_velocity_mps(self):
+        return None if self._orbit_velocity_mps is None else self._orbit_velocity_mps[self._samples]
+
+    @cached_property
+    def llar(self):
+        return make_llar(*georef_array(self.orbit, self.attitude))
+
+    @cached_property
+    def _next(self):
+        # As in Simulation, the last sample of the run reuses the previous displacement
+        return np.minimum(np.arange(self.offset, self.offset + self.size), len(self._orbit) - 2)
+
+    @cached_property
+    def orbit_velocities(self):
+        i = self._next
+        return self._orbit[i+1] - self._orbit[i]
+
+    @cached_property
+    def step_s(self):
+        # Time to the next sample, matching orbit_velocities
+        i = self._next
+        return (self._time_ns[i+1] - self._time_ns[i]) / 1e9
+
+    @cached_property
+    def orbit_speed(self):
+        return np.linalg.norm(self.orbit_velocities, axis=1) / self.step_s
 
 
 class Simulation:
-    attitude: list # Quaternions
-    orbit: list # ECEF
-    orbit_velocities: list
-    orbit_speed: list
-    dates: list # UTC
-    sun_vector: list # ECEF
-    star_tracker = [1, 0, 0]
+    attitude: np.ndarray # (N,4) scalar-first quaternions
+    orbit: np.ndarray # (N,3) ECEF, m
+    orbit_velocity_mps: np.ndarray # (N,3) ECEF, m/s, or None. Enables Hermite orbit interpolation
+    time_ns: np.ndarray # (N,) UTC, int64 nanoseconds since the Unix epoch
+    star_tracker = [1, 0, 0] # Boresight in the body frame (+z camera at nadir, +x along track at identity)
+    star_tracker_exclusion_deg = 30 # Sun exclusion half-angle
+    eclipse_model = "conical" # Or "cylindrical"
+    sun_table = True # SunTable for sun positions, True for the cached analytic table or None for the model itself
     imaging_site_location = [0, 0] # Lat, Lon
-    imaging_attitude: list # Quaternions or None
-    is_site_visible: list # Boolean
     scanline_width_m = 20000
     scanline_height_m = 100
     integration_time_s = 1/60
     interpolation_time_s = 1/60 # 60 Hz camera
+    chunk_size = 256 # Samples per cached chunk of derived data
+    adaptive = False # Interpolate sparsely where llar reconstructs within tolerance (see interpolate)
+    adaptive_sparse_time_s = 1
+    adaptive_tolerance_m = 1 # Ground error of reconstruct_llar
+    adaptive_tolerance_deg = 0.01 # Scanline rotation error of reconstruct_llar
+    adaptive_max_step_deg = 0.5 # Most the attitude turns between the samples refinement starts from
+    dense_windows = () # (start, stop) datetimes or datetime64s kept at the camera rate, e.g. imaging windows
+    imaging_radius_m = 50000 # Samples looking within this of the imaging site are kept at the camera rate
+    keyframes: tuple = None # (time_ns, attitude, orbit, orbit_velocity_mps, steps) interpolate() sampled from
+    _adaptive_times = False # time_ns was sampled adaptively, so its spacing varies
+    source_key: str = None # Result cache key of the run this was built from
+    _source_version = None # _version when source_key was set; later edits bypass the result cache
+    wheel_inertia_kgm2 = 2e-5
+    telemetry: dict # Series name (DATA_TYPES) -> (time_ns, column names, (K,C) values) at the run's own timesteps
 
-    # Derived Quantities
-    llar: list # Lat, Lon, Alt, Roll
+    # Derived Quantities, computed on first access and cached per chunk (see get_llar etc.)
+    llar: np.ndarray # LLAR_DTYPE: Lat, Lon, Alt, Roll and a validity mask
+    orbit_velocities: np.ndarray # (N,3) ECEF displacement to the next sample
+    orbit_speed: np.ndarray # (N,) m/s
+    imaging_attitude: np.ndarray # (N,4) Quaternions, NaN where the site is not visible
+    is_site_visible: np.ndarray # (N,) Boolean
+    sun_vector: np.ndarray # (N,3) ECEF unit vectors
+    sunlight: np.ndarray # (N,) Visible fraction of the sun's disk
+    in_eclipse: np.ndarray # (N,) Boolean, umbra or penumbra
+    star_tracker_sun_angle: np.ndarray # (N,) degrees
+    star_tracker_blinded: np.ndarray # (N,) Boolean, sun within the exclusion angle
 
 
-    def __init__(self, attitude, orbit, dates):
-        self.attitude = attitude
-        self.orbit = orbit
+    def __init__(self, attitude, orbit, dates, orbit_velocity_mps=None):
+        self._version = 0
+        self._llar_list = (None, None)
+        self.telemetry = {}
+        self._caches = {
+            "llar": ChunkCache(self._compute_llar, self.chunk_size),
+            "orbit_velocities": ChunkCache(self._compute_orbit_velocities, self.chunk_size),
+            "orbit_speed": ChunkCache(self._compute_orbit_speed, self.chunk_size),
+            "imaging": ChunkCache(self._compute_imaging_attitude, self.chunk_size),
+            "sun": ChunkCache(self._compute_sun, self.chunk_size),
+        }
+        self.attitude = np.asarray(attitude, dtype=float).reshape(-1, 4)
+        self.orbit = np.asarray(orbit, dtype=float).reshape(-1, 3)
+        self.orbit_velocity_mps = None if orbit_velocity_mps is None else np.asarray(orbit_velocity_mps, dtype=float).reshape(-1, 3)
         self.dates = dates
 
+    @property
+    def attitude(self):
+        return self._attitude
+
+    @attitude.setter
+    def attitude(self, attitude):
+        self._attitude = frozen(attitude)
+        self._version += 1
+
+    @property
+    def orbit(self):
+        return self._orbit
+
+    @orbit.setter
+    def orbit(self, orbit):
+        self._orbit = frozen(orbit)
+        self._version += 1
+
+    @property
+    def orbit_velocity_mps(self):
+        return self._orbit_velocity_mps
+
+    @orbit_velocity_mps.setter
+    def orbit_velocity_mps(self, velocity):
+        self._orbit_velocity_mps = frozen(velocity)
+        self._version += 1
+
+    @property
+    def time_ns(self):
+        return self._time_ns
+
+    @time_ns.setter
+    def time_ns(self, time_ns):
+        self._time_ns = frozen(np.asarray(time_ns, dtype=np.int64))
+        self._dates = None
+        self._adaptive_times = False
+        self._version += 1
+
+    @property
+    def times(self):
+        """
+        time_ns as a datetime64[ns] array.
+        """
+        return self.time_ns.view("datetime64[ns]")
+
+    @property
+    def dates(self):
+        """
+        UTC datetimes, built from time_ns on first access.
+        """
+        if self._dates is None:
+            self._dates = self.times.astype("datetime64[us]").tolist()
+        return self._dates
+
+    @dates.setter
+    def dates(self, dates):
+        self.time_ns = np.asarray(dates, dtype="datetime64[ns]").astype(np.int64)
+
+    def cache_key(self):
+        """
+        Derived data is recomputed whenever this changes.
+        """
+        return (self._version, self.interpolation_time_s)
+
+    def index(self, t):
+        """
+        Sample index of t, which may be an index, a datetime or a datetime64.
+        """
+        if t is None or isinstance(t, (int, np.integer)):
+            return t
+        return int(np.searchsorted(self.time_ns, np.datetime64(t, "ns").astype(np.int64)))
+
+    def window(self, start=0, stop=None):
+        """
+        (start, stop) sample indices of a window given as indices, datetimes or datetime64s.
+        """
+        start, stop = self.index(start), self.index(stop)
+        return slice(start, stop).indices(len(self.time_ns))[:2]
+
+    def _get(self, name, start, stop, key=None):
+        start, stop = self.window(start, stop)
+        cache = self._caches[name]
+        with span(f"derive.{name}"):
+            computed = cache.samples_computed
+            res = cache.get(start, stop, len(self.time_ns), key or self.cache_key())
+            count(f"{name}.samples", cache.samples_computed - computed)
+        return res
+
+    def get_llar(self, start=0, stop=None):
+        """
+        llar for samples start:stop. start and stop may be indices, datetimes or datetime64s.
+        """
+        return self._get("llar", start, stop)
+
+    def get_orbit_velocities(self, start=0, stop=None):
+        return self._get("orbit_velocities", start, stop)
+
+    def get_orbit_speed(self, start=0, stop=None):
+        return self._get("orbit_speed", start, stop)
+
+    def get_imaging_attitude(self, start=0, stop=None):
+        """
+        IMAGING_DTYPE array of imaging quaternions and site visibility for samples start:stop.
+        """
+        return self._get("imaging", start, stop, (*self.cache_key(), *self.imaging_site_location))
+
+    def get_sun(self, start=0, stop=None):
+        """
+        SUN_DTYPE array of sun direction, sunlight and star tracker sun angle for samples start:stop.
+        """
+        return self._get("sun", start, stop, (*self.cache_key(), *self.star_tracker, self.eclipse_model, id(self.sun_table)))
+
+    @property
+    def llar(self):
+        return self.get_llar()
+
+    @property
+    def orbit_velocities(self):
+        return self.get_orbit_velocities()
+
+    @property
+    def orbit_speed(self):
+        return self.get_orbit_speed()
+
+    @property
+    def imaging_attitude(self):
+        return self.get_imaging_attitude()["q"]
+
+    @property
+    def is_site_visible(self):
+        return self.get_imaging_attitude()["visible"]
+
+    @property
+    def sun_vector(self):
+        return self.get_sun()["vector"]
+
+    @property
+    def sunlight(self):
+        return self.get_sun()["sunlight"]
+
+    @property
+    def in_eclipse(self):
+        return self.sunlight < 1
+
+    @property
+    def star_tracker_sun_angle(self):
+        return self.get_sun()["star_tracker_angle"]
+
+    @property
+    def star_tracker_blinded(self):
+        return self.star_tracker_sun_angle < self.star_tracker_exclusion_deg
+
+    @property
+    def llar_list(self):
+        """
+        llar as a list of [lat, lon, alt, roll], with None where the Earth was missed.
+        """
+        key, res = self._llar_list
+        if key != self.cache_key():
+            llar = self.llar
+            rows = np.column_stack([llar[f] for f in ("lat", "lon", "alt", "roll")]).tolist()
+            res = [row if ok else None for row, ok in zip(rows, llar["valid"])]
+            self._llar_list = (self.cache_key(), res)
+        return res
+
+    def telemetry_at(self, name, time_ns=None):
+        """
+        (N, columns) telemetry series name linearly interpolated to time_ns (the samples by
+        default), so it lines up with attitude and the derived quantities. NaN outside the series.
+        """
+        series_ns, _, values = self.telemetry[name]
+        time_ns = self.time_ns if time_ns is None else np.asarray(time_ns, dtype="datetime64[ns]").astype(np.int64)
+        return np.column_stack([np.interp(time_ns, series_ns, v, left=np.nan, right=np.nan) for v in values.T])
+
     def timestep_s(self):
-        return (self.dates[-1] - self.dates[0]).total_seconds() / len(self.dates)
+        return (self.time_ns[-1] - self.time_ns[0]) / 1e9 / (len(self.time_ns) - 1)
     
     def interpolation_steps(self):
-        return int(self.timestep_s() / self.interpolation_time_s)
+        if self._adaptive_times:
+            raise ValueError("time_ns was sampled adaptively and has no fixed step; keyframes[4] has the steps it was sampled with")
+        # The ratio is often a hair under a whole number of camera frames
+        return max(int(self.timestep_s() / self.interpolation_time_s + 1e-9), 1)
     
+    @traced("derive.interpolate")
     def interpolate(self):
-        self.attitude = interpolate_attitude(self.attitude, self.interpolation_steps())
-        self.orbit = interpolate_orbit(self.orbit, self.interpolation_steps())
-        self.dates = interpolate_dates(self.dates, self.interpolation_steps())
+        """
+        Interpolates the key frames to interpolation_time_s. In adaptive mode only the samples
+        reconstruct_llar needs to stay within adaptive_tolerance_m and adaptive_tolerance_deg are
+        kept, plus every sample in fast slews, dense_windows and near the imaging site, so the
+        sample spacing varies. uniform() and reconstruct_llar() recover the camera rate samples.
+        """
+        steps = self.interpolation_steps()
+        self.keyframes = (self.time_ns, self.attitude, self.orbit, self.orbit_velocity_mps, steps)
+        if not self.adaptive:
+            time_ns = interpolation_times(self.time_ns, steps)
+            count("interpolate.samples", len(time_ns))
+            self.attitude, self.orbit, self.orbit_velocity_mps = interpolate_keyframes(
+                self.time_ns, self.attitude, self.orbit, time_ns, self.orbit_velocity_mps)
+            self.time_ns = time_ns
+            return
+
+        idx, llar, valid = self._adaptive_indices()
+        time_ns = grid_times(self.time_ns, steps, idx)
+        count("interpolate.samples", len(time_ns))
+        self.attitude, self.orbit, self.orbit_velocity_mps = interpolate_keyframes(
+            self.time_ns, self.attitude, self.orbit, time_ns, self.orbit_velocity_mps)
+        self.time_ns = time_ns
+        self._adaptive_times = True
+        self._caches["llar"].prime(frozen(make_llar(llar, valid)), self.cache_key())
+
+    def _adaptive_indices(self):
+        key_ns, attitude, orbit, velocity, steps = self.keyframes
+        n = (len(key_ns) - 1) * steps + 1
+
+        def evaluate(k):
+            a, o, _ = interpolate_keyframes(key_ns, attitude, orbit, grid_times(key_ns, steps, k), velocity)
+            return georef_array(o, a)
 
-    def calculate_velocities(self): # TODO: This assumes constant time intervals
-        self.orbit_velocities = [vec_diff(self.orbit[i], self.orbit[i-1]) for i in range(1, len(self.orbit))]
-        self.orbit_velocities.append(self.orbit_velocities[-1])
-        self.orbit_speed = [mag(v)/self.timestep_s() for v in self.orbit_velocities]
+        # Start slews from samples at most adaptive_max_step_deg apart, up to the camera rate
+        dense = np.zeros(n, dtype=bool)
+        sparse_steps = max(round(self.adaptive_sparse_time_s / self.interpolation_time_s), 1)
+        frame_deg = segment_rates(key_ns / 1e9, attitude) * self.interpolation_time_s
+        seed_steps = np.clip(self.adaptive_max_step_deg // np.maximum(frame_deg, 1e-12), 1, sparse_steps).astype(np.int64)
+        for i in np.flatnonzero(seed_steps < sparse_steps):
+            dense[i * steps:(i + 1) * steps + 1:seed_steps[i]] = True
+        for start, stop in self.dense_windows:
+            lo = grid_index(key_ns, steps, np.datetime64(start, "ns").astype(np.int64))
+            hi = grid_index(key_ns, steps, np.datetime64(stop, "ns").astype(np.int64), side="right")
+            dense[lo:hi + 1] = True
+
+        site = lla2ecef(*self.imaging_site_location)
+        def near(llar, valid):
+            ground = lla2ecef(llar[:, 0], llar[:, 1])
+            return valid & (np.linalg.norm(np.nan_to_num(ground) - site, axis=1) < self.imaging_radius_m)
+
+        return adaptive_indices(evaluate, lambda k: grid_times(key_ns, steps, k), n, sparse_steps,
+                                self.adaptive_tolerance_m, self.adaptive_tolerance_deg, dense, near)
+
+    def _grid_window(self, start, stop):
+        # Camera rate sample range of a window given as datetimes or datetime64s
+        key_ns, _, _, _, steps = self.keyframes
+        lo = 0 if start is None else int(grid_index(key_ns, steps, np.datetime64(start, "ns").astype(np.int64)))
+        hi = (len(key_ns) - 1) * steps if stop is None else \
+            int(grid_index(key_ns, steps, np.datetime64(stop, "ns").astype(np.int64), side="right"))
+        return lo, hi + 1
+
+    def reconstruct_llar(self, start=None, stop=None):
+        """
+        (time_ns, llar) at the camera rate between datetimes start and stop, reconstructed from
+        the samples an adaptive interpolate() kept, within the adaptive tolerances.
+        """
+        key_ns, _, _, _, steps = self.keyframes
+        time_ns = interpolation_times(key_ns, steps, *self._grid_window(start, stop))
+        llar = self.llar
+        rows = np.column_stack([llar[f] for f in ("lat", "lon", "alt", "roll")])
+        return time_ns, make_llar(*reconstruct_llar(self.time_ns, rows, llar["valid"], time_ns))
+
+    def uniform(self, start=None, stop=None):
+        """
+        Simulation of the camera rate samples between datetimes start and stop, interpolated
+        exactly from the key frames, e.g. for a close look at part of an adaptive run.
+        """
+        key_ns, attitude, orbit, velocity, steps = self.keyframes
+        time_ns = interpolation_times(key_ns, steps, *self._grid_window(start, stop))
+        attitude, orbit, velocity = interpolate_keyframes(key_ns, attitude, orbit, time_ns, velocity)
+        res = Simulation(attitude, orbit, time_ns.view("datetime64[ns]"), velocity)
+        for name in ("star_tracker", "star_tracker_exclusion_deg", "eclipse_model", "sun_table", "imaging_site_location",
+                     "scanline_width_m", "scanline_height_m", "integration_time_s", "interpolation_time_s"):
+            setattr(res, name, getattr(self, name))
+        res.telemetry = self.telemetry
+        return res
+
+    def stream(self, chunk_size=65536):
+        """
+        Interpolates the run to interpolation_time_s chunk_size samples at a time, yielding
+        SimulationChunks whose llar and velocities are derived on access. Unlike derive_data the
+        run is never interpolated as a whole and is left unchanged, so memory is proportional to
+        chunk_size rather than run length. See tools/stream.py for sinks that consume the chunks.
+        After an adaptive interpolate() the camera rate run is streamed from the key frames.
+        """
+        if self._adaptive_times:
+            key_ns, key_attitude, key_orbit, key_velocity, steps = self.keyframes
+        else:
+            key_ns, key_attitude, key_orbit, key_velocity = self.time_ns, self.attitude, self.orbit, self.orbit_velocity_mps
+            steps = self.interpolation_steps()
+        keys = len(key_ns)
+        n = (keys - 1) * steps + 1
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            first, end = max(start - 1, 0), min(stop + 1, n)
+            time_ns = interpolation_times(key_ns, steps, first, end)
+            # Only the key frames around the chunk
+            lo = min(first // steps, keys - 2)
+            hi = min((end - 1) // steps + 2, keys)
+            velocity = None if key_velocity is None else key_velocity[lo:hi]
+            with span("stream.interpolate"):
+                attitude, orbit, velocity = interpolate_keyframes(
+                    key_ns[lo:hi], key_attitude[lo:hi], key_orbit[lo:hi], time_ns, velocity)
+            yield SimulationChunk(start, stop - start, time_ns, attitude, orbit, velocity, start - first)
+
+    def _compute_llar(self, start, stop):
+        return make_llar(*georef_array(self.orbit[start:stop], self.attitude[start:stop]))
+
+    def _compute_orbit_velocities(self, start, stop):
+        # The last sample reuses the previous displacement
+        i = np.minimum(np.arange(start, stop), len(self.orbit) - 2)
+        return self.orbit[i+1] - self.orbit[i]
+
+    def _compute_orbit_speed(self, start, stop):
+        i = np.minimum(np.arange(start, stop), len(self.orbit) - 2)
+        dt = (self.time_ns[i+1] - self.time_ns[i]) / 1e9
+        return np.linalg.norm(self.get_orbit_velocities(start, stop), axis=1) / dt
+
+    def _compute_imaging_attitude(self, start, stop):
+        # Rotate nadir onto the line of sight to the site. The site is visible when the satellite is above its horizon
+        orbit = self.orbit[start:stop]
+        site = lla2ecef(*self.imaging_site_location)
+        up = lla2ecef(*self.imaging_site_location, 1) - site
+        res = np.empty(len(orbit), dtype=IMAGING_DTYPE)
+        res["visible"] = (orbit - site) @ up > 0
+        res["q"] = quat_between(-orbit, site - orbit)
+        res["q"][~res["visible"]] = np.nan
+        return res
+
+    def _compute_sun(self, start, stop):
+        sun = sun_position_ecef(self.times[start:stop], self.sun_table)
+        orbit = self.orbit[start:stop]
+        velocity = self.orbit_velocity_mps[start:stop] if self.orbit_velocity_mps is not None else self.get_orbit_velocities(start, stop)
+        res = np.empty(stop - start, dtype=SUN_DTYPE)
+        res["vector"] = sun / np.linalg.norm(sun, axis=1, keepdims=True)
+        res["sunlight"] = sunlight_fraction(orbit, sun, conical=self.eclipse_model == "conical")
+        res["star_tracker_angle"] = sun_angle(self.attitude[start:stop], orbit, velocity, self.star_tracker, res["vector"])
+        return res
+
+    def calculate_velocities(self):
+        self.get_orbit_speed()
 
     def calculate_sun_vector(self):
-        # Use dates to find sun vector
-        self.sun_vector = []
+        self.get_sun()
 
     def calculate_imaging_attitude(self):
-        # From the orbit (self.orbit) and imaging site (self.imaging_site_location), calculate the imaging attitude. Also check whether the site is visible (we don't look through the earth)
-        self.imaging_attitude = []
-        self.is_site_visible = []
-
-    def derive_data(self):
-        self.interpolate()
-        self.llar = [georef(self.orbit[i], self.attitude[i]) for i in range(len(self.orbit))]
-        self.calculate_velocities()
-        self.calculate_sun_vector()
-        self.calculate_imaging_attitude()
-
-    def export_quaternions(self,filename: str, BlockingFactor = 20, coordinate_axes = "ICRF"):
-        with open(f"{filename}.a","w") as f:
-            #Header information
-            f.write("stk.v.12.0\n")
-            f.write("# WrittenBy    Custom_Simulation\n\n")
-            f.write("BEGIN Attitude\n\n")
-
-            #Metadata
-            f.write(f"    NumberOfAttitudePoints\t {len(self.attitude)}\n")
-            f.write(f"    BlockingFactor\t {BlockingFactor}\n")
-            f.write(f"    CentralBody\t Earth\n")
-            f.write(f"    ScenarioEpoch\t {self.dates[0].strftime('%d %b %Y %H:%M:%S.%f')}\n")
-            
-            # Coordinate system
-            f.write(f"    CoordinateAxes\t {coordinate_axes}\n\n")
-
-            # Attitude data
-            f.write("AttitudeTimeQuaternions\t\n")
-            timestep = (self.dates[1] - self.dates[0]).total_seconds() if len(self.dates) > 1 else 0
-
-            # This is assuming the attitude data is in scalar last format
-            for i, quat in enumerate(self.attitude):
-                q1, q2, q3, qs = quat
-                f.write(f" {i*timestep}\t{q1}\t{q2}\t{q3}\t{qs}\n")
-
-            f.write("END Attitude\n")
+        self.get_imaging_attitude()
+
+    @traced("derive_data")
+    def derive_data(self, cache=True):
+        """
+        Interpolates to the camera rate. llar, velocities, speeds, imaging attitude and sun data are
+        then derived on first access, for the whole run or a window (see get_llar etc.).
+
+        For runs that came from the result cache (tools/cache.py) the interpolated arrays and llar
+        are looked up in and saved to the cache as well, unless cache is False or the attitude,
+        orbit or times have been changed since.
+        """
+        if not cache or self.source_key is None or self._version != self._source_version:
+            self.interpolate()
+            return
+
+        cache = default_cache() if cache is True else cache
+        variant = None
+        if self.adaptive:
+            variant = "adaptive-" + "-".join(f"{v:g}" for v in (
+                self.adaptive_sparse_time_s, self.adaptive_tolerance_m, self.adaptive_tolerance_deg,
+                self.adaptive_max_step_deg, self.imaging_radius_m, *self.imaging_site_location))
+            if self.dense_windows:
+                variant += "-" + "-".join(str(np.datetime64(t, "ns").astype(np.int64)) for w in self.dense_windows for t in w)
+        key = ResultCache.derived_key(self.source_key, self.interpolation_time_s, variant)
+        arrays = cache.load_derived(key)
+        if arrays is None:
+            self.interpolate()
+            arrays = {"time_ns": self.time_ns, "attitude": self.attitude, "orbit": self.orbit, "llar": self.llar}
+            if self.orbit_velocity_mps is not None:
+                arrays["orbit_velocity_mps"] = self.orbit_velocity_mps
+            cache.save_derived(key, arrays)
+        else:
+            self.keyframes = (self.time_ns, self.attitude, self.orbit, self.orbit_velocity_mps, self.interpolation_steps())
+            self.time_ns = arrays["time_ns"]
+            self.attitude = arrays["attitude"]
+            self.orbit = arrays["orbit"]
+            self.orbit_velocity_mps = arrays.get("orbit_velocity_mps")
+            self._adaptive_times = self.adaptive
+            self._caches["llar"].prime(frozen(arrays["llar"]), self.cache_key())
+
+    @traced("export.stk_attitude")
+    def export_quaternions(self, filename: str, BlockingFactor = 20, coordinate_axes = "ICRF"):
+        """
+        Writes the attitude to filename.a in STK format, with real per-sample time offsets and the
+        scalar-first quaternions reordered to STK's scalar-last. See tools/export.py.
+        """
+        write_stk_attitude(f"{filename}.a", self.time_ns, self.attitude, coordinate_axes=coordinate_axes,
+                           blocking_factor=BlockingFactor)
+
+    @traced("export.stk_ephemeris")
+    def export_ephemeris(self, filename: str):
+        """
+        Writes the ECEF orbit to filename.e in STK format, with velocities when they are known.
+        """
+        write_stk_ephemeris(f"{filename}.e", self.time_ns, self.orbit, self.orbit_velocity_mps)
+
+    @traced("export.aem")
+    def export_aem(self, filename: str, **kwargs):
+        """
+        Writes the attitude to filename.aem as a CCSDS Attitude Ephemeris Message.
+        """
+        write_aem(f"{filename}.aem", self.time_ns, self.attitude, **kwargs)
 
     @classmethod
+    @traced("load.from_tensor_tech_sim")
     def from_tensor_tech_sim(cls, sim: TensorTechSimulation):
-        attitude = [mrp["val"] for mrp in sim.mrpData]
-        attitude = [attitude[i:i+3] for i in range(0, len(attitude), 3)]
-        attitude = [mrp2quat(m) for m in attitude]
-        
-        orbit = [sim.orbitData[i]["r"] for i in range(len(sim.orbitData))]
-        dates = [sim.orbitData[i]["date"] for i in range(len(sim.orbitData))]
-        dates = [datetime.strptime(date, "%Y-%m-%d %H:%M:%S") for date in dates]
-        return cls(attitude, orbit, dates)
\ No newline at end of file
+        """
+        Simulation of a TensorTech run. The attitude MRPs are pivoted by name onto their own time
+        axis and converted in bulk, then slerped onto the orbit times if the two differ. Every
+        series in DATA_TYPES is kept as telemetry (see telemetry_at).
+        """
+        mrp_ns, mrp = pivot_columns(sim.mrpData, ["x", "y", "z"])
+        attitude = mrp2quat_array(mrp)
+        if not np.array_equal(mrp_ns, sim.orbit_time):
+            # Held at the first and last MRP outside their span
+            mrp_ns = mrp_ns.astype(np.int64)
+            orbit_ns = np.clip(sim.orbit_time.astype(np.int64), mrp_ns[0], mrp_ns[-1])
+            attitude = slerp_attitude((mrp_ns - mrp_ns[0]) / 1e9, attitude, (orbit_ns - mrp_ns[0]) / 1e9)
+
+        simulation = cls(attitude, sim.orbit_r, sim.orbit_time, sim.orbit_v)
+        simulation.source_key = sim.run_key
+        simulation._source_version = simulation._version
+        for name in DATA_TYPES:
+            times, columns, values = pivot_records(getattr(sim, name))
+            simulation.telemetry[name] = (frozen(times.astype(np.int64)), columns, frozen(values))
+        return simulation
@@ -0,0 +1,169 @@
+import numpy as np
+from .geodetic import ecef2lla_array, lla2ecef
+from .instrument import count, span
+
+
+def wrap180(angle):
+    return (angle + 180) % 360 - 180
+
+
+def interpolate_rows(llar0, llar1, valid0, valid1, u):
+    """
+    Rows at fractions u between (M,4) lat, lon, alt, roll rows llar0 and llar1: ground points are
+    interpolated linearly in ECEF and projected back onto the ellipsoid, and rolls linearly the
+    shorter way round. Rows between a valid and an invalid row are invalid.
+    """
+    ground0, ground1 = lla2ecef(llar0[:, 0], llar0[:, 1]), lla2ecef(llar1[:, 0], llar1[:, 1])
+    res = np.zeros((len(u), 4))
+    res[:, :2] = ecef2lla_array(ground0 + u[:, None] * (ground1 - ground0), validate=False)[:, :2]
+    res[:, 3] = wrap180(llar0[:, 3] + u * wrap180(llar1[:, 3] - llar0[:, 3]))
+    valid = valid0 & valid1
+    res[~valid] = np.nan
+    return res, valid
+
+
+def reconstruct_llar(time_ns, llar, valid, sample_ns):
+    """
+    (M,4) lat, lon, alt, roll and (M,) validity at sample_ns from sparse (N,4) rows and validity at
+    time_ns, interpolated as adaptive_indices assumes.
+    """
+    time_ns = np.asarray(time_ns, dtype=np.int64)
+    sample_ns = np.asarray(sample_ns, dtype=np.int64)
+    if len(time_ns) == 1:
+        return np.repeat(llar, len(sample_ns), axis=0), np.repeat(valid, len(sample_ns))
+    i = np.clip(np.searchsorted(time_ns, sample_ns, side="right") - 1, 0, len(time_ns) - 2)
+    u = (sample_ns - time_ns[i]) / (time_ns[i+1] - time_ns[i])
+    res, res_valid = interpolate_rows(llar[i], llar[i+1], valid[i], valid[i+1], u)
+
+    # Exact hits keep their own row, so a valid sample next to an invalid one survives
+    exact = u == 0
+    res[exact] = llar[i[exact]]
+    res_valid[exact] = valid[i[exact]]
+    return res, res_valid
+
+
+def reconstruction_error(llar, valid, truth, truth_valid):
+    """
+    Ground distance (m) and roll difference (degrees) of reconstructed samples from the truth,
+    infinite where their validity differs.
+    """
+    ground = np.linalg.norm(lla2ecef(llar[:, 0], llar[:, 1]) - lla2ecef(truth[:, 0], truth[:, 1]), axis=1)
+    roll = np.abs(wrap180(llar[:, 3] - truth[:, 3]))
+    mismatch = valid != truth_valid
+    both = valid & truth_valid
+    ground = np.where(mismatch, np.inf, np.where(both, ground, 0))
+    roll = np.where(mismatch, np.inf, np.where(both, roll, 0))
+    return ground, roll
+
+
+def adaptive_indices(evaluate, times, n, sparse_steps, tolerance_m, tolerance_deg, dense=None, near=None):
+    """
+    Indices of samples to keep out of a uniform sequence of n, so that reconstruct_llar from the
+    kept samples stays within tolerance_m on the ground and tolerance_deg in scanline rotation.
+
+    evaluate(k) returns the (M,4) llar and (M,) validity of samples k and times(k) their int64
+    times. Sampling starts every sparse_steps samples and bisects any interval whose quarter
+    points reconstruct out of tolerance, down to neighbouring samples. dense is a boolean mask of
+    samples that are always kept. near(llar, valid) flags kept samples whose whole intervals on
+    either side are filled in, e.g. those over an imaging site.
+
+    Returns the sorted indices with their llar and validity.
+    """
+    start = np.unique(np.r_[np.arange(0, n, max(sparse_steps, 1)), n - 1,
+                            np.flatnonzero(dense) if dense is not None else []]).astype(np.int64)
+    idx, (llar, valid) = start, evaluate(start)
+
+    def refine(idx, llar, valid):
+        # Bisect out of tolerance intervals until every interval passes or has no samples inside
+        pending = np.flatnonzero(np.diff(idx) > 1)
+        a, b = idx[pending], idx[pending + 1]
+        la, lb, va, vb = llar[pending], llar[pending + 1], valid[pending], valid[pending + 1]
+        new_idx, new_llar, new_valid = [idx], [llar], [valid]
+        while len(a):
+            count("adaptive.rounds")
+            m = (a + b) // 2
+            probes = np.stack([(a + m) // 2, m, (m + b) // 2], axis=1)
+            probe_llar, probe_valid = evaluate(probes.ravel())
+            count("adaptive.probes", probes.size)
+
+            # Reconstruct each probe from its interval's two ends
+            t_a, t_b, t_p = times(a), times(b), times(probes.ravel()).reshape(probes.shape)
+            u = ((t_p - t_a[:, None]) / (t_b - t_a)[:, None]).ravel()
+            ends = np.repeat(np.arange(len(a)), 3)
+            recon, recon_valid = interpolate_rows(la[ends], lb[ends], va[ends], vb[ends], u)
+            ground, roll = reconstruction_error(recon, recon_valid, probe_llar, probe_valid)
+            bad = ((ground > tolerance_m) | (roll > tolerance_deg)).reshape(probes.shape).any(axis=1)
+
+            mid_llar, mid_valid = probe_llar.reshape(-1, 3, 4)[bad, 1], probe_valid.reshape(-1, 3)[bad, 1]
+            m = m[bad]
+            new_idx.append(m)
+            new_llar.append(mid_llar)
+            new_valid.append(mid_valid)
+            a, b = np.r_[a[bad], m], np.r_[m, b[bad]]
+            la, lb = np.r_[la[bad], mid_llar], np.r_[mid_llar, lb[bad]]
+            va, vb = np.r_[va[bad], mid_valid], np.r_[mid_valid, vb[bad]]
+            keep = b - a > 1
+            a, b, la, lb, va, vb = a[keep], b[keep], la[keep], lb[keep], va[keep], vb[keep]
+
+        idx = np.concatenate(new_idx)
+        order = np.argsort(idx, kind="stable")
+        return idx[order], np.concatenate(new_llar)[order], np.concatenate(new_valid)[order]
+
+    with span("adaptive.refine"):
+        idx, llar, valid = refine(idx, llar, valid)
+
+    if near is not None:
+        flagged = near(llar, valid)
+        if flagged.any():
+            # Every sample between the neighbours of a flagged sample
+            lo = idx[np.maximum(np.flatnonzero(flagged) - 1, 0)]
+            hi = idx[np.minimum(np.flatnonzero(flagged) + 1, len(idx) - 1)]
+            fill = np.zeros(n + 1, dtype=np.int64)
+            np.add.at(fill, lo, 1)
+            np.add.at(fill, hi + 1, -1)
+            extra = np.setdiff1d(np.flatnonzero(np.cumsum(fill)[:n] > 0), idx)
+            if len(extra):
+                extra_llar, extra_valid = evaluate(extra)
+                idx = np.r_[idx, extra]
+                order = np.argsort(idx, kind="stable")
+                idx, llar, valid = idx[order], np.r_[llar, extra_llar][order], np.r_[valid, extra_valid][order]
+    count("adaptive.samples", len(idx))
+    return idx, llar, valid
+
+
+def segment_rates(key_s, attitude):
+    """
+    (N-1,) angular rates (degrees per second) of the slerped attitude in each key frame segment.
+    """
+    dot = np.abs(np.sum(attitude[:-1] * attitude[1:], axis=1))
+    return np.degrees(2 * np.arccos(np.clip(dot, -1, 1))) / np.diff(key_s)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    from .simulator import TensorTechSimulation
+    from ..classes.simulation import Simulation
+
+    # Sample counts and worst reconstruction errors of adaptive against uniform sampling
+    for filename in sys.argv[1:] or ["analysis/json/nadir_june_2024.json", "analysis/json/fixed_attitude_june_2024.json",
+                                     "analysis/json/fine_pointing_june_2024.json"]:
+        sim = TensorTechSimulation.from_file(filename)
+        uniform = Simulation.from_tensor_tech_sim(sim)
+        uniform.derive_data(cache=False)
+        truth = uniform.llar
+
+        adaptive = Simulation.from_tensor_tech_sim(sim)
+        adaptive.adaptive = True
+        start = time.perf_counter()
+        adaptive.derive_data(cache=False)
+        elapsed = time.perf_counter() - start
+
+        llar = adaptive.llar
+        recon, valid = reconstruct_llar(adaptive.time_ns, np.column_stack([llar[f] for f in ("lat", "lon", "alt", "roll")]),
+                                        llar["valid"], uniform.time_ns)
+        truth_rows = np.column_stack([truth[f] for f in ("lat", "lon", "alt", "roll")])
+        ground, roll = reconstruction_error(recon, valid, truth_rows, truth["valid"])
+        print(f"{filename}: {len(uniform.time_ns)} -> {len(adaptive.time_ns)} samples "
+              f"({len(uniform.time_ns) / len(adaptive.time_ns):.0f}x fewer) in {elapsed:.2f} s, "
+              f"max error {ground.max():.3f} m, {roll.max():.4f} deg")
@@ -0,0 +1,202 @@
+import asyncio
+import csv
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .simulator import TensorTechSimulation, SimulatonConfig, Maneuver, AlignmentAxis, pivot_records
+from .convert import lla2ecef
+from .client import TensorTechClient, DEFAULT_URL
+from .cache import ResultCache, write_atomic
+from .runstore import RunStore
+
+SUMMARY_FIELDS = ["hash", "backend", "name", "maneuver", "alignment_axis", "fine_cmd", "tle_epoch", "status", "samples",
+                  "valid_fraction", "mean_abs_scanline_rotation_deg", "max_abs_scanline_rotation_deg",
+                  "mean_point_interval_m", "final_attitude_error_rad"]
+
+
+def scenario_grid(name, maneuvers, alignment_axes, fine_cmds=(None,), tles=(None,), sim_time_min=30, step_size=0.01):
+    """
+    SimulatonConfigs for every combination of maneuver, alignment axis, fine pointing command
+    (a list of four strings, or None for the default) and TLE (a (line 1, line 2) pair, or None).
+    """
+    configs = []
+    for maneuver, axis, fine_cmd, tle in itertools.product(maneuvers, alignment_axes, fine_cmds, tles):
+        config = SimulatonConfig(name, maneuver, sim_time_min, axis)
+        config.step_size = step_size
+        if fine_cmd is not None:
+            config.fine_cmd = [str(x) for x in fine_cmd]
+        if tle is not None:
+            config.tle_1, config.tle_2 = tle
+        configs.append(config)
+    return configs
+
+
+def result_dir(results_dir, config: SimulatonConfig, backend="remote"):
+    # Keyed like the result cache, so local and remote runs of a config are kept apart
+    return os.path.join(results_dir, ResultCache.run_key(config, backend))
+
+
+def save_run(sim: TensorTechSimulation, path):
+    # An interrupted save must not leave a truncated run to be reused
+    write_atomic(path, lambda f: RunStore.write(f, sim))
+    return path
+
+
+def run_local(config: SimulatonConfig, path):
+    """
+    Propagates a config locally and saves the run store to path. Runs in a worker process.
+    """
+    sim = TensorTechSimulation(config)
+    sim.run(local=True, cache=False)
+    return save_run(sim, path)
+
+
+def derive(path, interpolation_time_s):
+    """
+    Derives a saved run and returns its summary metrics. Runs in a worker process.
+    """
+    from ..classes.simulation import Simulation
+
+    sim = TensorTechSimulation.from_file(path)
+    simulation = Simulation.from_tensor_tech_sim(sim)
+    simulation.interpolation_time_s = interpolation_time_s
+    simulation.derive_data()
+
+    llar = simulation.llar
+    valid = llar["valid"]
+    ground = lla2ecef(llar["lat"], llar["lon"])
+    step = np.linalg.norm(np.diff(ground, axis=0), axis=1)
+    step = step[valid[1:] & valid[:-1]]
+    roll = np.abs(llar["roll"][valid])
+    error = pivot_records(sim.attitudeErrorData)[2][:, 0]
+
+    return {
+        "samples": len(llar),
+        "valid_fraction": float(valid.mean()),
+        "mean_abs_scanline_rotation_deg": float(roll.mean()) if len(roll) else None,
+        "max_abs_scanline_rotation_deg": float(roll.max()) if len(roll) else None,
+        "mean_point_interval_m": float(step.mean()) if len(step) else None,
+        "final_attitude_error_rad": float(error[-1]),
+    }
+
+
+async def _simulate(config, path, backend, remote_slots, pool, client):
+    if os.path.exists(path):
+        return path
+    if backend == "local":
+        return await asyncio.get_running_loop().run_in_executor(pool, run_local, config, path)
+
+    async with remote_slots:
+        sim = TensorTechSimulation(config)
+        await sim.run_async(cache=False, client=client)
+    return save_run(sim, path)
+
+
+async def _run_one(config, results_dir, backend, remote_slots, pool, client, interpolation_time_s):
+    directory = result_dir(results_dir, config, backend)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "config.json"), "w") as f:
+        f.write(config.to_json())
+
+    row = {
+        "hash": config.config_hash(),
+        "backend": backend,
+        "name": config.name,
+        "maneuver": config.maneuver.name,
+        "alignment_axis": config.alignment_axis.name,
+        "fine_cmd": " ".join(config.fine_cmd),
+        "tle_epoch": config.tle_1[18:32].strip(),
+    }
+    try:
+        path = await _simulate(config, os.path.join(directory, "run.npz"), backend, remote_slots, pool, client)
+        metrics = await asyncio.get_running_loop().run_in_executor(pool, derive, path, interpolation_time_s)
+        with open(os.path.join(directory, "metrics.json"), "w") as f:
+            json.dump(metrics, f, indent=4)
+        row.update(metrics, status="ok")
+    except Exception as e:
+        # Keep the rest of the batch going
+        row["status"] = f"failed: {e!r}"
+    return row
+
+
+async def run_batch_async(configs, results_dir, backend="remote", max_remote=4, workers=None,
+                          interpolation_time_s=1/60, poll_s=1, base_url=DEFAULT_URL):
+    """
+    Simulates and derives every config concurrently. At most max_remote TensorTech sessions run at
+    once, sharing one pooled client; local propagation and derivation share a pool of `workers`
+    processes (all cores by default). Runs already in results_dir are reused. Returns the summary rows.
+    """
+    remote_slots = asyncio.Semaphore(max_remote)
+    with ProcessPoolExecutor(max_workers=workers) as pool, TensorTechClient(base_url, poll_s=poll_s) as client:
+        rows = await asyncio.gather(*[
+            _run_one(config, results_dir, backend, remote_slots, pool, client, interpolation_time_s)
+            for config in configs
+        ])
+    write_summary(rows, os.path.join(results_dir, "summary.csv"))
+    return rows
+
+
+def run_batch(configs, results_dir, **kwargs):
+    return asyncio.run(run_batch_async(configs, results_dir, **kwargs))
+
+
+def write_summary(rows, filename):
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def format_summary(rows):
+    """
+    Plain text table of the summary rows.
+    """
+    fields = ["hash", "backend", "maneuver", "alignment_axis", "fine_cmd", "status", "valid_fraction",
+              "mean_abs_scanline_rotation_deg", "mean_point_interval_m", "final_attitude_error_rad"]
+
+    def cell(value):
+        return f"{value:.4g}" if isinstance(value, float) else str(value if value is not None else "")
+
+    table = [fields] + [[cell(row.get(f)) for f in fields] for row in rows]
+    widths = [max(len(r[i]) for r in table) for i in range(len(fields))]
+    return "\n".join("  ".join(c.ljust(w) for c, w in zip(r, widths)) for r in table)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a grid of simulation scenarios concurrently")
+    parser.add_argument("results_dir")
+    parser.add_argument("--name", default="batch")
+    parser.add_argument("--maneuver", nargs="+", default=["NADIR"], choices=[m.name for m in Maneuver])
+    parser.add_argument("--axis", nargs="+", default=["POS_Z"], choices=[a.name for a in AlignmentAxis])
+    parser.add_argument("--fine-cmd", nargs="+", default=[], help="Quaternions as w,x,y,z")
+    parser.add_argument("--tle-file", help="File of TLE line pairs to sweep over")
+    parser.add_argument("--time", type=float, default=30, help="Simulation time (min)")
+    parser.add_argument("--step-size", type=float, default=0.01)
+    parser.add_argument("--backend", choices=["remote", "local"], default="remote")
+    parser.add_argument("--max-remote", type=int, default=4, help="Concurrent TensorTech sessions")
+    parser.add_argument("--workers", type=int, default=None, help="Derivation processes (default: all cores)")
+    parser.add_argument("--rate", type=float, default=60, help="Interpolation rate (Hz)")
+    args = parser.parse_args()
+
+    tles = [None]
+    if args.tle_file:
+        with open(args.tle_file) as f:
+            lines = [line.rstrip() for line in f if line[:2] in ("1 ", "2 ")]
+        tles = [(lines[i], lines[i+1]) for i in range(0, len(lines) - 1, 2)]
+
+    configs = scenario_grid(
+        args.name,
+        [Maneuver[m] for m in args.maneuver],
+        [AlignmentAxis[a] for a in args.axis],
+        [cmd.split(",") for cmd in args.fine_cmd] or [None],
+        tles,
+        args.time,
+        args.step_size,
+    )
+    rows = run_batch(configs, args.results_dir, backend=args.backend, max_remote=args.max_remote,
+                     workers=args.workers, interpolation_time_s=1 / args.rate)
+    print(format_summary(rows))
@@ -0,0 +1,212 @@
+import hashlib
+import os
+import tempfile
+import time
+from functools import lru_cache
+import numpy as np
+from .simulator import TensorTechSimulation
+from .runstore import RunStore
+from .instrument import traced
+
+DEFAULT_CACHE_DIR = os.environ.get("ADCS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "adcs-attitude-planning"))
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+# Sources whose changes invalidate derived products
+# Every module the interpolated arrays and llar are computed with
+DERIVED_SOURCES = ["tools/calculate.py", "tools/convert.py", "tools/consts.py", "tools/geodetic.py", "tools/adaptive.py", "classes/simulation.py"]
+
+
+def write_atomic(path, write):
+    """
+    Calls write with a temporary file next to path, then moves it to path, so readers never see
+    a partial file. Concurrent writers each get their own temporary file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+@lru_cache(maxsize=None)
+def code_version():
+    """
+    Short hash of the sources that derived products depend on.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    digest = hashlib.sha256()
+    for source in DERIVED_SOURCES:
+        with open(os.path.join(root, source), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+class ResultCache:
+    """
+    Local content-addressed cache of simulation runs and derived Simulation products.
+
+    Runs are RunStores under runs/, keyed on the SimulatonConfig hash and the backend that produced
+    them. Derived products are .npz files under derived/, keyed on the run key, the interpolation
+    rate and code_version(). Entries are evicted least recently used first once the cache grows past
+    max_bytes.
+    """
+    root: str
+    max_bytes: int
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def run_key(config, backend="remote"):
+        return config.config_hash() if backend == "remote" else f"{config.config_hash()}-{backend}"
+
+    @staticmethod
+    def derived_key(run_key, interpolation_time_s, variant=None):
+        variant = f"-{variant}" if variant else ""
+        return f"{run_key}-{1 / interpolation_time_s:.6g}Hz{variant}-{code_version()}"
+
+    def _path(self, kind, key):
+        return os.path.join(self.root, kind, f"{key}.npz")
+
+    def _open(self, kind, key):
+        path = self._path(kind, key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path) # Mark as recently used
+        return path
+
+    def _write(self, kind, key, write):
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, write)
+        self.prune(self.max_bytes, keep=[(kind, key)])
+
+    @traced("cache.load_run")
+    def load_run(self, sim: TensorTechSimulation, backend="remote"):
+        """
+        Fills sim from the cache. Returns False on a miss.
+        """
+        key = self.run_key(sim.simulation_config, backend)
+        path = self._open("runs", key)
+        if path is None:
+            return False
+        cached = RunStore(path, mmap=False).to_tensor_tech_sim()
+        cached.simulation_config = sim.simulation_config
+        sim.__dict__.update(cached.__dict__)
+        sim.run_key = key
+        return True
+
+    @traced("cache.save_run")
+    def save_run(self, sim: TensorTechSimulation, backend="remote"):
+        sim.run_key = self.run_key(sim.simulation_config, backend)
+        self._write("runs", sim.run_key, lambda f: RunStore.write(f, sim))
+
+    @traced("cache.load_derived")
+    def load_derived(self, key):
+        """
+        Dict of the arrays saved under key, or None on a miss.
+        """
+        path = self._open("derived", key)
+        if path is None:
+            return None
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+    @traced("cache.save_derived")
+    def save_derived(self, key, arrays):
+        self._write("derived", key, lambda f: np.savez(f, **arrays))
+
+    def entries(self):
+        """
+        (kind, key, bytes, last used timestamp) of every entry, least recently used first.
+        """
+        res = []
+        for kind in ("runs", "derived"):
+            directory = os.path.join(self.root, kind)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith(".npz"):
+                    stat = os.stat(os.path.join(directory, name))
+                    res.append((kind, name[:-4], stat.st_size, stat.st_mtime))
+        return sorted(res, key=lambda e: e[3])
+
+    def size(self):
+        return sum(e[2] for e in self.entries())
+
+    def prune(self, max_bytes=None, older_than_s=None, keep=()):
+        """
+        Evicts entries unused for older_than_s seconds, then least recently used entries until the
+        cache fits in max_bytes. (kind, key) pairs in keep are never evicted. Returns the evicted entries.
+        """
+        entries = self.entries()
+        total = sum(e[2] for e in entries)
+        removed = []
+        for entry in entries:
+            if entry[:2] in keep:
+                continue
+            stale = older_than_s is not None and time.time() - entry[3] > older_than_s
+            if not stale and (max_bytes is None or total <= max_bytes):
+                continue
+            try:
+                os.remove(self._path(entry[0], entry[1]))
+            except FileNotFoundError:
+                continue
+            total -= entry[2]
+            removed.append(entry)
+        return removed
+
+    def clear(self):
+        return self.prune(0)
+
+
+@lru_cache(maxsize=None)
+def default_cache():
+    return ResultCache()
+
+
+def parse_size(text):
+    """
+    Byte count of a size like 500M or 2G.
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    text = text.strip().upper().rstrip("B")
+    return int(float(text[:-1]) * units[text[-1]]) if text[-1] in units else int(text)
+
+
+def format_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+if __name__ == "__main__":
+    import argparse
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser(description="List and prune the local simulation result cache")
+    parser.add_argument("command", choices=["list", "prune", "clear"])
+    parser.add_argument("--dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--max-size", type=parse_size, help="Evict least recently used entries down to this size, e.g. 500M")
+    parser.add_argument("--older-than", type=float, help="Evict entries unused for this many days")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.dir)
+    if args.command == "list":
+        for kind, key, size, used in cache.entries():
+            print(f"{kind:8} {key:48} {format_size(size):>10}  {datetime.fromtimestamp(used):%Y-%m-%d %H:%M}")
+        print(f"{len(cache.entries())} entries, {format_size(cache.size())} in {cache.root}")
+    else:
+        if args.command == "clear":
+            removed = cache.clear()
+        else:
+            older_than_s = args.older_than * 86400 if args.older_than is not None else None
+            removed = cache.prune(args.max_size, older_than_s)
+        for kind, key, size, _ in removed:
+            print(f"removed {kind} {key} ({format_size(size)})")
+        print(f"{len(removed)} entries removed, {format_size(cache.size())} left")
@@ -0,0 +1,243 @@
+import asyncio
+import codecs
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+import requests
+from requests.adapters import HTTPAdapter
+from .simulator import DATA_TYPES
+from .instrument import count, span
+
+DEFAULT_URL = "https://testingtyf.tensortech.co"
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TensorTechError(Exception):
+    pass
+
+
+class TensorTechTimeout(TensorTechError):
+    pass
+
+
+class ResultParser:
+    """
+    Incremental parser for the result page, which embeds every series as a quoted JSON string after
+    its name. Text is fed in chunks and all series are extracted in a single pass, keeping only the
+    unparsed tail in memory.
+    """
+    pattern = re.compile(r"(%s)[^']*'([^']*)'" % "|".join(DATA_TYPES))
+    name_pattern = re.compile("|".join(DATA_TYPES))
+
+    def __init__(self):
+        self.series = {}
+        self.buffer = ""
+        self.keep = max(len(name) for name in DATA_TYPES) - 1
+
+    def feed(self, text):
+        self.buffer += text
+        pos = 0
+        while (match := self.pattern.search(self.buffer, pos)) is not None:
+            # Only the first occurrence of a name counts
+            if match[1] not in self.series:
+                self.series[match[1]] = json.loads(match[2])
+            pos = match.end()
+        # Keep an unfinished series, or enough text to complete a name split across chunks
+        start = self.name_pattern.search(self.buffer, pos)
+        self.buffer = self.buffer[start.start():] if start else self.buffer[max(pos, len(self.buffer) - self.keep):]
+
+    def missing(self):
+        return [name for name in DATA_TYPES if name not in self.series]
+
+
+class TensorTechClient:
+    """
+    Client for the TensorTech simulation service.
+
+    Requests go through one pooled requests.Session on worker threads, so many simulations can be
+    started and monitored concurrently from one event loop. Connection errors and 429/5xx responses
+    are retried with exponential backoff, other failures raise TensorTechError, and every wait is
+    bounded by a timeout. Cancelling the awaiting task stops monitoring a session.
+    """
+    base_url: str
+    request_timeout_s: float # Per request
+    run_timeout_s: float # Start to result of one simulation
+    retries: int # Per request
+    poll_s: float # Shortest progress poll interval
+    max_poll_s: float # Longest progress poll interval
+
+    def __init__(self, base_url=DEFAULT_URL, request_timeout_s=30, run_timeout_s=3600, retries=3,
+                 retry_backoff_s=0.5, poll_s=0.5, max_poll_s=15, pool_size=16):
+        self.base_url = base_url.rstrip("/")
+        self.request_timeout_s = request_timeout_s
+        self.run_timeout_s = run_timeout_s
+        self.retries = retries
+        self.retry_backoff_s = retry_backoff_s
+        self.poll_s = poll_s
+        self.max_poll_s = max_poll_s
+
+        self.http = requests.Session()
+        # Sessions are identified by an explicit cookie per request, so the shared jar must stay empty
+        self.http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        self.threads = ThreadPoolExecutor(pool_size)
+
+    def close(self):
+        self.threads.shutdown(wait=False)
+        self.http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def _request(self, method, path, session=None, payload=None, stream=False):
+        headers = {"Cookie": f"session={session}"} if session else {"Content-Type": "application/json"}
+        for attempt in range(self.retries + 1):
+            count("client.requests")
+            try:
+                response = self.http.request(method, f"{self.base_url}/{path}", headers=headers, data=payload,
+                                             timeout=self.request_timeout_s, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = TensorTechError(f"{method} /{path} failed: {e}")
+            else:
+                if response.status_code == 200:
+                    return response
+                error = TensorTechError(f"{method} /{path} failed with status code {response.status_code}: {response.text[:200]}")
+                response.close()
+                if response.status_code not in RETRY_STATUS:
+                    raise error
+            if attempt < self.retries:
+                count("client.retries")
+                time.sleep(self.retry_backoff_s * 2**attempt)
+        raise error
+
+    async def _call(self, f, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.threads, lambda: f(*args, **kwargs))
+
+    def _start(self, config_json):
+        response = self._request("POST", "platform-configuration", payload=config_json)
+        match = re.search(r'session=([^;]*)', response.headers.get("set-cookie", ""))
+        if not match:
+            raise TensorTechError("No session cookie in the platform-configuration response")
+        return match.group(1)
+
+    def _progress(self, session):
+        return float(self._request("GET", "updateP", session).json()["now"])
+
+    def _result(self, session, chunk_size=1 << 20):
+        parser = ResultParser()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        with self._request("GET", "result", session, stream=True) as response:
+            for chunk in response.iter_content(chunk_size):
+                parser.feed(decoder.decode(chunk))
+        parser.feed(decoder.decode(b"", final=True))
+        return parser
+
+    async def start(self, config_json):
+        """
+        Submits a SimulatonConfig JSON and returns the session id.
+        """
+        with span("client.start"):
+            return await self._call(self._start, config_json)
+
+    async def progress(self, session):
+        """
+        Progress of a session, in percent.
+        """
+        return await self._call(self._progress, session)
+
+    async def wait(self, session, on_progress=None, timeout_s=None):
+        """
+        Polls until the session reaches 100%. Polling speeds up while progress moves and backs off
+        while it stalls, between poll_s and max_poll_s.
+        """
+        with span("client.wait", session=session):
+            await self._wait(session, on_progress, timeout_s)
+
+    async def _wait(self, session, on_progress, timeout_s):
+        deadline = time.monotonic() + (timeout_s or self.run_timeout_s)
+        delay, last, last_t = self.poll_s, None, time.monotonic()
+        while True:
+            count("client.polls")
+            p = await self.progress(session)
+            now = time.monotonic()
+            if on_progress:
+                on_progress(p)
+            if p >= 100:
+                return
+            if now > deadline:
+                raise TensorTechTimeout(f"Session {session} stuck at {p:.0f}%")
+
+            if last is not None and p > last:
+                # Aim to poll about twice more before the estimated finish
+                eta = (100 - p) * (now - last_t) / (p - last)
+                delay = eta / 2
+                last_t = now
+            elif last is not None:
+                delay *= 1.5
+            if last is None or p > last:
+                last = p
+            await asyncio.sleep(min(max(delay, self.poll_s), self.max_poll_s, max(deadline - now, 0)))
+
+    async def result(self, session, timeout_s=30):
+        """
+        Dict of every series of a finished session. The result page can lag the progress counter, so
+        it is fetched again until every series is present or timeout_s passes.
+        """
+        deadline = time.monotonic() + timeout_s
+        delay = self.poll_s
+        while True:
+            with span("client.result", session=session):
+                parser = await self._call(self._result, session)
+            if not parser.missing():
+                return parser.series
+            if time.monotonic() > deadline:
+                raise TensorTechTimeout(f"Result of session {session} is missing {', '.join(parser.missing())}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_s)
+
+    async def simulate(self, config_json, on_progress=None):
+        """
+        Runs a simulation to completion. Returns the session id and the result series.
+        """
+        session = await self.start(config_json)
+        await self.wait(session, on_progress)
+        return session, await self.result(session)
+
+
+_clients = {}
+
+
+def default_client(base_url=None):
+    """
+    Shared client per service URL (DEFAULT_URL when None), so simulations reuse pooled connections.
+    """
+    base_url = base_url or DEFAULT_URL
+    if base_url not in _clients:
+        _clients[base_url] = TensorTechClient(base_url)
+    return _clients[base_url]
+
+
+def run_sync(coro):
+    """
+    Runs a coroutine to completion from synchronous code, including from inside a running event
+    loop such as a notebook's.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
@@ -1,3 +1,4 @@
 FLATTENING = 1 / 298.257223563
 R = 6378137
-E2 = FLATTENING * (2 - FLATTENING)
\ No newline at end of file
+E2 = FLATTENING * (2 - FLATTENING)
+OMEGA_EARTH = 7.292115146706979e-5 # rad/s
@@ -1,44 +1,33 @@
-from .consts import R, FLATTENING, E2
+from .consts import OMEGA_EARTH
+from .geodetic import ecef2lla_array, lla2ecef, lla2ecef_array
 import numpy as np
-import math
 
 def mrp2quat(m):
     """
     Modified Rodrigues Parameters to Quaternion
     """
-    m = np.reshape(m, -1)
-    magsq = np.dot(m, m)
-    q = np.array([(1 - magsq), 2 * m[0], 2 * m[1], 2 * m[2]]) / (1 + magsq)
-    return q.tolist()
+    return mrp2quat_array(m)[0].tolist()
+
+def mrp2quat_array(m):
+    """
+    (N,3) Modified Rodrigues Parameters to (N,4) scalar-first quaternions. MRPs outside the unit
+    sphere are switched to their shadow set -m/|m|^2 first, so every quaternion has a non-negative
+    scalar part and is the shorter rotation.
+    """
+    m = np.asarray(m, dtype=float).reshape(-1, 3)
+    magsq = np.sum(m * m, axis=1, keepdims=True)
+    shadow = magsq > 1
+    m = np.where(shadow, -m / np.where(shadow, magsq, 1), m)
+    magsq = np.where(shadow, 1 / magsq, magsq)
+    return np.concatenate([1 - magsq, 2 * m], axis=1) / (1 + magsq)
 
 def ecef2lla(x, y, z, warn = True):
     '''
-    Converts ECEF coordinates to latitude, longitude, and altitude.
-    https://www.mathworks.com/help/aeroblks/ecefpositiontolla.html
+    Converts ECEF coordinates (meters) to latitude, longitude (degrees), and altitude (meters).
+    Scalar form of geodetic.ecef2lla_array; bad input is reported through its validation hook
+    unless warn is False.
     '''
-
-    if x < 1e6 and warn:
-        print("WARNING: This function expects ECEF coordinates in meters. You may have passed ECEF coordinates in kilometers.")
-
-    lon = math.atan2(y, x)
-
-    s = math.sqrt(x**2 + y**2)
-    beta = math.atan(z / (1 - FLATTENING) / s)
-
-    lat_old = 0
-    while True:
-        lat = math.atan((z + E2 * R * math.sin(beta)**3) / (s - E2 * R * math.cos(beta)**3))
-        if abs(lat - lat_old) < 1e-12:
-            break
-        lat_old = lat
-        beta = math.atan((1 - FLATTENING) * math.tan(lat))
-    
-    N = R / math.sqrt(1 - E2 * math.sin(lat)**2)
-    alt = s * math.cos(lat) + (z + E2 * N * math.sin(lat)) * math.sin(lat) - N
-
-    lat = math.degrees(lat)
-    lon = math.degrees(lon)
-
+    lat, lon, alt = ecef2lla_array([x, y, z], validate=warn).tolist()
     return lat, lon, alt
 
 def quat2euler(q):
@@ -59,4 +48,34 @@ def quat2euler(q):
     t4 = +1.0 - 2.0 * (ysqr + z * z)
     Z = np.degrees(np.arctan2(t3, t4))
 
-    return X, Y, Z 
\ No newline at end of file
+    return X, Y, Z
+
+def datetime64_to_jd(times):
+    '''
+    Splits datetime64 UTC times into whole and fractional Julian dates, as sgp4_array expects.
+    '''
+    ns = np.asarray(times, dtype="datetime64[ns]").astype(np.int64)
+    days, rem = np.divmod(ns, 86400 * 10**9)
+    return 2440587.5 + days, rem / (86400 * 1e9)
+
+def gmst(jd):
+    '''
+    Greenwich mean sidereal time in radians (IAU-82, as used by SGP4) for UT1 Julian dates.
+    '''
+    t = (np.asarray(jd) - 2451545.0) / 36525
+    theta = -6.2e-6 * t**3 + 0.093104 * t**2 + (876600 * 3600 + 8640184.812866) * t + 67310.54841
+    return np.remainder(np.radians(theta / 240), 2 * np.pi)
+
+def teme2ecef(r, v, jd):
+    '''
+    Rotates (N,3) TEME positions and velocities to ECEF at Julian dates jd (UTC is used for UT1 and
+    polar motion is ignored). Velocities have the Earth rotation removed.
+    '''
+    theta = gmst(jd)
+    c, s = np.cos(theta), np.sin(theta)
+    r, v = np.asarray(r, dtype=float), np.asarray(v, dtype=float)
+    r_ecef = np.column_stack([c * r[:, 0] + s * r[:, 1], -s * r[:, 0] + c * r[:, 1], r[:, 2]])
+    v_ecef = np.column_stack([c * v[:, 0] + s * v[:, 1], -s * v[:, 0] + c * v[:, 1], v[:, 2]])
+    v_ecef += np.cross(r_ecef, [0, 0, OMEGA_EARTH])
+    return r_ecef, v_ecef
+
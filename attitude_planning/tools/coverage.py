@@ -0,0 +1,287 @@
+import numpy as np
+from scipy import ndimage
+from .consts import R as EARTH_RADIUS
+from .calculate import georef_array, make_scanlines
+
+GAP_DTYPE = np.dtype([("lat", "f8"), ("lon", "f8"), ("area_m2", "f8")])
+
+
+def swath_footprints(orbit, attitude, time_ns, width_m, height_m, integration_time_s, samples=None, offset=0):
+    """
+    (M,4,2) lat, long corners of the scanlines of the valid samples, with each scanline's height
+    smeared by integration_time_s at the orbit speed, as plot_scanlines draws them.
+
+    orbit, attitude and time_ns are (N,3), (N,4) and (N,) arrays. Only `samples` samples from
+    position offset (all by default) get footprints. A following sample can be passed for the
+    speed of the last one, and a preceding one (offset=1) for when there is no following one, as
+    at the end of a run. Returns the corners and the (M,) smeared heights.
+    """
+    orbit = np.asarray(orbit, dtype=float)
+    time_ns = np.asarray(time_ns, dtype=np.int64)
+    samples = len(orbit) - offset if samples is None else samples
+    if len(orbit) < 2:
+        raise ValueError("swath_footprints needs at least two samples for the orbit speed")
+    # As in Simulation, the last sample of the run reuses the previous displacement
+    i = np.minimum(np.arange(offset, offset + samples), len(orbit) - 2)
+    speed = np.linalg.norm(orbit[i+1] - orbit[i], axis=1) / ((time_ns[i+1] - time_ns[i]) / 1e9)
+
+    llar, valid = georef_array(orbit[offset:offset + samples], attitude[offset:offset + samples])
+    height = height_m + integration_time_s * speed[valid]
+    return make_scanlines(llar[valid, 0], llar[valid, 1], llar[valid, 3], width_m, height), height
+
+
+class CoverageGrid:
+    """
+    Sparse ground raster counting how many swath footprints cover each cell.
+
+    Cells are cell_m squares on a sinusoidal (equal-area) projection centered on lon0, stored in
+    tile x tile blocks that are only allocated once touched, so memory scales with the area covered
+    rather than the number of scanlines. bounds = (lat_min, lat_max, lon_min, lon_max) restricts the
+    grid to a target area. Footprints crossing the meridian opposite lon0, where the projection is
+    cut, are split there and rasterized on both edges.
+    """
+    cell_m: float
+    tile: int
+    tiles: dict # (tile row, tile col) -> (tile, tile) uint8 counts, saturating at 255
+    footprint_area_m2: float # Sum of the areas of every added footprint, before clipping to bounds
+    footprints: int
+
+    def __init__(self, cell_m=100, bounds=None, lon0=None, tile=64):
+        self.cell_m = cell_m
+        self.bounds = bounds
+        self.lon0 = lon0 if lon0 is not None else (None if bounds is None else (bounds[2] + bounds[3]) / 2)
+        self.tile = tile
+        self.tiles = {}
+        self.footprint_area_m2 = 0.0
+        self.footprints = 0
+
+    def _project(self, lat, dlon):
+        # Cell coordinates of points dlon degrees east of lon0, cell (r, c) spanning [r, r+1) x [c, c+1)
+        phi = np.radians(lat)
+        return EARTH_RADIUS * np.radians(dlon) * np.cos(phi) / self.cell_m, EARTH_RADIUS * phi / self.cell_m
+
+    def cell_centers(self, rows, cols):
+        """
+        lat, long of cell centers.
+        """
+        phi = (np.asarray(rows) + 0.5) * self.cell_m / EARTH_RADIUS
+        dlon = (np.asarray(cols) + 0.5) * self.cell_m / EARTH_RADIUS / np.maximum(np.cos(phi), 1e-12)
+        return np.degrees(phi), (np.degrees(dlon) + self.lon0 + 180) % 360 - 180
+
+    def _runs(self, corners):
+        # Scan-converts convex quads into (row, first col, last col) runs of cells whose centers are inside
+        lat, lon = corners[..., 0], corners[..., 1]
+        # Longitudes east of lon0, unwrapped around each quad's first corner so every quad is contiguous
+        first = (lon[:, :1] - self.lon0 + 180) % 360 - 180
+        dlon = first + (lon - lon[:, :1] + 180) % 360 - 180
+        # Quads reaching past the meridian opposite lon0 are also rasterized from the other side,
+        # and both copies are clipped to it below
+        east, west = dlon.max(axis=1) > 180, dlon.min(axis=1) < -180
+        lat = np.concatenate([lat, lat[east], lat[west]])
+        dlon = np.concatenate([dlon, dlon[east] - 360, dlon[west] + 360])
+        x, y = self._project(lat, dlon)
+
+        r0 = np.ceil(y.min(axis=1) - 0.5).astype(np.int64)
+        r1 = np.floor(y.max(axis=1) - 0.5).astype(np.int64)
+        counts = np.maximum(r1 - r0 + 1, 0)
+        quad = np.repeat(np.arange(len(x)), counts)
+        row = r0[quad] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        yc = row + 0.5
+
+        # x where the row center line crosses each edge
+        px, py = x[quad], y[quad]
+        qx, qy = np.roll(px, -1, axis=1), np.roll(py, -1, axis=1)
+        crosses = (np.minimum(py, qy) <= yc[:, None]) & (yc[:, None] <= np.maximum(py, qy)) & (py != qy)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            xs = px + (yc[:, None] - py) * (qx - px) / (qy - py)
+        x_lo = np.where(crosses, xs, np.inf).min(axis=1)
+        x_hi = np.where(crosses, xs, -np.inf).max(axis=1)
+
+        # Clip to the meridian opposite lon0, excluding it on the east so no cell is counted twice
+        row_lat = np.degrees(yc * self.cell_m / EARTH_RADIUS)
+        scale = EARTH_RADIUS * np.cos(np.radians(row_lat)) / self.cell_m
+        x_lo = np.maximum(x_lo, -np.pi * scale)
+        x_hi = np.minimum(x_hi, np.nextafter(np.pi * scale, 0))
+
+        if self.bounds is not None:
+            lat_min, lat_max, lon_min, lon_max = self.bounds
+            keep = (row_lat >= lat_min) & (row_lat <= lat_max)
+            x_lo = np.maximum(x_lo, np.radians((lon_min - self.lon0 + 180) % 360 - 180) * scale)
+            x_hi = np.minimum(x_hi, np.radians((lon_max - self.lon0 + 180) % 360 - 180) * scale)
+        else:
+            keep = np.ones(len(row), dtype=bool)
+
+        c0 = np.ceil(x_lo - 0.5)
+        c1 = np.floor(x_hi - 0.5)
+        keep &= np.isfinite(c0) & np.isfinite(c1) & (c1 >= c0)
+        return row[keep], c0[keep].astype(np.int64), c1[keep].astype(np.int64)
+
+    def add(self, corners, heights=None, width_m=None):
+        """
+        Adds (N,4,2) lat, long footprint corners (e.g. from swath_footprints or make_scanlines).
+        Pass the footprint heights and width to include them in footprint_area_m2.
+        """
+        corners = np.asarray(corners, dtype=float).reshape(-1, 4, 2)
+        if len(corners) == 0:
+            return
+        if self.lon0 is None:
+            self.lon0 = float(corners[0, 0, 1])
+        self.footprints += len(corners)
+        if heights is not None and width_m is not None:
+            self.footprint_area_m2 += float(np.sum(np.broadcast_to(heights, len(corners)) * width_m))
+
+        if self.bounds is not None:
+            # Only footprints that can reach the target area are rasterized
+            lat_min, lat_max, lon_min, lon_max = self.bounds
+            lat, east = corners[..., 0], (corners[..., 1] - lon_min) % 360
+            inside = (lat.max(axis=1) >= lat_min) & (lat.min(axis=1) <= lat_max)
+            inside &= (east.min(axis=1) <= (lon_max - lon_min) % 360) | (np.ptp(east, axis=1) > 180)
+            corners = corners[inside]
+
+        row, c0, c1 = self._runs(corners)
+        if len(row) == 0:
+            return
+
+        # Split runs at tile boundaries
+        T = self.tile
+        pieces = c1 // T - c0 // T + 1
+        run = np.repeat(np.arange(len(row)), pieces)
+        j = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        tile_col = c0[run] // T + j
+        start = np.maximum(c0[run], tile_col * T) - tile_col * T
+        stop = np.minimum(c1[run], tile_col * T + T - 1) - tile_col * T
+        tile_row, local_row = np.divmod(row[run], T)
+
+        # One difference array per touched tile, accumulated with bincount and summed along rows
+        # Pack (row, col) into one int64 so the unique is a plain sort
+        packed, tile_index = np.unique((tile_row << 32) | (tile_col & 0xFFFFFFFF), return_inverse=True)
+        keys = np.column_stack([packed >> 32, (packed & 0xFFFFFFFF) - ((packed & 0x80000000) << 1)])
+        base = (tile_index * T + local_row) * (T + 1)
+        size = len(keys) * T * (T + 1)
+        diff = np.bincount(base + start, minlength=size) - np.bincount(base + stop + 1, minlength=size)
+        counts = np.cumsum(diff.reshape(len(keys), T, T + 1), axis=2)[:, :, :T]
+
+        for key, count in zip(map(tuple, keys.tolist()), counts):
+            tile = self.tiles.get(key)
+            total = count if tile is None else tile + count
+            self.tiles[key] = np.minimum(total, 255).astype(np.uint8)
+
+    def gaps(self, max_gap_m=500, batch=1024):
+        """
+        Uncovered patches up to max_gap_m across that lie between covered cells (found with a
+        morphological closing), as a GAP_DTYPE array of patch centroids and areas. Patches crossing
+        tile edges are reported once per tile.
+        """
+        T = self.tile
+        k = int(np.ceil(max_gap_m / self.cell_m)) + 1
+        k += 1 - k % 2 # Odd, so the closing is centered
+        h = k - 1 # Halo that the dilation and erosion reach into from neighbouring tiles
+        if h > T:
+            raise ValueError(f"max_gap_m must be at most {T} cells ({T * self.cell_m} m)")
+
+        keys = list(self.tiles)
+        index = {key: i for i, key in enumerate(keys)}
+        # Tiles are labelled separately: connectivity only within each tile
+        structure = np.zeros((3, 3, 3), dtype=bool)
+        structure[1] = ndimage.generate_binary_structure(2, 1)
+
+        res = []
+        for first in range(0, len(keys), batch):
+            batch_keys = keys[first:first + batch]
+            covered = np.stack([self.tiles[key] > 0 for key in batch_keys])
+            block = np.zeros((len(batch_keys), T + 2*h, T + 2*h), dtype=bool)
+            block[:, h:h+T, h:h+T] = covered
+            for dr in (-1, 0, 1):
+                for dc in (-1, 0, 1):
+                    if dr == dc == 0:
+                        continue
+                    neighbours = [index.get((key[0] + dr, key[1] + dc), -1) for key in batch_keys]
+                    has = np.flatnonzero(np.array(neighbours) >= 0)
+                    if len(has) == 0:
+                        continue
+                    src = np.stack([self.tiles[keys[neighbours[i]]] > 0 for i in has])
+                    rows = slice(T - h, T) if dr < 0 else (slice(0, h) if dr > 0 else slice(0, T))
+                    cols = slice(T - h, T) if dc < 0 else (slice(0, h) if dc > 0 else slice(0, T))
+                    out_rows = slice(0, h) if dr < 0 else (slice(h + T, T + 2*h) if dr > 0 else slice(h, h + T))
+                    out_cols = slice(0, h) if dc < 0 else (slice(h + T, T + 2*h) if dc > 0 else slice(h, h + T))
+                    block[has, out_rows, out_cols] = src[:, rows, cols]
+
+            closed = ndimage.minimum_filter(ndimage.maximum_filter(block, size=(1, k, k)), size=(1, k, k))
+            gap = closed[:, h:h+T, h:h+T] & ~covered
+            if not gap.any():
+                continue
+            labels, n = ndimage.label(gap, structure)
+            tile, rows, cols = np.nonzero(labels)
+            label = labels[tile, rows, cols]
+            size = np.bincount(label, minlength=n + 1)[1:]
+            rows = np.bincount(label, rows, minlength=n + 1)[1:] / size
+            cols = np.bincount(label, cols, minlength=n + 1)[1:] / size
+            tile_keys = np.array(batch_keys)[tile[np.unique(label, return_index=True)[1]]]
+            area = size * self.cell_m**2
+            lat, lon = self.cell_centers(rows + tile_keys[:, 0] * T, cols + tile_keys[:, 1] * T)
+            res.append(np.rec.fromarrays([lat, lon, area], dtype=GAP_DTYPE).view(np.ndarray))
+        return np.concatenate(res) if res else np.empty(0, dtype=GAP_DTYPE)
+
+    def report(self, max_gap_m=500):
+        """
+        Coverage summary. overlap_ratio is the rasterized footprint area over the covered area (1 when
+        footprints never overlap); multiple_coverage_fraction is the covered fraction seen more than once.
+        """
+        cell_area = self.cell_m**2
+        covered = sum(int(np.count_nonzero(t)) for t in self.tiles.values())
+        multiple = sum(int(np.count_nonzero(t > 1)) for t in self.tiles.values())
+        hits = sum(int(t.sum(dtype=np.int64)) for t in self.tiles.values())
+        gaps = self.gaps(max_gap_m)
+        return {
+            "footprints": self.footprints,
+            "covered_area_m2": covered * cell_area,
+            "footprint_area_m2": self.footprint_area_m2,
+            "overlap_ratio": hits / covered if covered else None,
+            "multiple_coverage_fraction": multiple / covered if covered else None,
+            "gap_area_m2": float(gaps["area_m2"].sum()),
+            "gap_fraction": float(gaps["area_m2"].sum()) / (covered * cell_area + gaps["area_m2"].sum()) if covered else None,
+            "gaps": gaps,
+            "tiles": len(self.tiles),
+        }
+
+
+def swath_coverage(simulation, cell_m=100, bounds=None, chunk_size=2048, grid=None):
+    """
+    Streams the interpolated samples of a Simulation into a CoverageGrid chunk_size samples at a
+    time, so working memory is bounded by the chunk and the covered area. Returns the grid.
+    """
+    grid = grid or CoverageGrid(cell_m, bounds)
+    n = len(simulation.time_ns)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        # Include the samples either side for the speed of the last one
+        first, end = max(start - 1, 0), min(stop + 1, n)
+        corners, heights = swath_footprints(
+            simulation.orbit[first:end], simulation.attitude[first:end], simulation.time_ns[first:end],
+            simulation.scanline_width_m, simulation.scanline_height_m, simulation.integration_time_s, stop - start,
+            start - first)
+        grid.add(corners, heights, simulation.scanline_width_m)
+    return grid
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import resource
+    from .simulator import TensorTechSimulation
+    from ..classes.simulation import Simulation
+
+    filename = sys.argv[1] if len(sys.argv) > 1 else "analysis/json/nadir_june_2024.json"
+    simulation = Simulation.from_tensor_tech_sim(TensorTechSimulation.from_file(filename))
+    simulation.derive_data(cache=False)
+
+    for cell_m, bounds in ((100, None), (10, (-10, -5, 0, 5))):
+        start = time.perf_counter()
+        grid = swath_coverage(simulation, cell_m, bounds)
+        report = grid.report(max_gap_m=5 * cell_m)
+        elapsed = time.perf_counter() - start
+        print(f"{len(simulation.time_ns)} samples, {cell_m} m cells, bounds {bounds}: {elapsed:.1f} s, {report['tiles']} tiles")
+        print(f"  covered {report['covered_area_m2'] / 1e6:.0f} km2, footprints {report['footprint_area_m2'] / 1e6:.0f} km2, "
+              f"overlap ratio {report['overlap_ratio']:.3f}, multiply covered {report['multiple_coverage_fraction']:.1%}")
+        print(f"  {len(report['gaps'])} gaps, {report['gap_area_m2'] / 1e6:.2f} km2 ({report['gap_fraction']:.2%})")
+    print(f"Peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
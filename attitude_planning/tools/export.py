@@ -0,0 +1,412 @@
+import datetime
+import numpy as np
+
+# Decimal places written per column
+TIME_DECIMALS = 9 # Exact for int64 nanosecond times
+QUATERNION_DECIMALS = 10
+POSITION_DECIMALS = 6
+VELOCITY_DECIMALS = 9
+
+# "0000" to "9999" as 4-byte words
+DIGITS = np.array([list(b"%04d" % i) for i in range(10000)], dtype=np.uint8).view(np.uint32)[:, 0]
+
+# Width of header fields that are only known once a streamed file is complete
+COUNT_WIDTH = 12
+
+
+def fixed_point(values, decimals):
+    """
+    Formats (N,) values as right-aligned fixed-point text like "%.{decimals}f", returned as an (N,
+    width) uint8 array of ASCII so whole columns are formatted with array operations. Integer
+    values are taken to be already scaled by 10**decimals, so int64 nanoseconds format exactly.
+    """
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer):
+        scaled = np.abs(values).astype(np.int64)
+    else:
+        if not np.all(np.isfinite(values)):
+            raise ValueError("Cannot export non-finite values")
+        scaled = np.round(np.abs(values) * 10**decimals).astype(np.int64)
+    negative = (values < 0) & (scaled > 0)
+
+    whole = scaled // 10**decimals
+    int_digits = len(str(int(whole.max()))) if len(values) else 1
+    width = 1 + int_digits + (decimals + 1 if decimals else 0)
+    out = np.empty((len(values), width), dtype=np.uint8)
+
+    # Digits four at a time from a lookup table of 4-byte words
+    limbs = -(-(int_digits + decimals) // 4)
+    words = np.empty((len(values), limbs), dtype=np.uint32)
+    for i in range(limbs - 1, -1, -1):
+        scaled, limb = np.divmod(scaled, 10000)
+        words[:, i] = DIGITS[limb]
+    digits = words.view(np.uint8)[:, 4 * limbs - int_digits - decimals:]
+
+    # Blank the leading zeros of the whole part, keeping the units digit, and put the sign before the first digit
+    lead = np.zeros(len(values), dtype=int)
+    for k in range(1, int_digits):
+        lead += whole < 10**(int_digits - k)
+    out[:, 0] = ord(" ")
+    out[:, 1:1 + int_digits] = digits[:, :int_digits]
+    if int_digits > 1:
+        out[:, 1:int_digits] = np.where(np.arange(int_digits - 1) < lead[:, None], ord(" "), out[:, 1:int_digits])
+    if decimals:
+        out[:, 1 + int_digits] = ord(".")
+        out[:, 2 + int_digits:] = digits[:, int_digits:]
+    out[np.flatnonzero(negative), lead[negative]] = ord("-")
+    return out
+
+
+def format_rows(columns):
+    """
+    Joins (N, width) ASCII columns with spaces into newline-terminated rows, as bytes.
+    """
+    n = len(columns[0])
+    parts = []
+    for column in columns:
+        parts += [column, np.full((n, 1), ord(" "), dtype=np.uint8)]
+    parts[-1] = np.full((n, 1), ord("\n"), dtype=np.uint8)
+    return np.hstack(parts).tobytes()
+
+
+def to_scalar_last(q, scalar_first=True):
+    q = np.asarray(q, dtype=float).reshape(-1, 4)
+    return np.roll(q, -1, axis=1) if scalar_first else q
+
+
+def stk_epoch(time_ns):
+    return np.datetime64(int(time_ns), "ns").astype("datetime64[us]").item().strftime("%d %b %Y %H:%M:%S.%f")
+
+
+def parse_stk_epoch(text):
+    return np.datetime64(datetime.datetime.strptime(text.strip(), "%d %b %Y %H:%M:%S.%f"), "ns").astype(np.int64)
+
+
+def iso_times(time_ns):
+    """
+    (N,) int64 nanosecond times as ISO 8601 UTC text with nanoseconds, an (N, 29) uint8 array.
+    Dates are formatted once per day and times of day from the digit table.
+    """
+    time_ns = np.asarray(time_ns, dtype=np.int64)
+    day, ns = np.divmod(time_ns, 86400 * 10**9)
+    days, inverse = np.unique(day, return_inverse=True)
+    dates = np.datetime_as_string(days.astype("datetime64[D]")).astype("S10").view(np.uint8).reshape(-1, 10)
+
+    seconds, fraction = np.divmod(ns, 10**9)
+    hours, seconds = np.divmod(seconds, 3600)
+    minutes, seconds = np.divmod(seconds, 60)
+    out = np.empty((len(time_ns), 29), dtype=np.uint8)
+    out[:, :10] = dates[inverse.reshape(-1)]
+    out[:, 10:20] = np.frombuffer(b"T00:00:00.", dtype=np.uint8)
+    for col, value in ((11, hours), (14, minutes), (17, seconds)):
+        out[:, col:col + 2] = DIGITS[value].view(np.uint8).reshape(-1, 4)[:, 2:]
+    high, low = np.divmod(fraction, 10**8)
+    out[:, 20] = ord("0") + high
+    for i, shift in enumerate((10**4, 1)):
+        out[:, 21 + 4 * i:25 + 4 * i] = DIGITS[low // shift % 10000].view(np.uint8).reshape(-1, 4)
+    return out
+
+
+class StkWriter:
+    """
+    Base for streamed STK and CCSDS writers. Rows are written in chunks with write(), or from a
+    Simulation.stream with add() (see tools/stream.py), and the header's point count and stop time
+    are filled in by close().
+    """
+    epoch_resolution_ns = 1000 # ScenarioEpoch has microseconds
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "wb")
+        self.count = 0
+        self.epoch_ns = None
+        self.last_ns = None
+        self._patches = {}
+
+    def _placeholder(self, name, width=COUNT_WIDTH):
+        # Reserve space for a header value and remember where it goes
+        self._patches[name] = (self.file.tell(), width)
+        self.file.write(b" " * width)
+
+    def _patch(self, name, text):
+        offset, width = self._patches[name]
+        self.file.seek(offset)
+        self.file.write(text.ljust(width).encode())
+        self.file.seek(0, 2)
+
+    def _start(self, time_ns):
+        # The epoch is written at epoch_resolution_ns, so offsets are measured from it as written
+        self.epoch_ns = int(time_ns[0]) // self.epoch_resolution_ns * self.epoch_resolution_ns
+        self.write_header()
+
+    def _rows(self, time_ns, *columns):
+        time_ns = np.asarray(time_ns, dtype=np.int64)
+        if len(time_ns) == 0:
+            return
+        if self.epoch_ns is None:
+            self._start(time_ns)
+        self.file.write(format_rows([self.format_time(time_ns), *columns]))
+        self.count += len(time_ns)
+        self.last_ns = int(time_ns[-1])
+
+    def format_time(self, time_ns):
+        return fixed_point(time_ns - self.epoch_ns, TIME_DECIMALS)
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.epoch_ns is None:
+            raise ValueError(f"No points were written to {self.filename}")
+        self.file.write(self.footer.encode())
+        self.finish_header()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+class StkAttitudeWriter(StkWriter):
+    """
+    STK attitude (.a) file of time offsets and quaternions. STK quaternions are scalar-last; input
+    quaternions are scalar-first (as everywhere in this package) unless scalar_first is False.
+    """
+    footer = "END Attitude\n"
+
+    def __init__(self, filename, coordinate_axes="ICRF", blocking_factor=20, scalar_first=True):
+        super().__init__(filename)
+        self.coordinate_axes = coordinate_axes
+        self.blocking_factor = blocking_factor
+        self.scalar_first = scalar_first
+
+    def write_header(self):
+        self.file.write(b"stk.v.12.0\n# WrittenBy    Custom_Simulation\n\nBEGIN Attitude\n\n    NumberOfAttitudePoints\t ")
+        self._placeholder("count")
+        self.file.write((
+            f"\n    BlockingFactor\t {self.blocking_factor}\n"
+            f"    CentralBody\t Earth\n"
+            f"    ScenarioEpoch\t {stk_epoch(self.epoch_ns)}\n"
+            f"    CoordinateAxes\t {self.coordinate_axes}\n\n"
+            f"AttitudeTimeQuaternions\t\n"
+        ).encode())
+
+    def finish_header(self):
+        self._patch("count", str(self.count))
+
+    def write(self, time_ns, attitude):
+        q = to_scalar_last(attitude, self.scalar_first)
+        self._rows(time_ns, *(fixed_point(q[:, i], QUATERNION_DECIMALS) for i in range(4)))
+
+    def add(self, chunk):
+        self.write(chunk.time_ns, chunk.attitude)
+
+
+class StkEphemerisWriter(StkWriter):
+    """
+    STK ephemeris (.e) file of time offsets, positions (m) and, if given, velocities (m/s) in the
+    Earth fixed frame, which is how orbits are stored here.
+    """
+    footer = "END Ephemeris\n"
+
+    def __init__(self, filename, velocity=True, coordinate_system="Fixed", interpolation_order=5):
+        super().__init__(filename)
+        self.velocity = velocity
+        self.coordinate_system = coordinate_system
+        self.interpolation_order = interpolation_order
+
+    def write_header(self):
+        self.file.write(b"stk.v.12.0\n# WrittenBy    Custom_Simulation\n\nBEGIN Ephemeris\n\n    NumberOfEphemerisPoints\t ")
+        self._placeholder("count")
+        self.file.write((
+            f"\n    ScenarioEpoch\t {stk_epoch(self.epoch_ns)}\n"
+            f"    InterpolationMethod\t Lagrange\n"
+            f"    InterpolationOrder\t {self.interpolation_order}\n"
+            f"    CentralBody\t Earth\n"
+            f"    CoordinateSystem\t {self.coordinate_system}\n\n"
+            f"{'EphemerisTimePosVel' if self.velocity else 'EphemerisTimePos'}\t\n"
+        ).encode())
+
+    def finish_header(self):
+        self._patch("count", str(self.count))
+
+    def write(self, time_ns, orbit, velocity=None):
+        orbit = np.asarray(orbit, dtype=float).reshape(-1, 3)
+        columns = [fixed_point(orbit[:, i], POSITION_DECIMALS) for i in range(3)]
+        if self.velocity:
+            if velocity is None:
+                raise ValueError("EphemerisTimePosVel needs velocities; pass velocity=False for positions only")
+            velocity = np.asarray(velocity, dtype=float).reshape(-1, 3)
+            columns += [fixed_point(velocity[:, i], VELOCITY_DECIMALS) for i in range(3)]
+        self._rows(time_ns, *columns)
+
+    def add(self, chunk):
+        velocity = chunk.orbit_velocity_mps
+        if velocity is None and self.velocity:
+            # Linearly interpolated orbits have no velocities, so use the displacement to the next sample
+            velocity = chunk.orbit_velocities / chunk.step_s[:, None]
+        self.write(chunk.time_ns, chunk.orbit, velocity)
+
+
+class AemWriter(StkWriter):
+    """
+    CCSDS Attitude Ephemeris Message (KVN) with UTC epochs. quaternion_type sets the order written
+    to the file ("FIRST" or "LAST" for the scalar); input quaternions are scalar-first unless
+    scalar_first is False.
+    """
+    footer = "DATA_STOP\n"
+    epoch_resolution_ns = 1 # START_TIME has nanoseconds
+
+    def __init__(self, filename, object_name="SATELLITE", object_id="UNKNOWN", ref_frame_a="ITRF",
+                 ref_frame_b="SC_BODY_1", quaternion_type="LAST", scalar_first=True, originator="UTAT-SS"):
+        super().__init__(filename)
+        if quaternion_type not in ("FIRST", "LAST"):
+            raise ValueError(f"quaternion_type must be FIRST or LAST, not {quaternion_type}")
+        self.meta = {
+            "OBJECT_NAME": object_name, "OBJECT_ID": object_id, "CENTER_NAME": "EARTH",
+            "REF_FRAME_A": ref_frame_a, "REF_FRAME_B": ref_frame_b, "ATTITUDE_DIR": "A2B", "TIME_SYSTEM": "UTC",
+        }
+        self.quaternion_type = quaternion_type
+        self.scalar_first = scalar_first
+        self.originator = originator
+
+    def write_header(self):
+        created = np.datetime_as_string(np.datetime64(datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None), "s"))
+        lines = [
+            "CCSDS_AEM_VERS = 1.0", f"CREATION_DATE = {created}", f"ORIGINATOR = {self.originator}", "",
+            "META_START", *(f"{k} = {v}" for k, v in self.meta.items()),
+            f"START_TIME = {iso_times([self.epoch_ns]).tobytes().decode()}",
+        ]
+        self.file.write(("\n".join(lines) + "\nSTOP_TIME = ").encode())
+        self._placeholder("stop", 29)
+        self.file.write((
+            f"\nATTITUDE_TYPE = QUATERNION\nQUATERNION_TYPE = {self.quaternion_type}\nMETA_STOP\n\nDATA_START\n"
+        ).encode())
+
+    def finish_header(self):
+        self._patch("stop", iso_times([self.last_ns]).tobytes().decode())
+
+    def format_time(self, time_ns):
+        return iso_times(time_ns)
+
+    def write(self, time_ns, attitude):
+        q = to_scalar_last(attitude, self.scalar_first)
+        if self.quaternion_type == "FIRST":
+            q = np.roll(q, 1, axis=1)
+        self._rows(time_ns, *(fixed_point(q[:, i], QUATERNION_DECIMALS) for i in range(4)))
+
+    def add(self, chunk):
+        self.write(chunk.time_ns, chunk.attitude)
+
+
+def write_stk_attitude(filename, time_ns, attitude, **kwargs):
+    with StkAttitudeWriter(filename, **kwargs) as writer:
+        writer.write(time_ns, attitude)
+
+
+def write_stk_ephemeris(filename, time_ns, orbit, velocity=None, **kwargs):
+    with StkEphemerisWriter(filename, velocity=velocity is not None, **kwargs) as writer:
+        writer.write(time_ns, orbit, velocity)
+
+
+def write_aem(filename, time_ns, attitude, **kwargs):
+    with AemWriter(filename, **kwargs) as writer:
+        writer.write(time_ns, attitude)
+
+
+def _read_stk(filename, data_keywords):
+    # Header keywords up to the data keyword, then the numeric block up to the END line
+    header = {}
+    with open(filename) as f:
+        for line in f:
+            words = line.split(None, 1)
+            if not words or words[0].startswith("#"):
+                continue
+            if words[0] in data_keywords:
+                header["format"] = words[0]
+                break
+            header[words[0]] = words[1].strip() if len(words) > 1 else ""
+        data = np.loadtxt(f, comments=["END", "#"], ndmin=2)
+    return header, data
+
+
+def read_stk_attitude(filename):
+    """
+    Reads an STK attitude file. Returns int64 nanosecond times, (N,4) scalar-first quaternions and
+    the header keywords.
+    """
+    header, data = _read_stk(filename, ("AttitudeTimeQuaternions",))
+    time_ns = parse_stk_epoch(header["ScenarioEpoch"]) + np.round(data[:, 0] * 1e9).astype(np.int64)
+    return time_ns, np.roll(data[:, 1:5], 1, axis=1), header
+
+
+def read_stk_ephemeris(filename):
+    """
+    Reads an STK ephemeris file. Returns int64 nanosecond times, (N,3) positions, (N,3) velocities
+    (None for EphemerisTimePos) and the header keywords.
+    """
+    header, data = _read_stk(filename, ("EphemerisTimePosVel", "EphemerisTimePos"))
+    time_ns = parse_stk_epoch(header["ScenarioEpoch"]) + np.round(data[:, 0] * 1e9).astype(np.int64)
+    return time_ns, data[:, 1:4], data[:, 4:7] if data.shape[1] >= 7 else None, header
+
+
+def read_aem(filename):
+    """
+    Reads a single-segment CCSDS AEM with quaternions. Returns int64 nanosecond times, (N,4)
+    scalar-first quaternions and the header keywords.
+    """
+    header = {}
+    with open(filename) as f:
+        for line in f:
+            if line.strip() == "DATA_START":
+                break
+            if "=" in line:
+                key, value = line.split("=", 1)
+                header[key.strip()] = value.strip()
+        rows = [line.split() for line in f if line.strip() and not line.startswith(("DATA_STOP", "COMMENT"))]
+    rows = np.array(rows) if rows else np.zeros((0, 5), dtype=str)
+    time_ns = rows[:, 0].astype("datetime64[ns]").astype(np.int64)
+    q = rows[:, 1:5].astype(float)
+    return time_ns, q if header.get("QUATERNION_TYPE") == "FIRST" else np.roll(q, 1, axis=1), header
+
+
+if __name__ == "__main__":
+    import os
+    import time
+    import tempfile
+
+    # A million points at 60 Hz with random attitudes, starting off a microsecond boundary
+    rng = np.random.default_rng(0)
+    n = 1_000_000
+    time_ns = np.datetime64("2024-06-01T00:00:00.016666667", "ns").astype(np.int64) + np.round(np.arange(n) * 1e9 / 60).astype(np.int64)
+    q = rng.normal(size=(n, 4))
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    orbit = rng.normal(size=(n, 3)) * 7e6
+    velocity = rng.normal(size=(n, 3)) * 7e3
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, write, read, args in (
+            ("test.a", write_stk_attitude, read_stk_attitude, (q,)),
+            ("test.e", write_stk_ephemeris, read_stk_ephemeris, (orbit, velocity)),
+            ("test.aem", write_aem, read_aem, (q,)),
+        ):
+            filename = os.path.join(tmp, name)
+            start = time.perf_counter()
+            write(filename, time_ns, *args)
+            elapsed = time.perf_counter() - start
+            res = read(filename)
+            errors = [np.abs(a - b).max() for a, b in zip(res[1:], args)]
+            print(f"{name}: {n} points in {elapsed:.2f} s ({os.path.getsize(filename) / 1e6:.0f} MB), "
+                  f"max time error {np.abs(res[0] - time_ns).max()} ns, max value error {max(errors):.1e}")
+
+        # The previous exporter's row loop, for comparison
+        start = time.perf_counter()
+        with open(os.path.join(tmp, "loop.a"), "w") as f:
+            for i, quat in enumerate(q):
+                q1, q2, q3, qs = quat
+                f.write(f" {i/60}\t{q1}\t{q2}\t{q3}\t{qs}\n")
+        print(f"Row loop: {time.perf_counter() - start:.2f} s")
@@ -0,0 +1,219 @@
+"""
+Local stand-in for the TensorTech service, for exercising tools/client.py without the network.
+
+FakeTensorTech serves the three endpoints the client uses from a saved run: platform-configuration
+starts a session, updateP reports progress rising linearly over run_s seconds, and result returns
+a page embedding every series the way the service does. Failures are injected per endpoint as a
+queue of status codes to answer with before succeeding, and progress can stall, responses can be
+slowed down and the result page can lag the progress counter.
+
+Run as a module to check the client against it:
+
+    python -m attitude_planning.tools.fake_server [run.json]
+"""
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .simulator import DATA_TYPES
+
+
+def result_page(series):
+    """
+    Result page embedding each series as a quoted JSON string after its name, as the service does.
+    """
+    scripts = "".join(f"    var {name} = JSON.parse('{json.dumps(series[name])}');\n" for name in series)
+    return f"<html><head><script>\n{scripts}</script></head><body></body></html>"
+
+
+class FakeTensorTech:
+    """
+    Threaded HTTP server on a free localhost port, serving a saved run's series to every session.
+    Use as a context manager; url is the client's base_url.
+    """
+    def __init__(self, series, run_s=0.2, failures=None, stall_at=None, delay_s=0, result_lag=0):
+        self.series = series
+        self.run_s = run_s
+        self.failures = {path: list(codes) for path, codes in (failures or {}).items()}
+        self.stall_at = stall_at # Progress (percent) sessions stop at
+        self.delay_s = delay_s # Before every response
+        self.result_lag = result_lag # Result fetches per session missing the last series
+        self.sessions = {} # Session id -> start time
+        self.result_fetches = {}
+        self.requests = {} # Path -> requests received
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def progress(self, session):
+        p = min(100 * (time.monotonic() - self.sessions[session]) / self.run_s, 100) if self.run_s else 100
+        return p if self.stall_at is None else min(p, self.stall_at)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b"", headers=()):
+                try:
+                    self.send_response(status)
+                    for header in headers:
+                        self.send_header(*header)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass # The client timed out and hung up
+
+            def _session(self):
+                cookie = self.headers.get("Cookie", "")
+                return cookie.split("session=", 1)[1].split(";")[0] if "session=" in cookie else None
+
+            def _handle(self, method):
+                path = self.path.strip("/")
+                if method == "POST":
+                    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with fake._lock:
+                    fake.requests[path] = fake.requests.get(path, 0) + 1
+                    codes = fake.failures.get(path)
+                    status = codes.pop(0) if codes else None
+                time.sleep(fake.delay_s)
+                if status is not None:
+                    return self._send(status, b"injected failure")
+
+                if method == "POST" and path == "platform-configuration":
+                    session = uuid.uuid4().hex
+                    with fake._lock:
+                        fake.sessions[session] = time.monotonic()
+                    return self._send(200, b"{}", [("Set-Cookie", f"session={session}; Path=/")])
+
+                session = self._session()
+                if method != "GET" or session not in fake.sessions:
+                    return self._send(404, b"unknown session or path")
+                if path == "updateP":
+                    return self._send(200, json.dumps({"now": fake.progress(session)}).encode())
+                if path == "result":
+                    with fake._lock:
+                        fetch = fake.result_fetches[session] = fake.result_fetches.get(session, 0) + 1
+                    names = list(fake.series)
+                    if fetch <= fake.result_lag:
+                        names = names[:-1]
+                    return self._send(200, result_page({n: fake.series[n] for n in names}).encode())
+                return self._send(404, b"unknown path")
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import asyncio
+    import sys
+    from .client import ResultParser, TensorTechClient, TensorTechError, TensorTechTimeout
+
+    with open(sys.argv[1] if len(sys.argv) > 1 else "analysis/json/nadir_june_2024.json") as f:
+        data = json.load(f)
+    series = {name: data[name] for name in DATA_TYPES}
+    config = json.dumps(data["config"])
+
+    # The parser extracts every series in one pass, whatever the chunk boundaries
+    page = result_page(series)
+    for size in (1, 7, 13, 4096, len(page)):
+        parser = ResultParser()
+        for i in range(0, len(page), size):
+            parser.feed(page[i:i + size])
+        assert parser.series == series and not parser.missing(), f"parser failed with {size} character chunks"
+    print("ResultParser: every series extracted with 1 to", len(page), "character chunks")
+
+    def client(server, **kwargs):
+        return TensorTechClient(server.url, **{"poll_s": 0.02, "max_poll_s": 0.1, "retry_backoff_s": 0.01, **kwargs})
+
+    async def concurrent(n=20):
+        with FakeTensorTech(series, run_s=0.3) as server, client(server) as c:
+            start = time.perf_counter()
+            results = await asyncio.gather(*[c.simulate(config) for _ in range(n)])
+            elapsed = time.perf_counter() - start
+            assert len({session for session, _ in results}) == n
+            assert all(result == series for _, result in results)
+            print(f"{n} concurrent sessions finished in {elapsed:.2f} s with identical series")
+
+    async def retries():
+        with FakeTensorTech(series, failures={"platform-configuration": [503, 503]}) as server, client(server) as c:
+            await c.simulate(config)
+            assert server.requests["platform-configuration"] == 3
+        with FakeTensorTech(series, failures={"platform-configuration": [503] * 10}) as server, client(server, retries=2) as c:
+            try:
+                await c.start(config)
+                raise AssertionError("persistent 503 did not raise")
+            except TensorTechError:
+                assert server.requests["platform-configuration"] == 3
+        with FakeTensorTech(series, failures={"platform-configuration": [400]}) as server, client(server) as c:
+            try:
+                await c.start(config)
+                raise AssertionError("400 did not raise")
+            except TensorTechError:
+                assert server.requests["platform-configuration"] == 1, "400 was retried"
+        print("Retries: two 503s recovered, persistent 503 raised after 3 attempts, 400 raised without retrying")
+
+    async def timeouts():
+        with FakeTensorTech(series, stall_at=50) as server, client(server) as c:
+            session = await c.start(config)
+            start = time.monotonic()
+            try:
+                await c.wait(session, timeout_s=0.3)
+                raise AssertionError("stalled session did not time out")
+            except TensorTechTimeout:
+                assert time.monotonic() - start < 1
+        with FakeTensorTech(series, delay_s=0.3) as server, client(server, request_timeout_s=0.05, retries=1) as c:
+            try:
+                await c.start(config)
+                raise AssertionError("slow response did not time out")
+            except TensorTechError:
+                assert server.requests["platform-configuration"] == 2
+        print("Timeouts: a stalled session and a slow response both raised within their bounds")
+
+    async def cancellation():
+        with FakeTensorTech(series, run_s=60) as server, client(server) as c:
+            session = await c.start(config)
+            task = asyncio.create_task(c.wait(session))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            try:
+                await task
+                raise AssertionError("cancelled wait finished")
+            except asyncio.CancelledError:
+                pass
+            polls = server.requests["updateP"]
+            await asyncio.sleep(0.3)
+            assert server.requests["updateP"] <= polls + 1, "polling continued after cancellation"
+        print(f"Cancellation: polling stopped after {polls} polls")
+
+    async def result_lag():
+        with FakeTensorTech(series, run_s=0, result_lag=2) as server, client(server) as c:
+            session, result = await c.simulate(config)
+            assert result == series and server.result_fetches[session] == 3
+        print("Result lag: incomplete result pages were refetched until every series was present")
+
+    for check in (concurrent, retries, timeouts, cancellation, result_lag):
+        asyncio.run(check())
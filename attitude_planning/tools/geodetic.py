@@ -0,0 +1,140 @@
+import warnings
+import numpy as np
+from .consts import R, FLATTENING, E2
+from .instrument import count
+
+B = R * (1 - FLATTENING) # Semi-minor axis, m
+EP2 = E2 / (1 - E2) # Second eccentricity squared
+MIN_RADIUS = 1e6 # m. Smaller ECEF radii are almost certainly kilometers
+
+
+class GeodeticWarning(UserWarning):
+    pass
+
+
+def warn_invalid(message, mask):
+    warnings.warn(f"{message} ({np.count_nonzero(mask)} of {mask.size} points)", GeodeticWarning, stacklevel=4)
+
+
+# Called as validation_hook(message, mask) for each problem found in ecef2lla_array input, where mask
+# flags the offending rows. Replace with set_validation_hook, e.g. to raise or to log
+validation_hook = warn_invalid
+
+
+def set_validation_hook(hook):
+    """
+    Sets the function that reports bad ecef2lla_array input. None silences reports.
+    """
+    global validation_hook
+    validation_hook = hook
+
+
+def validate_ecef(ecef):
+    if validation_hook is None:
+        return
+    finite = np.all(np.isfinite(ecef), axis=-1)
+    if not finite.all():
+        validation_hook("Non-finite ECEF coordinates", ~finite)
+    small = finite & (np.linalg.norm(np.where(finite[..., None], ecef, 0), axis=-1) < MIN_RADIUS)
+    if small.any():
+        validation_hook("ECEF coordinates within 1000 km of the Earth's center; expected meters, not kilometers", small)
+
+
+def ecef2lla_array(ecef, iterations=2, validate=True):
+    """
+    Converts (..., 3) ECEF meters to (..., 3) geodetic latitude and longitude (degrees) and altitude
+    (meters) on WGS-84, with a fixed number of Bowring iterations.
+
+    Two iterations agree with lla2ecef round trips to 1e-8 m in position and altitude from the
+    surface to 2000 km, including the poles. One iteration is good to 2 cm over the same range.
+    """
+    ecef = np.asarray(ecef, dtype=float)
+    if validate:
+        validate_ecef(ecef)
+    x, y, z = ecef[..., 0], ecef[..., 1], ecef[..., 2]
+    p = np.hypot(x, y)
+    count("ecef2lla.points", p.size)
+    count("ecef2lla.iterations", p.size * iterations)
+
+    beta = np.arctan2(z, (1 - FLATTENING) * p)
+    for i in range(iterations):
+        lat = np.arctan2(z + EP2 * B * np.sin(beta)**3, p - E2 * R * np.cos(beta)**3)
+        if i < iterations - 1:
+            beta = np.arctan2((1 - FLATTENING) * np.sin(lat), np.cos(lat))
+
+    sin, cos = np.sin(lat), np.cos(lat)
+    N = R / np.sqrt(1 - E2 * sin**2)
+    alt = p * cos + (z + E2 * N * sin) * sin - N
+    return np.stack([np.degrees(lat), np.degrees(np.arctan2(y, x)), alt], axis=-1)
+
+
+def lla2ecef(lat, lon, alt=0):
+    '''
+    Converts geodetic latitude and longitude (degrees) and altitude (meters) to ECEF meters.
+    Accepts scalars or arrays and returns an (..., 3) array.
+    '''
+    lat, lon = np.radians(lat), np.radians(lon)
+    N = R / np.sqrt(1 - E2 * np.sin(lat)**2)
+    return np.stack([
+        (N + alt) * np.cos(lat) * np.cos(lon),
+        (N + alt) * np.cos(lat) * np.sin(lon),
+        (N * (1 - E2) + alt) * np.sin(lat)
+    ], axis=-1)
+
+
+def lla2ecef_array(lla):
+    """
+    Converts (..., 3) latitude, longitude (degrees) and altitude (meters) to (..., 3) ECEF meters.
+    """
+    lla = np.asarray(lla, dtype=float)
+    return lla2ecef(lla[..., 0], lla[..., 1], lla[..., 2])
+
+
+if __name__ == "__main__":
+    import time
+
+    # Accuracy against exact round trips, uniform over the sphere from 5 km below the surface to 2000 km
+    rng = np.random.default_rng(0)
+    n = 1_000_000
+    lla = np.column_stack([
+        np.degrees(np.arcsin(rng.uniform(-1, 1, n))),
+        rng.uniform(-180, 180, n),
+        rng.uniform(-5e3, 2e6, n),
+    ])
+    lla[:4, 0] = [90, -90, 0, 89.9999999]
+    ecef = lla2ecef_array(lla)
+
+    for iterations in (1, 2, 3):
+        start = time.perf_counter()
+        res = ecef2lla_array(ecef, iterations)
+        elapsed = time.perf_counter() - start
+        position = np.linalg.norm(lla2ecef_array(res) - ecef, axis=1).max()
+        alt = np.abs(res[:, 2] - lla[:, 2]).max()
+        print(f"{iterations} iteration(s): max position error {position:.2e} m, altitude error {alt:.2e} m, "
+              f"{elapsed / n * 1e9:.0f} ns per point")
+
+    # The previous scalar solver, iterated to convergence, with its latitude numerator corrected
+    # from E2 * R to EP2 * B (it was off by up to 41 m at mid latitudes)
+    import math
+
+    def iterative(x, y, z):
+        s = math.hypot(x, y)
+        beta = math.atan(z / (1 - FLATTENING) / s)
+        lat_old = 0
+        while True:
+            lat = math.atan((z + EP2 * B * math.sin(beta)**3) / (s - E2 * R * math.cos(beta)**3))
+            if abs(lat - lat_old) < 1e-12:
+                break
+            lat_old = lat
+            beta = math.atan((1 - FLATTENING) * math.tan(lat))
+        N = R / math.sqrt(1 - E2 * math.sin(lat)**2)
+        alt = s * math.cos(lat) + (z + E2 * N * math.sin(lat)) * math.sin(lat) - N
+        return math.degrees(lat), math.degrees(math.atan2(y, x)), alt
+
+    sample = ecef[4:20004]
+    start = time.perf_counter()
+    ref = np.array([iterative(*p) for p in sample])
+    loop = time.perf_counter() - start
+    diff = np.abs(ref - ecef2lla_array(sample)).max(axis=0)
+    print(f"Iterative loop: {loop / len(sample) * 1e9:.0f} ns per point, max difference "
+          f"{diff[0]:.1e} deg lat, {diff[1]:.1e} deg lon, {diff[2]:.1e} m alt")
@@ -0,0 +1,262 @@
+"""
+Timing spans and counters for the load, derive and visualize pipeline.
+
+Instrumentation is off unless a Recorder is active, and while it is off a span, count or traced
+call costs a global lookup. Turn it on for a block with profile():
+
+    with profile("trace.json") as recorder:
+        simulation.derive_data()
+        plot_quantity(simulation, Quantity.SCANLINE_INTERVAL)
+    print(recorder.table())
+
+or for a whole process by setting ATTITUDE_PLANNING_PROFILE to 1 (print the table at exit) or to a
+.json filename (also save a Chrome trace there, viewable in chrome://tracing or Perfetto).
+"""
+import atexit
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+ENV_VAR = "ATTITUDE_PLANNING_PROFILE"
+
+# Open spans of the current thread or asyncio task, innermost last
+_stack = contextvars.ContextVar("instrument_stack", default=())
+# The active Recorder, or None when instrumentation is off
+_recorder = None
+
+
+class Recorder:
+    """
+    Completed spans and counter totals. Counts are added to the totals and to the innermost open
+    span, so the trace shows where they happened.
+    """
+    def __init__(self):
+        self.origin_ns = time.perf_counter_ns()
+        self.spans = [] # (name, start_ns, duration_ns, thread id, depth, args) in completion order
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        stack = _stack.get()
+        if stack:
+            args = stack[-1].args
+            args[name] = args.get(name, 0) + n
+
+    def add(self, span, duration_ns):
+        with self._lock:
+            self.spans.append((span.name, span.start_ns - self.origin_ns, duration_ns, threading.get_ident(),
+                               span.depth, span.args))
+
+    def stages(self):
+        """
+        Dict of span name -> calls, total and self seconds (total less child spans) and the
+        counters added within it, in order of first completion.
+        """
+        res = {}
+        child_ns = {}
+        # Children complete before their parent, so their time is known when the parent is reached
+        for name, start, duration, thread, depth, args in self.spans:
+            stage = res.setdefault(name, {"calls": 0, "total_s": 0.0, "self_s": 0.0, "counters": {}})
+            children = child_ns.pop((thread, depth + 1), 0)
+            stage["calls"] += 1
+            stage["total_s"] += duration / 1e9
+            stage["self_s"] += (duration - children) / 1e9
+            for k, v in args.items():
+                if isinstance(v, (int, float)):
+                    stage["counters"][k] = stage["counters"].get(k, 0) + v
+            child_ns[(thread, depth)] = child_ns.get((thread, depth), 0) + duration
+        return res
+
+    def table(self):
+        """
+        Per-stage breakdown as a text table, slowest self time first, then the counter totals.
+        """
+        stages = self.stages()
+        wall = sum(s[2] for s in self.spans if s[4] == 0) / 1e9 or 1
+        fields = ["stage", "calls", "total s", "self s", "self %", "counters"]
+        table = [fields] + [[
+            name, str(s["calls"]), f"{s['total_s']:.4f}", f"{s['self_s']:.4f}", f"{100 * s['self_s'] / wall:.1f}",
+            ", ".join(f"{k}={v:g}" for k, v in s["counters"].items()),
+        ] for name, s in sorted(stages.items(), key=lambda item: -item[1]["self_s"])]
+        widths = [max(len(r[i]) for r in table) for i in range(len(fields))]
+        lines = ["  ".join(c.ljust(w) for c, w in zip(r, widths)).rstrip() for r in table]
+        if self.counters:
+            lines += ["", "counters:"] + [f"  {k} = {v:g}" for k, v in self.counters.items()]
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """
+        The spans as Chrome trace events (complete events in microseconds), with their counters as
+        args.
+        """
+        pid = os.getpid()
+        events = [{"name": name, "ph": "X", "ts": start / 1e3, "dur": duration / 1e3, "pid": pid, "tid": thread,
+                   "args": {k: v if isinstance(v, (int, float, str, bool)) else str(v) for k, v in args.items()}}
+                  for name, start, duration, thread, depth, args in self.spans]
+        events.append({"name": "counters", "ph": "C", "ts": (time.perf_counter_ns() - self.origin_ns) / 1e3,
+                       "pid": pid, "args": self.counters})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_trace(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class Span:
+    __slots__ = ("recorder", "name", "args", "start_ns", "depth", "token")
+
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        stack = _stack.get()
+        self.depth = len(stack)
+        self.token = _stack.set(stack + (self,))
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter_ns() - self.start_ns
+        _stack.reset(self.token)
+        self.recorder.add(self, duration)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enabled():
+    return _recorder is not None
+
+
+def span(name, **args):
+    """
+    Context manager timing a block as a named stage. args are recorded with it.
+    """
+    recorder = _recorder
+    if recorder is None:
+        return _NULL_SPAN
+    return Span(recorder, name, args)
+
+
+def count(name, n=1):
+    """
+    Adds n to a counter, e.g. samples processed or solver iterations.
+    """
+    recorder = _recorder
+    if recorder is not None:
+        recorder.count(name, n)
+
+
+def traced(name):
+    """
+    Decorator timing every call of a function as a span.
+    """
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            recorder = _recorder
+            if recorder is None:
+                return f(*args, **kwargs)
+            with Span(recorder, name, {}):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class profile:
+    """
+    Records spans and counts within a block into a new Recorder, and saves a Chrome trace to
+    trace (a filename) at the end if given. Usable as a context manager or decorator.
+    """
+    def __init__(self, trace=None):
+        self.trace = trace
+        self.recorder = None
+
+    def __enter__(self):
+        global _recorder
+        self.previous = _recorder
+        self.recorder = _recorder = Recorder()
+        return self.recorder
+
+    def __exit__(self, *exc):
+        global _recorder
+        _recorder = self.previous
+        if self.trace:
+            self.recorder.save_trace(self.trace)
+
+    def __call__(self, f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with profile(self.trace):
+                return f(*args, **kwargs)
+        return wrapper
+
+
+def _profile_process(setting):
+    global _recorder
+    recorder = _recorder = Recorder()
+
+    def report():
+        print(recorder.table(), file=sys.stderr)
+        if setting.endswith(".json"):
+            recorder.save_trace(setting)
+    atexit.register(report)
+
+
+if os.environ.get(ENV_VAR, "") not in ("", "0"):
+    _profile_process(os.environ[ENV_VAR])
+
+
+if __name__ == "__main__":
+    # Run as a script this file is a second copy of the module, so use the one the package imports
+    from attitude_planning.tools.instrument import count, profile, traced
+    from .simulator import TensorTechSimulation
+    from ..classes.simulation import Simulation
+
+    sim = TensorTechSimulation.from_file(sys.argv[1] if len(sys.argv) > 1 else "analysis/json/nadir_june_2024.json")
+
+    # Cost of an instrumented call and count, less the bare call, with instrumentation off and on
+    def bare():
+        pass
+
+    def timed(f, n=100000):
+        start = time.perf_counter()
+        for _ in range(n):
+            f()
+        return (time.perf_counter() - start) / n * 1e9
+
+    def instrumented():
+        noop()
+        count("noop")
+    noop = traced("noop")(bare)
+    base = timed(bare)
+    print(f"Instrumentation off: {timed(instrumented) - base:.0f} ns per traced call and count")
+    with profile():
+        print(f"Instrumentation on: {timed(instrumented) - base:.0f} ns per traced call and count")
+
+    with profile("trace.json") as recorder:
+        simulation = Simulation.from_tensor_tech_sim(sim)
+        simulation.derive_data(cache=False)
+        simulation.get_llar()
+        simulation.get_sun()
+        simulation.get_llar(0, 1000)
+    print(recorder.table())
+    print(f"{len(recorder.spans)} spans saved to trace.json")
@@ -0,0 +1,290 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .consts import R as EARTH_RADIUS
+from .convert import lla2ecef, quat2euler
+from .calculate import apply_quat_array, quat_between, quat_multiply_array, georef_array
+
+PROFILES = ["fixed", "nadir-offset", "tracking"]
+
+PLAN_DTYPE = np.dtype([
+    ("profile", "U12"),
+    # fixed and nadir-offset: along-track, cross-track and boresight yaw angles in degrees.
+    # tracking: yaw offset in degrees, yaw compensation gain, sweep fraction of the ground speed
+    ("params", "f8", (3,)),
+    ("q", "f8", (4,)), # Command at the peak sample
+    ("coverage", "f8"), # Fraction of the target disk imaged
+    ("mean_abs_scanline_rotation_deg", "f8"),
+    ("max_abs_scanline_rotation_deg", "f8"),
+    ("mean_point_interval_m", "f8"),
+    ("max_point_interval_m", "f8"),
+    ("max_off_nadir_deg", "f8"),
+    ("score", "f8"),
+])
+
+# Candidates per kernel call, so the (candidates, segments, target points) arrays stay small
+BATCH_ELEMENTS = 2_000_000
+
+
+def _unit(v):
+    return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+
+def yaw_quaternions(axis, yaw_deg):
+    """
+    Scalar-first quaternions rotating by yaw_deg about unit axes, broadcast together.
+    """
+    half = np.radians(np.asarray(yaw_deg, dtype=float))[..., None] / 2
+    vector = np.sin(half) * axis
+    return np.concatenate([np.broadcast_to(np.cos(half), vector.shape[:-1] + (1,)), vector], axis=-1)
+
+
+def target_points(radius_m, n=61):
+    """
+    (n,2) east, north offsets in meters spread evenly over a disk (a sunflower pattern).
+    """
+    k = np.arange(n) + 0.5
+    r = radius_m * np.sqrt(k / n)
+    theta = k * np.pi * (3 - np.sqrt(5))
+    return np.column_stack([r * np.sin(theta), r * np.cos(theta)])
+
+
+class PassGeometry:
+    """
+    Orbit samples of one imaging pass over a site, with the orbit frame (+z nadir, +x along the
+    velocity, as sun.body_axis_ecef) and the line of sight to the site at each sample. Everything
+    here is plain arrays, so a pass can be sent to worker processes.
+    """
+    def __init__(self, times, orbit, lat, lon, alt=0, peak=None, width_m=20000, line_period_s=1/60, target_radius_m=10000):
+        time_ns = np.asarray(times, dtype="datetime64[ns]").astype(np.int64)
+        self.time_s = (time_ns - time_ns[0]) / 1e9
+        self.orbit = np.asarray(orbit, dtype=float).reshape(-1, 3)
+        self.lat, self.lon = float(lat), float(lon)
+        self.site = lla2ecef(lat, lon, alt)
+        self.width_m = width_m
+        self.line_period_s = line_period_s
+        self.targets = target_points(target_radius_m)
+
+        self.z = _unit(-self.orbit)
+        velocity = np.gradient(self.orbit, self.time_s, axis=0)
+        self.y = _unit(np.cross(self.z, velocity))
+        self.x = np.cross(self.y, self.z)
+        self.los = _unit(self.site - self.orbit)
+        self.peak = int(np.argmax(np.sum(self.los * self.z, axis=1))) if peak is None else int(peak)
+
+    @classmethod
+    def from_window(cls, catalog, window, times, orbit, **kwargs):
+        """
+        The pass of a SiteCatalog window (a WINDOW_DTYPE record) over the orbit it was found on.
+        """
+        lo, hi = window["start_index"], window["stop_index"]
+        site = window["site"]
+        return cls(times[lo:hi], orbit[lo:hi], catalog.lat[site], catalog.lon[site], catalog.alt[site],
+                   window["peak_index"] - lo, **kwargs)
+
+    def __len__(self):
+        return len(self.orbit)
+
+    def los_angles(self, i=None):
+        """
+        Along-track and cross-track angles in degrees of the line of sight at sample i (the peak).
+        """
+        i = self.peak if i is None else i
+        los = self.los[i]
+        return np.degrees([np.arctan2(los @ self.x[i], los @ self.z[i]), np.arctan2(los @ self.y[i], los @ self.z[i])])
+
+    def _direction(self, along_deg, cross_deg, i=slice(None)):
+        # Unit vectors tilted from nadir by along and cross-track angles in the orbit frame
+        along, cross = np.tan(np.radians(along_deg))[..., None, None], np.tan(np.radians(cross_deg))[..., None, None]
+        return _unit(self.z[i] + along * self.x[i] + cross * self.y[i])
+
+    def attitude(self, profile, params):
+        """
+        (C,N,4) commanded attitudes of C candidates of a profile with (C,3) params.
+        """
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        c = len(params)
+        if profile == "fixed":
+            # The nadir-offset command of the peak sample, held for the whole pass
+            p = self.peak
+            d = self._direction(params[:, 0], params[:, 1], slice(p, p + 1))
+            q = quat_multiply_array(yaw_quaternions(d, params[:, 2, None]), quat_between(self.z[p], d))
+            return np.broadcast_to(q, (c, len(self), 4))
+        if profile == "nadir-offset":
+            d = self._direction(params[:, 0], params[:, 1])
+            return quat_multiply_array(yaw_quaternions(d, params[:, 2, None]), quat_between(self.z, d))
+        if profile == "tracking":
+            # A staring pushbroom images one line, so the aim point sweeps through the site along the
+            # ground track at a fraction of the ground speed, slowing the scan. Yaw about the line of
+            # sight then counters the tracking command's own scanline rotation
+            ground_track = self.z * -EARTH_RADIUS
+            aim = self.site + params[:, 2, None, None] * (ground_track - ground_track[self.peak])
+            los = _unit(aim - self.orbit)
+            track = quat_between(self.z, los)
+            rotation = quat2euler(np.moveaxis(track, -1, 0))[2]
+            yaw = params[:, :1] - params[:, 1:2] * rotation
+            return quat_multiply_array(yaw_quaternions(los, yaw), track)
+        raise ValueError(f"Unknown profile {profile!r}, expected one of {PROFILES}")
+
+    def _local_xy(self, lat, lon):
+        # Equirectangular meters east and north of the site
+        return np.stack([
+            EARTH_RADIUS * np.radians((lon - self.lon + 180) % 360 - 180) * np.cos(np.radians(self.lat)),
+            EARTH_RADIUS * np.radians(lat - self.lat),
+        ], axis=-1)
+
+    def evaluate(self, profile, params):
+        """
+        Predicted metrics of C candidates of a profile as a PLAN_DTYPE array (score unset).
+
+        Ground points come from one georef_array call over every candidate and sample. The swath
+        between consecutive samples is the parallelogram swept by the scanline's width axis
+        (bearing rotation + 90) as it moves to the next ground point, so scanlines at an angle to
+        the motion image a narrower swath and scanlines along it image nothing.
+        """
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        q = self.attitude(profile, params)
+        c, n = q.shape[:2]
+        llar, valid = georef_array(np.broadcast_to(self.orbit, (c, n, 3)).reshape(-1, 3), q.reshape(-1, 4))
+        llar, valid = llar.reshape(c, n, 4), valid.reshape(c, n)
+        ground = self._local_xy(llar[..., 0], llar[..., 1])
+        rotation = llar[..., 3]
+
+        step = np.diff(ground, axis=1)
+        seg_valid = valid[:, 1:] & valid[:, :-1]
+        interval = np.linalg.norm(step, axis=-1) / np.diff(self.time_s) * self.line_period_s
+        width = np.radians(rotation[:, :-1] + 90)
+        u = np.stack([np.sin(width), np.cos(width)], axis=-1)
+
+        # Target points p = ground + a * step + b * u are covered when 0 <= a <= 1 and |b| <= width / 2
+        rel = self.targets[None, None] - ground[:, :-1, None]
+        det = step[..., 0] * u[..., 1] - step[..., 1] * u[..., 0]
+        det = np.where(np.abs(det) > 1e-9, det, np.nan)[..., None]
+        a = (rel[..., 0] * u[..., 1, None] - rel[..., 1] * u[..., 0, None]) / det
+        b = (step[..., 0, None] * rel[..., 1] - step[..., 1, None] * rel[..., 0]) / det
+        covered = (a >= 0) & (a <= 1) & (np.abs(b) <= self.width_m / 2) & seg_valid[..., None]
+
+        boresight = np.sum(apply_quat_array(q, self.z) * self.z, axis=-1)
+        res = np.zeros(c, dtype=PLAN_DTYPE)
+        res["profile"] = profile
+        res["params"] = params
+        res["q"] = q[:, self.peak]
+        res["coverage"] = covered.any(axis=1).mean(axis=1)
+        with np.errstate(invalid="ignore"):
+            abs_rotation = np.where(valid, np.abs(rotation), np.nan)
+            interval = np.where(seg_valid, interval, np.nan)
+            res["mean_abs_scanline_rotation_deg"] = _nan_reduce(np.nanmean, abs_rotation)
+            res["max_abs_scanline_rotation_deg"] = _nan_reduce(np.nanmax, abs_rotation)
+            res["mean_point_interval_m"] = _nan_reduce(np.nanmean, interval)
+            res["max_point_interval_m"] = _nan_reduce(np.nanmax, interval)
+        res["max_off_nadir_deg"] = np.degrees(np.arccos(np.clip(boresight.min(axis=1), -1, 1)))
+        return res
+
+    def candidates(self, profile, along_span_deg=10, cross_span_deg=10, steps=15, yaw_steps=19):
+        """
+        (C,3) default parameter grid of a profile. Pointing profiles span the line of sight at the
+        peak, tracking spans boresight yaw offsets, compensation gains and sweep fractions.
+        """
+        if profile == "tracking":
+            grid = np.meshgrid(np.linspace(-90, 90, 2 * yaw_steps - 1), np.linspace(0, 1.5, steps), [0.25, 0.5, 0.75, 1],
+                               indexing="ij")
+            return np.column_stack([g.ravel() for g in grid])
+        along0, cross0 = self.los_angles()
+        grid = np.meshgrid(
+            along0 + np.linspace(-along_span_deg, along_span_deg, steps),
+            cross0 + np.linspace(-cross_span_deg, cross_span_deg, steps),
+            np.linspace(-90, 90, yaw_steps), indexing="ij")
+        return np.column_stack([g.ravel() for g in grid])
+
+
+def _nan_reduce(f, values):
+    # Row-wise reduction that gives NaN for rows with no valid values instead of warning
+    res = np.full(len(values), np.nan)
+    rows = ~np.all(np.isnan(values), axis=1)
+    res[rows] = f(values[rows], axis=1)
+    return res
+
+
+def evaluate_batch(geometry: PassGeometry, profile, params):
+    """
+    Evaluates candidates in slices of about BATCH_ELEMENTS kernel elements. Runs in a worker process.
+    """
+    size = max(BATCH_ELEMENTS // max(len(geometry) * len(geometry.targets), 1), 1)
+    return np.concatenate([geometry.evaluate(profile, params[i:i + size]) for i in range(0, len(params), size)])
+
+
+def score(plans, rotation_weight=0.5):
+    """
+    Coverage less the mean absolute scanline rotation as a fraction of 90 degrees, weighted.
+    Candidates that miss the Earth score -inf.
+    """
+    s = plans["coverage"] - rotation_weight * plans["mean_abs_scanline_rotation_deg"] / 90
+    return np.where(np.isfinite(s), s, -np.inf)
+
+
+def optimize_pass(geometry: PassGeometry, profiles=PROFILES, candidates=None, top=10, rotation_weight=0.5, workers=None):
+    """
+    Evaluates candidate commands of each profile for a pass and returns the top candidates as a
+    PLAN_DTYPE array ranked by score. candidates maps profiles to (C,3) params, defaulting to
+    PassGeometry.candidates. Batches are split across workers processes (every core by default);
+    workers=1 evaluates in this process.
+    """
+    candidates = candidates or {}
+    jobs = []
+    for profile in profiles:
+        params = candidates.get(profile)
+        params = geometry.candidates(profile) if params is None else np.atleast_2d(np.asarray(params, dtype=float))
+        jobs.append((profile, params))
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        results = [evaluate_batch(geometry, profile, params) for profile, params in jobs]
+    else:
+        # About two batches per worker, so uneven profiles still keep every core busy
+        total = sum(len(p) for _, p in jobs)
+        size = max(-(-total // (2 * workers)), 1)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(evaluate_batch, geometry, profile, params[i:i + size])
+                       for profile, params in jobs for i in range(0, len(params), size)]
+            results = [f.result() for f in futures]
+
+    plans = np.concatenate(results) if results else np.zeros(0, dtype=PLAN_DTYPE)
+    plans["score"] = score(plans, rotation_weight)
+    return plans[np.argsort(-plans["score"], kind="stable")[:top]]
+
+
+def plan_attitude(geometry: PassGeometry, plan):
+    """
+    (N,4) commanded attitude of a plan (a PLAN_DTYPE record) at every sample of the pass.
+    """
+    return geometry.attitude(str(plan["profile"]), plan["params"])[0]
+
+
+if __name__ == "__main__":
+    import time
+    from sgp4.api import Satrec
+    from .convert import datetime64_to_jd, teme2ecef
+    from .simulator import SimulatonConfig
+    from .visibility import SiteCatalog
+
+    # Passes of the default TLE over a few sites on one day, sampled at 1 s as in planner.main
+    config = SimulatonConfig("optimize", None, 0, None)
+    times = np.datetime64("2024-06-01T00:00", "ns") + np.arange(86400) * np.timedelta64(1, "s")
+    jd, fr = datetime64_to_jd(times)
+    e, r, v = Satrec.twoline2rv(config.tle_1, config.tle_2).sgp4_array(jd, fr)
+    orbit = teme2ecef(r * 1000, v * 1000, jd + fr)[0]
+
+    catalog = SiteCatalog([43.66, -33.87, 51.5], [-79.40, 151.21, -0.13], names=["Toronto", "Sydney", "London"])
+    windows = catalog.windows(times, orbit, max_off_nadir_deg=30)
+    for window in windows[:3]:
+        geometry = PassGeometry.from_window(catalog, window, times, orbit)
+        count = sum(len(geometry.candidates(p)) for p in PROFILES)
+        start = time.perf_counter()
+        plans = optimize_pass(geometry, top=3)
+        elapsed = time.perf_counter() - start
+        print(f"{catalog.names[window['site']]} {str(window['peak'])[:19]}, {len(geometry)} samples, "
+              f"off-nadir {window['min_off_nadir_deg']:.1f}: {count} candidates in {elapsed:.2f} s")
+        for p in plans:
+            print(f"  {p['profile']:12} {np.round(p['params'], 2)}  coverage {p['coverage']:.2f}  "
+                  f"rotation {p['mean_abs_scanline_rotation_deg']:.1f}/{p['max_abs_scanline_rotation_deg']:.1f}  "
+                  f"interval {p['mean_point_interval_m']:.1f} m  off-nadir {p['max_off_nadir_deg']:.1f}  score {p['score']:.3f}")
@@ -0,0 +1,291 @@
+import math
+import numpy as np
+from sgp4.api import Satrec
+from scipy.spatial.transform import Rotation as R
+from .simulator import SimulatonConfig, Maneuver, AlignmentAxis, TensorTechSimulation, DATA_TYPES, unpivot_records, pivot_records
+from .convert import datetime64_to_jd, gmst, teme2ecef, lla2ecef
+from .sun import sun_vector_eci
+
+BODY_AXES = {
+    AlignmentAxis.POS_X: [1, 0, 0],
+    AlignmentAxis.NEG_X: [-1, 0, 0],
+    AlignmentAxis.POS_Y: [0, 1, 0],
+    AlignmentAxis.NEG_Y: [0, -1, 0],
+    AlignmentAxis.POS_Z: [0, 0, 1],
+    AlignmentAxis.NEG_Z: [0, 0, -1],
+}
+
+
+def tle_epoch(tle_1):
+    """
+    datetime64 epoch of a TLE, rounded to the second.
+    """
+    year, day = int(tle_1[18:20]), float(tle_1[20:32])
+    year += 2000 if year < 57 else 1900
+    start = np.datetime64(f"{year}-01-01", "ns") + np.timedelta64(round((day - 1) * 86400), "s")
+    return start.astype("datetime64[s]").astype("datetime64[ns]")
+
+
+def fine_quaternion(fine_cmd):
+    """
+    Unit scalar-first quaternion of a fine pointing command of four numeric strings.
+    """
+    if len(fine_cmd) != 4:
+        raise ValueError(f"fine_cmd needs 4 quaternion components, got {len(fine_cmd)}")
+    q = []
+    for i, x in enumerate(fine_cmd):
+        try:
+            q.append(float(x))
+        except (TypeError, ValueError):
+            raise ValueError(f"fine_cmd[{i}] (q{i}) must be a number for fine pointing, got {x!r}") from None
+    q = np.array(q)
+    if not np.all(np.isfinite(q)) or not np.linalg.norm(q):
+        raise ValueError(f"fine_cmd must be a finite, non-zero quaternion, got {fine_cmd}")
+    return q / np.linalg.norm(q)
+
+
+def reference_attitude(config: SimulatonConfig, times, r, v, target=(0, 0)):
+    """
+    Scalar-first quaternions rotating body vectors into ECI for the attitude the maneuver commands.
+
+    r and v are (N,3) ECI (TEME) positions and velocities. The alignment axis points at nadir, the
+    sun or the target, and the next body axis (X -> Y -> Z -> X) is kept as close as possible to
+    the velocity (or the orbit normal when sun pointing). Fine pointing holds config.fine_cmd in
+    ECI and detumbling has no reference (identity).
+    """
+    n = len(times)
+    if config.maneuver == Maneuver.FINE_POINTING:
+        return np.tile(fine_quaternion(config.fine_cmd), (n, 1))
+    if config.maneuver == Maneuver.DETUMBLING:
+        return np.tile([1.0, 0, 0, 0], (n, 1))
+
+    if config.maneuver == Maneuver.NADIR:
+        point, secondary = -r, v
+    elif config.maneuver == Maneuver.SUN_POINTING:
+        point, secondary = sun_vector_eci(times), np.cross(r, v)
+    elif config.maneuver == Maneuver.TARGET_TRACKING:
+        site = lla2ecef(*target)
+        theta = gmst(sum(datetime64_to_jd(times)))
+        c, s = np.cos(theta), np.sin(theta)
+        site_eci = np.column_stack([c * site[0] - s * site[1], s * site[0] + c * site[1], np.full(n, site[2])])
+        point, secondary = site_eci - r, v
+
+    point = point / np.linalg.norm(point, axis=1, keepdims=True)
+    secondary = secondary - np.sum(secondary * point, axis=1, keepdims=True) * point
+    secondary = secondary / np.linalg.norm(secondary, axis=1, keepdims=True)
+
+    a = np.array(BODY_AXES[config.alignment_axis], dtype=float)
+    b = np.roll(np.abs(a), 1)
+    body = np.column_stack([a, b, np.cross(a, b)])
+    eci = np.stack([point, secondary, np.cross(point, secondary)], axis=2)
+    return np.roll(R.from_matrix(eci @ body.T).as_quat(), 1, axis=1)
+
+
+def _integrate(q_ref, w_ref, dt, J, Kp, Kd, w0, max_torque, record_every):
+    # Plain-float fixed-step loop: the torque is held over each step (as a flight controller would)
+    # and the rigid body plus wheels are integrated with RK4.
+    J = J.tolist()
+    Ji = np.linalg.inv(np.array(J)).tolist()
+    Kp, Kd = Kp.tolist(), Kd.tolist()
+    qw, qx, qy, qz = 1.0, 0.0, 0.0, 0.0
+    wx, wy, wz = (float(x) for x in w0)
+    hx = hy = hz = 0.0
+    out = []
+
+    def deriv(qw, qx, qy, qz, wx, wy, wz, hx, hy, hz, ux, uy, uz):
+        Hx = J[0][0]*wx + J[0][1]*wy + J[0][2]*wz + hx
+        Hy = J[1][0]*wx + J[1][1]*wy + J[1][2]*wz + hy
+        Hz = J[2][0]*wx + J[2][1]*wy + J[2][2]*wz + hz
+        tx = ux - (wy*Hz - wz*Hy)
+        ty = uy - (wz*Hx - wx*Hz)
+        tz = uz - (wx*Hy - wy*Hx)
+        return (
+            0.5 * (-qx*wx - qy*wy - qz*wz),
+            0.5 * (qw*wx + qy*wz - qz*wy),
+            0.5 * (qw*wy + qz*wx - qx*wz),
+            0.5 * (qw*wz + qx*wy - qy*wx),
+            Ji[0][0]*tx + Ji[0][1]*ty + Ji[0][2]*tz,
+            Ji[1][0]*tx + Ji[1][1]*ty + Ji[1][2]*tz,
+            Ji[2][0]*tx + Ji[2][1]*ty + Ji[2][2]*tz,
+            -ux, -uy, -uz,
+        )
+
+    for k, ((rw, rx, ry, rz), (ox, oy, oz)) in enumerate(zip(q_ref.tolist(), w_ref.tolist())):
+        # Error quaternion q_ref^-1 * q, shortest way round
+        ew = rw*qw + rx*qx + ry*qy + rz*qz
+        ex = rw*qx - rx*qw - ry*qz + rz*qy
+        ey = rw*qy - ry*qw - rz*qx + rx*qz
+        ez = rw*qz - rz*qw - rx*qy + ry*qx
+        if ew < 0:
+            ew, ex, ey, ez = -ew, -ex, -ey, -ez
+        sx, sy, sz = ex / (1 + ew), ey / (1 + ew), ez / (1 + ew)
+
+        # Reference rate in body axes: rotate by the inverse error
+        cx = ey*oz - ez*oy
+        cy = ez*ox - ex*oz
+        cz = ex*oy - ey*ox
+        rbx = ox - 2*ew*cx + 2*(ey*cz - ez*cy)
+        rby = oy - 2*ew*cy + 2*(ez*cx - ex*cz)
+        rbz = oz - 2*ew*cz + 2*(ex*cy - ey*cx)
+
+        Hx = J[0][0]*wx + J[0][1]*wy + J[0][2]*wz + hx
+        Hy = J[1][0]*wx + J[1][1]*wy + J[1][2]*wz + hy
+        Hz = J[2][0]*wx + J[2][1]*wy + J[2][2]*wz + hz
+        dx, dy, dz = wx - rbx, wy - rby, wz - rbz
+        ux = -(Kp[0][0]*sx + Kp[0][1]*sy + Kp[0][2]*sz) - (Kd[0][0]*dx + Kd[0][1]*dy + Kd[0][2]*dz) + (wy*Hz - wz*Hy)
+        uy = -(Kp[1][0]*sx + Kp[1][1]*sy + Kp[1][2]*sz) - (Kd[1][0]*dx + Kd[1][1]*dy + Kd[1][2]*dz) + (wz*Hx - wx*Hz)
+        uz = -(Kp[2][0]*sx + Kp[2][1]*sy + Kp[2][2]*sz) - (Kd[2][0]*dx + Kd[2][1]*dy + Kd[2][2]*dz) + (wx*Hy - wy*Hx)
+        if max_torque is not None:
+            norm = math.sqrt(ux*ux + uy*uy + uz*uz)
+            if norm > max_torque:
+                ux, uy, uz = ux * max_torque / norm, uy * max_torque / norm, uz * max_torque / norm
+
+        if k % record_every == 0:
+            out.append((qw, qx, qy, qz, wx, wy, wz, hx, hy, hz, ux, uy, uz))
+
+        y = (qw, qx, qy, qz, wx, wy, wz, hx, hy, hz)
+        k1 = deriv(*y, ux, uy, uz)
+        k2 = deriv(*(a + 0.5*dt*b for a, b in zip(y, k1)), ux, uy, uz)
+        k3 = deriv(*(a + 0.5*dt*b for a, b in zip(y, k2)), ux, uy, uz)
+        k4 = deriv(*(a + dt*b for a, b in zip(y, k3)), ux, uy, uz)
+        qw, qx, qy, qz, wx, wy, wz, hx, hy, hz = (a + dt/6 * (b + 2*c + 2*d + e) for a, b, c, d, e in zip(y, k1, k2, k3, k4))
+        norm = math.sqrt(qw*qw + qx*qx + qy*qy + qz*qz)
+        qw, qx, qy, qz = qw / norm, qx / norm, qy / norm, qz / norm
+
+    return np.array(out)
+
+
+def propagate(config: SimulatonConfig, start=None, output_step_s=11, min_step_s=0.1, target=(0, 0),
+              bandwidth=0.02, damping=0.9, max_torque=None, wheel_inertia=2e-5):
+    """
+    Simulates a SimulatonConfig locally, without the TensorTech service.
+
+    The orbit comes from one SGP4 call over all integration steps. The attitude is a rigid body with
+    the MOI from bus_content, driven by reaction wheels under an MRP PD controller (natural
+    frequency `bandwidth` rad/s) that tracks the maneuver's reference attitude. The integration
+    step is config.step_size but at least min_step_s; the closed loop is far slower than that.
+    config.initial_omega is applied to every body axis (rad/s).
+
+    Returns the output datetime64 times and a dict of (N, k) arrays with the TensorTech series
+    names and columns. mrpData is the attitude relative to the reference, which is what the
+    TensorTech runs report, and attitudeErrorData is 2 atan(|mrp|). Magnetorquers and the gimbal
+    are not modelled and are reported as zeros. The orbit is returned as orbit_r (m) and orbit_v
+    (m/s) in ECEF.
+    """
+    if config.maneuver == Maneuver.FINE_POINTING:
+        fine_quaternion(config.fine_cmd)
+    start = tle_epoch(config.tle_1) if start is None else np.datetime64(start, "ns")
+    dt = max(float(config.step_size), min_step_s)
+    steps = int(config.sim_time_min * 60 / dt) + 1
+    record_every = max(int(round(output_step_s / dt)), 1)
+    times = start + (np.arange(steps) * dt * 1e9).astype("timedelta64[ns]")
+
+    jd, fr = datetime64_to_jd(times)
+    e, r, v = Satrec.twoline2rv(config.tle_1, config.tle_2).sgp4_array(jd, fr)
+    r, v = r * 1000, v * 1000
+
+    q_ref = reference_attitude(config, times, r, v, target)
+    rot = R.from_quat(np.roll(q_ref, -1, axis=1))
+    w_ref = np.zeros((steps, 3))
+    w_ref[:-1] = (rot[:-1].inv() * rot[1:]).as_rotvec() / dt
+    w_ref[-1] = w_ref[-2]
+
+    J = np.array(config.moi, dtype=float).reshape(3, 3)
+    # Detumbling only damps the rates
+    Kp = 4 * bandwidth**2 * J * (config.maneuver != Maneuver.DETUMBLING)
+    Kd = 2 * damping * bandwidth * J
+    w0 = np.full(3, float(config.initial_omega))
+    state = _integrate(q_ref, w_ref, dt, J, Kp, Kd, w0, max_torque, record_every)
+
+    idx = np.arange(0, steps, record_every)
+    q = state[:, 0:4]
+    q_err = R.from_quat(np.roll(q_ref[idx], -1, axis=1)).inv() * R.from_quat(np.roll(q, -1, axis=1))
+    err = np.roll(q_err.as_quat(), 1, axis=1)
+    err[err[:, 0] < 0] *= -1
+    mrp = err[:, 1:] / (1 + err[:, :1])
+
+    axis = np.array(BODY_AXES[config.alignment_axis], dtype=float)
+    wheel = state[:, 7:10] @ axis / wheel_inertia
+    torque = state[:, 10:13]
+    r_ecef, v_ecef = teme2ecef(r[idx], v[idx], jd[idx] + fr[idx])
+    zeros = np.zeros((len(idx), 1))
+
+    return times[idx], {
+        "omegaData": state[:, 4:7],
+        "mrpData": mrp,
+        "dipoleData": np.zeros((len(idx), 3)),
+        "gimbalAngData": zeros,
+        "gimbalVecData": zeros,
+        "wheelAccData": (-torque @ axis / wheel_inertia)[:, None],
+        "wheelVecData": wheel[:, None],
+        "attitudeErrorData": 2 * np.arctan(np.linalg.norm(mrp, axis=1))[:, None],
+        "desiredTorqueData": torque,
+        "orbit_e": e[idx],
+        "orbit_r": r_ecef,
+        "orbit_v": v_ecef,
+    }
+
+
+SERIES_COLUMNS = {
+    "omegaData": ["x", "y", "z"],
+    "mrpData": ["x", "y", "z"],
+    "dipoleData": ["x", "y", "z"],
+    "gimbalAngData": ["gimbal angle"],
+    "gimbalVecData": ["gimbal velocity"],
+    "wheelAccData": ["wheel acceleration"],
+    "wheelVecData": ["wheel velocity"],
+    "attitudeErrorData": ["attitude error"],
+    "desiredTorqueData": ["x", "y", "z"],
+}
+
+
+def run_local(sim: TensorTechSimulation, **kwargs):
+    """
+    Fills a TensorTechSimulation from propagate, in place of the remote run.
+    """
+    times, series = propagate(sim.simulation_config, **kwargs)
+    for name in DATA_TYPES:
+        sim.__dict__[name] = unpivot_records(times, SERIES_COLUMNS[name], series[name])
+    sim.orbit_time = times
+    sim.orbit_e, sim.orbit_r, sim.orbit_v = series["orbit_e"], series["orbit_r"], series["orbit_v"]
+    return sim
+
+
+def cross_check(local: TensorTechSimulation, remote: TensorTechSimulation):
+    """
+    Compares a local run against a remote one on the remote output times.
+
+    Returns the RMS orbit position difference (m), the RMS and final difference of the attitude
+    error (rad) and the final attitude error of each run.
+    """
+    times = remote.orbit_time.astype(np.int64)
+    lt = local.orbit_time.astype(np.int64)
+    keep = (times >= lt[0]) & (times <= lt[-1])
+    times = times[keep]
+
+    r_local = np.column_stack([np.interp(times, lt, local.orbit_r[:, i]) for i in range(3)])
+    dr = np.linalg.norm(r_local - remote.orbit_r[keep], axis=1)
+
+    def error(sim):
+        t, _, values = pivot_records(sim.attitudeErrorData)
+        return np.interp(times, t.astype(np.int64), values[:, 0])
+
+    e_local, e_remote = error(local), error(remote)
+    return {
+        "samples": int(len(times)),
+        "orbit_rms_m": float(np.sqrt(np.mean(dr**2))),
+        "attitude_error_rms_rad": float(np.sqrt(np.mean((e_local - e_remote)**2))),
+        "final_attitude_error_local_rad": float(e_local[-1]),
+        "final_attitude_error_remote_rad": float(e_remote[-1]),
+    }
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    for filename in sys.argv[1:] or ["analysis/json/fine_pointing_june_2024.json"]:
+        remote = TensorTechSimulation.from_file(filename)
+        begin = time.perf_counter()
+        local = run_local(TensorTechSimulation(remote.simulation_config), start=remote.orbit_time[0])
+        print(f"{filename}: {time.perf_counter() - begin:.2f} s, {cross_check(local, remote)}")
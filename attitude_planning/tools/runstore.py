@@ -0,0 +1,190 @@
+import json
+import struct
+import zipfile
+import numpy as np
+from .simulator import TensorTechSimulation, SimulatonConfig, DATA_TYPES, pivot_records, unpivot_records
+
+STORE_VERSION = 1
+
+
+class RunStore:
+    """
+    Columnar binary store for TensorTechSimulation runs.
+
+    A store is an uncompressed .npz file. Each series is one float64 (N, k) array next to the time
+    axis it shares with other series, and a JSON "meta" entry records the column names, the time
+    axis of every series and the simulation config. Because members are stored uncompressed they
+    are memory-mapped on open, so only the series that are used are read from disk.
+    """
+    filename: str
+    meta: dict
+
+    def __init__(self, filename, mmap=True):
+        self.filename = filename
+        self.mmap = mmap
+        self._arrays = {}
+        with zipfile.ZipFile(filename) as z:
+            self._members = {info.filename: info for info in z.infolist()}
+        self.meta = json.loads(bytes(self._load("meta")).decode())
+
+    def _load(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = self._memmap(name) if self.mmap else self._read(name)
+        return self._arrays[name]
+
+    def _read(self, name):
+        with np.load(self.filename) as z:
+            return z[name]
+
+    def _memmap(self, name):
+        info = self._members[f"{name}.npy"]
+        if info.compress_type != zipfile.ZIP_STORED:
+            return self._read(name)
+
+        with open(self.filename, "rb") as f:
+            # Skip the local file header, whose extra field may differ from the central directory
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if not shape or 0 in shape:
+            return self._read(name)
+        return np.memmap(self.filename, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran else "C")
+
+    @property
+    def names(self):
+        return list(self.meta["series"])
+
+    @property
+    def config(self):
+        return SimulatonConfig.from_json(self.meta["config"]) if self.meta["config"] else None
+
+    def columns(self, name):
+        return self.meta["series"][name]["columns"]
+
+    def time(self, name="mrpData"):
+        """
+        datetime64[ns] time axis of a series.
+        """
+        return self._load(self.meta["series"][name]["time"])
+
+    def series(self, name):
+        """
+        (N, k) values of a series, one column per entry of columns(name).
+        """
+        return self._load(name)
+
+    def to_tensor_tech_sim(self):
+        """
+        Rebuilds the record lists of a TensorTechSimulation, for code that still expects them.
+        """
+        sim = TensorTechSimulation(self.config)
+        for name in DATA_TYPES:
+            sim.__dict__[name] = unpivot_records(self.time(name), self.columns(name), self.series(name))
+
+        sim.orbit_time = np.array(self.time("orbitData"))
+        sim.orbit_e, sim.orbit_r, sim.orbit_v = self.orbit()
+        if self.meta.get("orbit_frame", "TEME") == "TEME":
+            sim.orbit_from_teme()
+        return sim
+
+    def orbit(self):
+        """
+        SGP4 error codes, (N,3) positions in m and (N,3) velocities in m/s.
+        """
+        orbit = np.asarray(self.series("orbitData"))
+        return orbit[:, 0].astype(int), orbit[:, 1:4], orbit[:, 4:7] * 1000
+
+    @classmethod
+    def write(cls, filename, sim: TensorTechSimulation):
+        arrays = {}
+        meta = {
+            "version": STORE_VERSION,
+            "config": sim.simulation_config.to_json() if sim.simulation_config else None,
+            "orbit_frame": "ECEF",
+            "series": {}
+        }
+
+        def add(name, times, columns, values):
+            # Series share a time axis whenever their times are identical
+            for key in (k for k in arrays if k.startswith("time")):
+                if np.array_equal(arrays[key], times):
+                    break
+            else:
+                key = f"time{sum(k.startswith('time') for k in arrays) or ''}"
+                arrays[key] = times
+            arrays[name] = np.ascontiguousarray(values, dtype=float)
+            meta["series"][name] = {"columns": columns, "time": key}
+
+        for name in DATA_TYPES:
+            add(name, *pivot_records(sim.__dict__[name]))
+
+        add("orbitData", sim.orbit_time, ["e", "r_x", "r_y", "r_z", "v_x", "v_y", "v_z"],
+            np.column_stack([sim.orbit_e, sim.orbit_r, sim.orbit_v / 1000]))
+
+        arrays["meta"] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+        np.savez(filename, **arrays)
+
+
+def convert_json(filename, out=None):
+    """
+    Migrates a JSON run saved by TensorTechSimulation.save to a RunStore next to it.
+    """
+    out = out or filename.rsplit(".", 1)[0] + ".npz"
+    RunStore.write(out, TensorTechSimulation.from_file(filename))
+    return out
+
+
+def benchmark(filename, repeat=5):
+    """
+    Load time and file size of a JSON run against its RunStore.
+    """
+    import os
+    import time
+    import tempfile
+
+    out = os.path.join(tempfile.mkdtemp(), "run.npz")
+    convert_json(filename, out)
+
+    def best(f):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            f()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def load_store():
+        store = RunStore(out)
+        for name in store.names:
+            np.asarray(store.series(name)).sum()
+
+    return {
+        "json_bytes": os.path.getsize(filename),
+        "store_bytes": os.path.getsize(out),
+        "json_load_s": best(lambda: TensorTechSimulation.from_file(filename)),
+        "store_open_s": best(lambda: RunStore(out).series("mrpData")),
+        "store_load_s": best(load_store),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert saved JSON runs to the binary run store")
+    parser.add_argument("command", choices=["convert", "bench"])
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args()
+
+    for filename in args.files:
+        if args.command == "convert":
+            print(f"{filename} -> {convert_json(filename)}")
+        else:
+            res = benchmark(filename)
+            print(f"{filename}: {res['json_bytes'] / 1e3:.0f} kB JSON in {res['json_load_s'] * 1e3:.1f} ms, "
+                  f"{res['store_bytes'] / 1e3:.0f} kB store opened in {res['store_open_s'] * 1e3:.2f} ms "
+                  f"and fully read in {res['store_load_s'] * 1e3:.2f} ms")
@@ -1,10 +1,49 @@
-import requests
+import hashlib
 import json
-import re
-import time
 from enum import Enum
-from sgp4.api import Satrec, jday
+from sgp4.api import Satrec
 import numpy as np
+from .convert import datetime64_to_jd, teme2ecef
+from .instrument import count, span, traced
+
+DATA_TYPES = ["omegaData", "mrpData", "dipoleData", "gimbalAngData", "gimbalVecData", "wheelAccData", "wheelVecData", "attitudeErrorData", "desiredTorqueData"]
+
+def pivot_records(records):
+    """
+    Pivots TensorTech {date, name, val} records into a shared time axis.
+
+    Returns the sorted datetime64[ns] times, the names in order of first appearance and an
+    (N, len(names)) array of values (NaN where a name has no record at a time).
+    """
+    # Timestamps repeat once per name, so parse each distinct string once, in one call
+    strings, string_idx = np.unique(np.array([r["date"] for r in records], dtype=str), return_inverse=True)
+    times, time_idx = np.unique(strings.astype("datetime64[ns]"), return_inverse=True)
+    time_idx = time_idx.reshape(-1)[string_idx.reshape(-1)]
+    names, first, name_idx = np.unique([r["name"] for r in records], return_index=True, return_inverse=True)
+
+    values = np.full((len(times), len(names)), np.nan)
+    values[time_idx, name_idx.reshape(-1)] = [r["val"] for r in records]
+
+    order = np.argsort(first)
+    return times, [str(n) for n in names[order]], values[:, order]
+
+def pivot_columns(records, columns):
+    """
+    pivot_records for the given names only, as datetime64[ns] times and an (N, len(columns))
+    array in that column order, whatever order the records came in.
+    """
+    times, names, values = pivot_records(records)
+    missing = [c for c in columns if c not in names]
+    if missing:
+        raise ValueError(f"No records named {missing}, only {names}")
+    return times, values[:, [names.index(c) for c in columns]]
+
+def unpivot_records(times, names, values):
+    """
+    Inverse of pivot_records: {date, name, val} records for an (N, len(names)) array of values.
+    """
+    dates = np.char.replace(np.datetime_as_string(np.asarray(times, dtype="datetime64[s]")), "T", " ").tolist()
+    return [{"date": d, "name": n, "val": x} for d, row in zip(dates, np.asarray(values).tolist()) for n, x in zip(names, row)]
 
 class Maneuver(Enum):
     DETUMBLING = "1"
@@ -56,12 +95,32 @@ class SimulatonConfig:
         if isinstance(data, str):
             data = json.loads(data)
 
-        return SimulatonConfig(
+        option = data["simulation option"]
+        config = SimulatonConfig(
             data["name"],
-            Maneuver(data["simulation option"]["maneuver"]),
-            data["simulation option"]["span"],
-            AlignmentAxis(data["simulation option"]["alignment axis"])
+            Maneuver(option["maneuver"]),
+            option["span"],
+            AlignmentAxis(option["alignment axis"])
         )
+        config.adcs_module = data.get("adcs module", config.adcs_module)
+        if "bus" in data:
+            config.bus_size = data["bus"]["size"]
+            config.bus_type = data["bus"]["type"]
+            config.moi = data["bus"]["content"][:9]
+            config.front_area = data["bus"]["content"][9]
+        if "orbit" in data:
+            config.tle_1, config.tle_2 = data["orbit"]["content"]
+        config.step_size = option.get("step size", config.step_size)
+        config.initial_omega = option.get("initial omega", config.initial_omega)
+        config.fine_cmd = option.get("fine cmd", config.fine_cmd)
+        return config
+
+    def config_hash(self):
+        """
+        Short hash of the canonical to_json, identifying configs that simulate the same thing.
+        """
+        canonical = json.dumps(json.loads(self.to_json()), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode()).hexdigest()[:16]
 
     def to_json(self):
         return json.dumps({
@@ -84,7 +143,9 @@ class SimulatonConfig:
         })
 
 class TensorTechSimulation:
+    base_url: str = None # TensorTech service, client.DEFAULT_URL when None
     session: str = None
+    run_key: str = None # Result cache key, set when the run was loaded from or saved to the cache
     simulation_config: SimulatonConfig
     omegaData: list
     mrpData: list
@@ -95,98 +156,113 @@ class TensorTechSimulation:
     wheelVecData: list
     attitudeErrorData: list
     desiredTorqueData: list
-    orbitData: list
+    orbit_time: np.ndarray # (N,) datetime64[ns] UTC
+    orbit_r: np.ndarray # (N,3) ECEF, m
+    orbit_v: np.ndarray # (N,3) ECEF, m/s
+    orbit_e: np.ndarray # (N,) SGP4 error codes
 
     def __init__(self, simulation_config):
         self.simulation_config = simulation_config
 
-    def __make_request(self, path, method, payload=None, vital=True):
-        url = f"https://testingtyf.tensortech.co/{path}"
-        headers = {'Cookie': f'session={self.session}'} if self.session else {'Content-Type': 'application/json'}
-        response = requests.request(method, url, headers=headers, data=payload)
+    def __print_progress(self, p):
+        print(f"\rProgress: {int(p)}% [{'=' * int(p/10)}{' ' * (10 - int(p/10))}]", end='', flush=True)
 
-        if response.status_code != 200 and vital:
-            print(f"Request failed with status code {response.status_code}")
-            print(response.text)
-            exit(1)
+    def __set_result(self, series):
+        for dataType in DATA_TYPES:
+            self.__dict__[dataType] = series[dataType]
 
-        return response
-    
-    def __get_session(self, header):
-        match = re.search(r'session=([^;]*)', header)
-        return match.group(1) if match else None
+    @property
+    def orbitData(self):
+        """
+        Orbit points as {date, e, r, v} dicts (r in m, v in km/s) built from the orbit arrays.
+        """
+        dates = np.char.replace(np.datetime_as_string(self.orbit_time, unit="s"), "T", " ").tolist()
+        return [{"date": d, "e": [e], "r": r, "v": v} for d, e, r, v in
+                zip(dates, self.orbit_e.tolist(), self.orbit_r.tolist(), (self.orbit_v / 1000).tolist())]
 
-    def __init_session(self):
-        response = self.__make_request("platform-configuration", "POST", self.simulation_config.to_json())
-        self.session = self.__get_session(response.headers['set-cookie'])
-    
-    def __get_progress(self):
-        response = self.__make_request("updateP", "GET", vital=False)
-        return float(response.json()['now'])
-    
-    def __wait_until_done(self):
-        while True:
-            p = self.__get_progress()
-            print(f"\rProgress: {int(p)}% [{'=' * int(p/10)}{' ' * (10 - int(p/10))}]", end='', flush=True)
-            if p == 100:
-                break
-            time.sleep(1)
-        time.sleep(5)
-    
-    def __extract_data(self, response_text, name):
-        response_text = response_text[response_text.find(name) + 1:]
-        response_text = response_text[response_text.find("'") + 1:]
-        response_text = response_text[:response_text.find("'")]
-
-        return json.loads(response_text)
-
-    def __get_result(self):
-        response = self.__make_request("result", "GET")
-        dataTypes = ["omegaData", "mrpData", "dipoleData", "gimbalAngData", "gimbalVecData", "wheelAccData", "wheelVecData", "attitudeErrorData", "desiredTorqueData"]
-        res = {}
-        for dataType in dataTypes:
-            # res[dataType] = self.__extract_data(response.text, dataType)
-            self.__dict__[dataType] = self.__extract_data(response.text, dataType)
-        return res
-    
-    def __date_str_to_jd(self, date_str):
-        year = int(date_str[:4])
-        month = int(date_str[5:7])
-        day = int(date_str[8:10])
-        hour = int(date_str[11:13])
-        minute = int(date_str[14:16])
-        second = int(date_str[17:19])
-        return jday(year, month, day, hour, minute, second)
-    
-    def __tle_to_orbit(self, tle_1, tle_2, jd, fr):
-        satellite = Satrec.twoline2rv(tle_1, tle_2)
-        return satellite.sgp4_array(np.array([jd]), np.array([fr]))
-    
+    @orbitData.setter
+    def orbitData(self, data):
+        self.orbit_time = np.array([o["date"] for o in data], dtype="datetime64[ns]")
+        self.orbit_e = np.array([o["e"][0] for o in data], dtype=int).reshape(-1)
+        self.orbit_r = np.array([o["r"] for o in data], dtype=float).reshape(-1, 3)
+        self.orbit_v = np.array([o["v"] for o in data], dtype=float).reshape(-1, 3) * 1000
+
+    def orbit_from_teme(self):
+        """
+        Converts orbit arrays loaded from runs saved before orbits were stored in ECEF.
+        """
+        jd, fr = datetime64_to_jd(self.orbit_time)
+        self.orbit_r, self.orbit_v = teme2ecef(self.orbit_r, self.orbit_v, jd + fr)
+
+    @traced("simulate.sgp4")
     def __get_all_orbit_points(self, tle_1, tle_2):
-        self.orbitData = []
-        for data in self.gimbalAngData:
-            jd, fr = self.__date_str_to_jd(data["date"])
-            e, r, v = self.__tle_to_orbit(tle_1, tle_2, jd, fr)
-            self.orbitData.append({
-                "date": data["date"],
-                "e": e.tolist(),
-                "r": [x * 1000 for x in r.tolist()[0]],
-                "v": v.tolist()[0]
-            })
-
-    def run(self):
-        self.__init_session()
-        self.__wait_until_done()
-        self.__get_result()
+        # Parse the TLE once and propagate every epoch in a single call
+        self.orbit_time = np.array([data["date"] for data in self.gimbalAngData], dtype="datetime64[ns]")
+        jd, fr = datetime64_to_jd(self.orbit_time)
+        satellite = Satrec.twoline2rv(tle_1, tle_2)
+        e, r, v = satellite.sgp4_array(jd, fr)
+        count("sgp4.epochs", len(jd))
+        self.orbit_e = e
+        self.orbit_r, self.orbit_v = teme2ecef(r * 1000, v * 1000, jd + fr)
+        return self.orbit_time, self.orbit_r, self.orbit_v
+
+    def run(self, local=False, cache=True, client=None):
+        """
+        Runs the simulation on the TensorTech service, or with the local propagator when local is
+        True (see tools/propagator.py). Runs are looked up in and saved to the result cache
+        (tools/cache.py) unless cache is False; cache may also be a ResultCache.
+        """
+        with span("simulate.run", backend="local" if local else "remote"):
+            if not local:
+                from .client import run_sync
+                run_sync(self.run_async(cache, client, self.__print_progress))
+                return
+
+            if cache:
+                from .cache import default_cache
+                cache = default_cache() if cache is True else cache
+                if cache.load_run(self, "local"):
+                    return
+            from .propagator import run_local
+            with span("simulate.propagate"):
+                run_local(self)
+            if cache:
+                cache.save_run(self, "local")
+
+    async def run_async(self, cache=True, client=None, on_progress=None):
+        """
+        Same as run on the TensorTech service, but awaits it instead of blocking so many sessions
+        can be monitored from one event loop. client defaults to the shared client for base_url.
+        Raises TensorTechError if the service fails.
+        """
+        from .client import default_client
+        if cache:
+            from .cache import default_cache
+            cache = default_cache() if cache is True else cache
+            if cache.load_run(self, "remote"):
+                return
+
+        client = client or default_client(self.base_url)
+        self.session, series = await client.simulate(self.simulation_config.to_json(), on_progress)
+        self.__set_result(series)
         self.__get_all_orbit_points(self.simulation_config.tle_1, self.simulation_config.tle_2)
+        if cache:
+            cache.save_run(self, "remote")
 
-    def run_session_id(self, session_id):
+    def run_session_id(self, session_id, client=None):
+        from .client import default_client, run_sync
+        client = client or default_client(self.base_url)
         self.session = session_id
-        self.__get_result()
+        self.__set_result(run_sync(client.result(session_id)))
         self.__get_all_orbit_points(self.simulation_config.tle_1, self.simulation_config.tle_2)
 
     @classmethod
+    @traced("load.from_file")
     def from_file(self, filename):
+        if filename.endswith(".npz"):
+            from .runstore import RunStore
+            return RunStore(filename).to_tensor_tech_sim()
+
         with open(filename, "r") as f:
             data = json.load(f)
             sim_config = SimulatonConfig.from_json(data["config"])
@@ -201,9 +277,16 @@ class TensorTechSimulation:
             sim.attitudeErrorData = data["attitudeErrorData"]
             sim.desiredTorqueData = data["desiredTorqueData"]
             sim.orbitData = data["orbitData"]
+            if data.get("orbitFrame", "TEME") == "TEME":
+                sim.orbit_from_teme()
             return sim
 
     def save(self, filename):
+        if filename.endswith(".npz"):
+            from .runstore import RunStore
+            RunStore.write(filename, self)
+            return
+
         data = {}
         data["omegaData"] = self.omegaData
         data["mrpData"] = self.mrpData
@@ -215,6 +298,7 @@ class TensorTechSimulation:
         data["attitudeErrorData"] = self.attitudeErrorData
         data["desiredTorqueData"] = self.desiredTorqueData
         data["orbitData"] = self.orbitData
+        data["orbitFrame"] = "ECEF"
         data["config"] = self.simulation_config.to_json()
 
         with open(filename, "w") as f:
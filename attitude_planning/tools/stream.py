@@ -0,0 +1,145 @@
+import numpy as np
+from .calculate import apply_quat_array, make_scanlines
+from .coverage import CoverageGrid
+from .geodetic import lla2ecef
+from .instrument import count, span, traced
+
+
+class RunningStats:
+    """
+    Count, mean, standard deviation and range of values added in batches, merged with Chan's
+    parallel update so nothing but the totals is kept.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[np.isfinite(values)]
+        n = len(values)
+        if n == 0:
+            return
+        mean = values.mean()
+        delta = mean - self.mean
+        total = self.count + n
+        self.m2 += np.sum((values - mean)**2) + delta**2 * self.count * n / total
+        self.mean += delta * n / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count else np.nan
+
+    def as_dict(self):
+        if not self.count:
+            return {"count": 0, "mean": np.nan, "std": np.nan, "min": np.nan, "max": np.nan}
+        return {"count": self.count, "mean": self.mean, "std": self.std, "min": self.min, "max": self.max}
+
+
+class StatsSink:
+    """
+    Running statistics of per-sample metrics over a stream. Point intervals and ground speeds carry
+    the last ground point over from the previous chunk.
+    """
+    metrics = ["scanline_rotation_deg", "point_interval_m", "ground_speed_mps", "orbit_speed_mps", "off_nadir_deg"]
+
+    def __init__(self):
+        self.stats = {name: RunningStats() for name in self.metrics}
+        self.samples = 0
+        self.valid = 0
+        self._last = (np.full(3, np.nan), None)
+
+    def add(self, chunk):
+        llar = chunk.llar
+        valid = llar["valid"]
+        self.samples += len(chunk)
+        self.valid += np.count_nonzero(valid)
+
+        # Samples that miss the Earth are NaN, which drops the intervals either side of them
+        ground = lla2ecef(llar["lat"], llar["lon"])
+        last_ground, last_t = self._last
+        previous = np.vstack([last_ground[None], ground[:-1]])
+        dt = np.diff(np.r_[chunk.time_ns[0] if last_t is None else last_t, chunk.time_ns]) / 1e9
+        interval = np.linalg.norm(ground - previous, axis=1)
+        self._last = (ground[-1], chunk.time_ns[-1])
+
+        orbit = chunk.orbit
+        nadir = -orbit / np.linalg.norm(orbit, axis=1, keepdims=True)
+        boresight = apply_quat_array(chunk.attitude, nadir)
+
+        self.stats["scanline_rotation_deg"].add(llar["roll"][valid])
+        self.stats["point_interval_m"].add(interval)
+        self.stats["ground_speed_mps"].add(interval[dt > 0] / dt[dt > 0])
+        self.stats["orbit_speed_mps"].add(chunk.orbit_speed)
+        self.stats["off_nadir_deg"].add(np.degrees(np.arccos(np.clip(np.sum(boresight * nadir, axis=1), -1, 1))))
+
+    def report(self):
+        return {"samples": self.samples, "valid": self.valid, **{name: s.as_dict() for name, s in self.stats.items()}}
+
+
+class CoverageSink:
+    """
+    Adds the scanline footprints of each chunk to a CoverageGrid, as swath_coverage does for an
+    interpolated Simulation.
+    """
+    def __init__(self, simulation, cell_m=100, bounds=None, grid=None):
+        self.width_m = simulation.scanline_width_m
+        self.height_m = simulation.scanline_height_m
+        self.integration_time_s = simulation.integration_time_s
+        self.grid = grid or CoverageGrid(cell_m, bounds)
+
+    def add(self, chunk):
+        llar = chunk.llar
+        valid = llar["valid"]
+        height = self.height_m + self.integration_time_s * chunk.orbit_speed[valid]
+        corners = make_scanlines(llar["lat"][valid], llar["lon"][valid], llar["roll"][valid], self.width_m, height)
+        self.grid.add(corners, height, self.width_m)
+
+
+@traced("stream.run")
+def run_stream(simulation, sinks, chunk_size=65536):
+    """
+    Streams a Simulation (see Simulation.stream) through sinks, objects with an add(chunk) method
+    and optionally a close() method called at the end. Returns the sinks.
+    """
+    for chunk in simulation.stream(chunk_size):
+        count("stream.samples", len(chunk))
+        for sink in sinks:
+            with span(f"stream.{type(sink).__name__}"):
+                sink.add(chunk)
+    for sink in sinks:
+        if hasattr(sink, "close"):
+            sink.close()
+    return sinks
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import resource
+    from .simulator import TensorTechSimulation, SimulatonConfig, Maneuver, AlignmentAxis
+    from ..classes.simulation import Simulation
+
+    # A day of local nadir pointing, streamed at the 60 Hz camera rate
+    config = SimulatonConfig("stream", Maneuver.NADIR, float(sys.argv[1]) if len(sys.argv) > 1 else 1440, AlignmentAxis.POS_Z)
+    config.step_size = 10
+    sim = TensorTechSimulation(config)
+    sim.run(local=True, cache=False)
+    simulation = Simulation.from_tensor_tech_sim(sim)
+
+    start = time.perf_counter()
+    stats, coverage = run_stream(simulation, [StatsSink(), CoverageSink(simulation, cell_m=500)])
+    elapsed = time.perf_counter() - start
+    report = stats.report()
+    print(f"{report['samples']} samples in {elapsed:.1f} s ({report['samples'] / elapsed / 1e6:.2f} M samples/s)")
+    for name in StatsSink.metrics:
+        r = report[name]
+        print(f"  {name}: mean {r['mean']:.2f}, std {r['std']:.2f}, range {r['min']:.2f} to {r['max']:.2f}")
+    print(f"  covered {coverage.grid.report(max_gap_m=2500)['covered_area_m2'] / 1e6:.0f} km2")
+    print(f"Peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
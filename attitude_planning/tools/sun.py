@@ -0,0 +1,246 @@
+from functools import lru_cache
+import numpy as np
+from scipy.interpolate import CubicSpline
+from .calculate import apply_quat_array
+from .consts import R as EARTH_RADIUS
+from .convert import datetime64_to_jd, gmst, lla2ecef
+
+AU = 149597870700 # m
+SUN_RADIUS = 695700000 # m
+DAY_NS = 86400 * 10**9
+
+
+def sun_position_eci(times):
+    """
+    Sun position in ECI (mean equator and equinox of date), in meters, for datetime64 UTC times.
+    Low-precision Astronomical Almanac model, good to about 0.01 degrees between 1950 and 2050.
+    """
+    jd, fr = datetime64_to_jd(times)
+    n = (jd - 2451545.0) + fr
+    L = np.radians(280.460 + 0.9856474 * n)
+    g = np.radians(357.528 + 0.9856003 * n)
+    lam = L + np.radians(1.915) * np.sin(g) + np.radians(0.020) * np.sin(2 * g)
+    eps = np.radians(23.439 - 4e-7 * n)
+    dist = AU * (1.00014 - 0.01671 * np.cos(g) - 0.00014 * np.cos(2 * g))
+    return dist[:, None] * np.column_stack([np.cos(lam), np.cos(eps) * np.sin(lam), np.sin(eps) * np.sin(lam)])
+
+
+def precession_matrix(jd):
+    """
+    (N,3,3) IAU 1976 precession from the J2000 mean equator and equinox to those of date.
+    """
+    t = (np.asarray(jd, dtype=float) - 2451545.0) / 36525
+    arcsec = np.pi / 180 / 3600
+    zeta = (2306.2181 * t + 0.30188 * t**2 + 0.017998 * t**3) * arcsec
+    z = (2306.2181 * t + 1.09468 * t**2 + 0.018203 * t**3) * arcsec
+    theta = (2004.3109 * t - 0.42665 * t**2 - 0.041833 * t**3) * arcsec
+    cz, sz, cZ, sZ, ct, st = np.cos(zeta), np.sin(zeta), np.cos(z), np.sin(z), np.cos(theta), np.sin(theta)
+    return np.stack([
+        np.stack([cz * ct * cZ - sz * sZ, -sz * ct * cZ - cz * sZ, -st * cZ], axis=-1),
+        np.stack([cz * ct * sZ + sz * cZ, -sz * ct * sZ + cz * cZ, -st * sZ], axis=-1),
+        np.stack([cz * st, -sz * st, ct], axis=-1),
+    ], axis=-2)
+
+
+class SunTable:
+    """
+    Sun positions in ECI (mean equator and equinox of date) tabulated over a time range and
+    interpolated with cubic splines. Built from the analytic model, or from an external ephemeris
+    such as a JPL Horizons vector table for better than its 0.01 degrees.
+    """
+    def __init__(self, time_ns, positions):
+        self.time_ns = np.asarray(time_ns, dtype=np.int64)
+        self.spline = CubicSpline((self.time_ns - self.time_ns[0]) / 1e9, np.asarray(positions, dtype=float), axis=0)
+
+    @classmethod
+    def from_model(cls, start, stop, step_s=600):
+        """
+        Table of sun_position_eci from start to stop (datetime64), with a margin of one step.
+        """
+        step = np.timedelta64(int(step_s * 1e9), "ns")
+        times = np.arange(np.datetime64(start, "ns") - step, np.datetime64(stop, "ns") + 2 * step, step)
+        return cls(times.astype(np.int64), sun_position_eci(times))
+
+    @classmethod
+    def from_csv(cls, filename, scale=1, j2000=True):
+        """
+        Reads a CSV of UTC times and sun x, y, z columns, such as a JPL Horizons vector table
+        (geocentric, scale=1000 for km). Positions in the J2000 frame are precessed to the frame
+        of date, as Horizons gives them; pass j2000=False for tables already of date.
+        """
+        import csv
+
+        with open(filename, newline="") as f:
+            rows = [row for row in csv.reader(f) if row and row[0].strip()[:1].isdigit()]
+        times = np.array([row[0].strip().replace(" ", "T") for row in rows], dtype="datetime64[ns]")
+        positions = np.array([[float(x) for x in row[1:4]] for row in rows]) * scale
+        if j2000:
+            jd, fr = datetime64_to_jd(times)
+            positions = np.einsum("nij,nj->ni", precession_matrix(jd + fr), positions)
+        return cls(times.astype(np.int64), positions)
+
+    def covers(self, times):
+        time_ns = np.asarray(times, dtype="datetime64[ns]").astype(np.int64)
+        return len(time_ns) == 0 or (time_ns.min() >= self.time_ns[0] and time_ns.max() <= self.time_ns[-1])
+
+    def positions(self, times):
+        if not self.covers(times):
+            raise ValueError("Times outside the sun table")
+        time_ns = np.asarray(times, dtype="datetime64[ns]").astype(np.int64)
+        return self.spline((time_ns - self.time_ns[0]) / 1e9)
+
+
+@lru_cache(maxsize=32)
+def _day_table(first_day, last_day, step_s):
+    return SunTable.from_model(np.datetime64(first_day * DAY_NS, "ns"), np.datetime64((last_day + 1) * DAY_NS, "ns"), step_s)
+
+
+def sun_table(times, step_s=600):
+    """
+    Cached SunTable of the analytic model over the whole UTC days spanned by times, so repeated
+    plans over the same dates reuse it.
+    """
+    time_ns = np.asarray(times, dtype="datetime64[ns]").astype(np.int64)
+    return _day_table(int(time_ns.min() // DAY_NS), int(time_ns.max() // DAY_NS), step_s)
+
+
+def sun_vector_eci(times):
+    """
+    Unit sun direction in ECI for datetime64 UTC times.
+    """
+    pos = sun_position_eci(times)
+    return pos / np.linalg.norm(pos, axis=1, keepdims=True)
+
+
+def eci2ecef(v, times):
+    """
+    Rotates (N,3) ECI (of date) vectors to ECEF by GMST at datetime64 UTC times.
+    """
+    theta = gmst(sum(datetime64_to_jd(times)))
+    c, sn = np.cos(theta), np.sin(theta)
+    return np.column_stack([c * v[:, 0] + sn * v[:, 1], -sn * v[:, 0] + c * v[:, 1], v[:, 2]])
+
+
+def sun_position_ecef(times, table=None):
+    """
+    Sun position in ECEF, in meters, for datetime64 UTC times, from a SunTable when given (or
+    table=True for the cached analytic one) and otherwise from the analytic model.
+    """
+    times = np.asarray(times, dtype="datetime64[ns]")
+    if len(times) == 0:
+        return np.zeros((0, 3))
+    if table is True:
+        table = sun_table(times)
+    return eci2ecef(table.positions(times) if table is not None else sun_position_eci(times), times)
+
+
+def sun_vector_ecef(times, table=None):
+    """
+    Unit sun direction in ECEF for datetime64 UTC times (rotated from ECI by GMST).
+    """
+    pos = sun_position_ecef(times, table)
+    return pos / np.maximum(np.linalg.norm(pos, axis=1, keepdims=True), 1)
+
+
+def sunlight_fraction(orbit, sun_position, conical=True):
+    """
+    Fraction of the sun's disk visible from (N,3) ECEF positions, given (N,3) ECEF sun positions
+    in meters: 1 in sunlight, 0 in umbra and in between in penumbra. The cylindrical model only
+    gives 0 or 1, with the shadow the width of the Earth.
+    """
+    orbit = np.asarray(orbit, dtype=float).reshape(-1, 3)
+    to_sun = np.asarray(sun_position, dtype=float).reshape(-1, 3) - orbit
+    r = np.linalg.norm(orbit, axis=1)
+    d = np.linalg.norm(to_sun, axis=1)
+    if not conical:
+        u = to_sun / d[:, None]
+        along = np.sum(orbit * u, axis=1)
+        perpendicular = np.linalg.norm(orbit - along[:, None] * u, axis=1)
+        return np.where((along < 0) & (perpendicular < EARTH_RADIUS), 0.0, 1.0)
+
+    # Apparent radii of the sun (a) and Earth (b) and their separation (c), as seen from the satellite
+    a = np.arcsin(np.clip(SUN_RADIUS / d, -1, 1))
+    b = np.arcsin(np.clip(EARTH_RADIUS / r, -1, 1))
+    c = np.arccos(np.clip(-np.sum(orbit * to_sun, axis=1) / (r * d), -1, 1))
+
+    # Area of the sun's disk hidden by the Earth's, for partly overlapping circles
+    x = (c**2 + a**2 - b**2) / (2 * np.maximum(c, 1e-12))
+    y = np.sqrt(np.maximum(a**2 - x**2, 0))
+    hidden = a**2 * np.arccos(np.clip(x / a, -1, 1)) + b**2 * np.arccos(np.clip((c - x) / b, -1, 1)) - c * y
+    res = 1 - hidden / (np.pi * a**2)
+    res = np.where(c >= a + b, 1.0, res)
+    res = np.where(c <= b - a, 0.0, res)
+    # Annular: the sun's disk is larger than the Earth's and surrounds it
+    res = np.where(c <= a - b, 1 - (b / a)**2, res)
+    return np.clip(res, 0, 1)
+
+
+def body_axis_ecef(attitude, orbit, velocity, axis):
+    """
+    ECEF direction of a body-frame axis for (N,4) scalar-first attitudes. At the identity attitude
+    the body frame is the orbit frame, with +z at nadir and +x along the velocity, so the camera
+    (+z) looks where georef_array looks.
+    """
+    orbit = np.asarray(orbit, dtype=float).reshape(-1, 3)
+    z = -orbit / np.linalg.norm(orbit, axis=1, keepdims=True)
+    y = np.cross(z, velocity)
+    y /= np.linalg.norm(y, axis=1, keepdims=True)
+    x = np.cross(y, z)
+    axis = np.asarray(axis, dtype=float)
+    reference = axis[..., 0, None] * x + axis[..., 1, None] * y + axis[..., 2, None] * z
+    return apply_quat_array(attitude, reference / np.linalg.norm(reference, axis=-1, keepdims=True))
+
+
+def sun_angle(attitude, orbit, velocity, axis, sun_vector):
+    """
+    Angle in degrees between a body axis (e.g. a star tracker boresight) and (N,3) ECEF sun
+    directions. The axis is sun-blinded where this is under its exclusion angle.
+    """
+    direction = body_axis_ecef(attitude, orbit, velocity, axis)
+    return np.degrees(np.arccos(np.clip(np.sum(direction * sun_vector, axis=1), -1, 1)))
+
+
+def sun_elevation(times, lat, lon):
+    """
+    Sun elevation in degrees above the local horizon at geodetic lat, lon (degrees), for
+    datetime64 UTC times. times, lat and lon broadcast against each other.
+    """
+    times = np.asarray(times, dtype="datetime64[ns]")
+    sun = sun_vector_ecef(times.reshape(-1)).reshape(*times.shape, 3)
+    up = lla2ecef(lat, lon, 1) - lla2ecef(lat, lon)
+    return np.degrees(np.arcsin(np.clip(np.sum(sun * up, axis=-1), -1, 1)))
+
+
+if __name__ == "__main__":
+    import time
+    from sgp4.api import Satrec
+    from .convert import teme2ecef
+    from .simulator import SimulatonConfig
+
+    # One day of the default TLE at 1 s
+    config = SimulatonConfig("sun", None, 0, None)
+    times = np.datetime64("2024-06-01T00:00", "ns") + np.arange(86400) * np.timedelta64(1, "s")
+    jd, fr = datetime64_to_jd(times)
+    e, r, v = Satrec.twoline2rv(config.tle_1, config.tle_2).sgp4_array(jd, fr)
+    orbit, velocity = teme2ecef(r * 1000, v * 1000, jd + fr)
+
+    for table in (None, True, True):
+        start = time.perf_counter()
+        sun = sun_position_ecef(times, table)
+        print(f"Sun positions ({'cached table' if table else 'analytic model'}): {(time.perf_counter() - start) * 1e3:.1f} ms")
+    model = sun_vector_ecef(times)
+    error = np.degrees(np.arccos(np.clip(np.sum(model * sun_vector_ecef(times, True), axis=1), -1, 1))).max()
+    print(f"Table against the model: {error:.1e} degrees")
+
+    start = time.perf_counter()
+    conical = sunlight_fraction(orbit, sun)
+    elapsed = time.perf_counter() - start
+    cylindrical = sunlight_fraction(orbit, sun, conical=False)
+    penumbra = (conical > 0) & (conical < 1)
+    print(f"Conical eclipse in {elapsed * 1e3:.1f} ms: {np.mean(conical == 0):.1%} umbra, {np.count_nonzero(penumbra)} s of penumbra; "
+          f"cylindrical: {np.mean(cylindrical == 0):.1%} shadow")
+
+    # Star tracker along track at nadir pointing
+    q = np.tile([1.0, 0, 0, 0], (len(times), 1))
+    angle = sun_angle(q, orbit, velocity, [1, 0, 0], model)
+    print(f"Star tracker within 30 degrees of the sun {np.mean(angle < 30):.1%} of the day")
@@ -0,0 +1,210 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from .consts import R as EARTH_RADIUS
+from .convert import lla2ecef
+from .calculate import quat_between
+from .sun import sun_vector_ecef
+
+WINDOW_DTYPE = np.dtype([
+    ("site", "i8"), # Index into the SiteCatalog
+    ("start", "datetime64[ns]"),
+    ("stop", "datetime64[ns]"), # Last visible sample
+    ("peak", "datetime64[ns]"), # Sample with the smallest off-nadir angle
+    ("start_index", "i8"),
+    ("stop_index", "i8"), # Exclusive
+    ("peak_index", "i8"),
+    ("min_off_nadir_deg", "f8"),
+    ("max_elevation_deg", "f8"),
+    ("sun_elevation_deg", "f8"), # At the peak
+    ("q", "f8", (4,)), # Pointing quaternion at the peak
+])
+
+# Margin on ball queries for the ellipsoid and site altitudes, m
+QUERY_MARGIN = 30000
+
+
+def pointing_quaternions(orbit, site):
+    """
+    Scalar-first quaternions that rotate nadir onto the line of sight from (N,3) ECEF positions to
+    (N,3) or (3,) ECEF site positions, as Simulation.imaging_attitude does.
+    """
+    orbit = np.asarray(orbit, dtype=float)
+    return quat_between(-orbit, site - orbit)
+
+
+class SiteCatalog:
+    """
+    Imaging sites with a KD-tree over their ECEF positions, so visibility over an orbit only looks at
+    sites near each orbit sample instead of every site at every sample.
+    """
+    lat: np.ndarray # (M,) degrees
+    lon: np.ndarray # (M,) degrees
+    alt: np.ndarray # (M,) m
+    names: list
+    ecef: np.ndarray # (M,3) m
+    up: np.ndarray # (M,3) geodetic unit normals
+
+    def __init__(self, lat, lon, alt=0, names=None):
+        self.lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        self.lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        self.alt = np.broadcast_to(np.asarray(alt, dtype=float), self.lat.shape)
+        self.names = list(names) if names is not None else [f"{a:.4f},{b:.4f}" for a, b in zip(self.lat, self.lon)]
+        self.ecef = lla2ecef(self.lat, self.lon, self.alt)
+        up = lla2ecef(self.lat, self.lon, self.alt + 1) - self.ecef
+        self.up = up / np.linalg.norm(up, axis=1, keepdims=True)
+        self.tree = cKDTree(self.ecef)
+
+    def __len__(self):
+        return len(self.lat)
+
+    @classmethod
+    def from_csv(cls, filename):
+        """
+        Reads a CSV with lat and lon columns and optional name and alt columns.
+        """
+        import csv
+
+        with open(filename, newline="") as f:
+            rows = list(csv.DictReader(f))
+        return cls(
+            [float(r["lat"]) for r in rows],
+            [float(r["lon"]) for r in rows],
+            [float(r.get("alt") or 0) for r in rows],
+            [r["name"] for r in rows] if rows and "name" in rows[0] else None,
+        )
+
+    def candidates(self, orbit, max_off_nadir_deg=None):
+        """
+        (sample, site) index pairs for every site within slant range of each (N,3) ECEF orbit
+        position that could be seen at up to max_off_nadir_deg (or down to the horizon).
+        """
+        orbit = np.asarray(orbit, dtype=float).reshape(-1, 3)
+        r = np.linalg.norm(orbit, axis=1)
+        re = EARTH_RADIUS - QUERY_MARGIN
+        horizon = np.sqrt(np.maximum(r**2 - re**2, 0))
+        if max_off_nadir_deg is None:
+            reach = horizon
+        else:
+            # Slant range to a spherical Earth at the off-nadir limit, unless that is past the horizon
+            eta = np.radians(max_off_nadir_deg)
+            disc = re**2 - (r * np.sin(eta))**2
+            reach = np.where(disc > 0, r * np.cos(eta) - np.sqrt(np.maximum(disc, 0)), horizon)
+        neighbours = self.tree.query_ball_point(orbit, reach + 2 * QUERY_MARGIN, workers=-1)
+
+        counts = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=len(neighbours))
+        samples = np.repeat(np.arange(len(orbit)), counts)
+        sites = np.concatenate(neighbours).astype(np.int64) if counts.sum() else np.zeros(0, dtype=np.int64)
+        return samples, sites
+
+    def visibility(self, times, orbit, max_off_nadir_deg=30, min_elevation_deg=0, min_sun_elevation_deg=None):
+        """
+        Every visible (sample, site) pair of an orbit. A site is visible when the satellite is above
+        min_elevation_deg at the site (0 is the Earth occlusion limit), the site is within
+        max_off_nadir_deg of nadir and, if min_sun_elevation_deg is given, the sun is at least that
+        high at the site.
+
+        Returns sample and site indices with the off-nadir angle, satellite elevation and sun
+        elevation of each pair, in degrees.
+        """
+        orbit = np.asarray(orbit, dtype=float).reshape(-1, 3)
+        samples, sites = self.candidates(orbit, max_off_nadir_deg)
+
+        los = self.ecef[sites] - orbit[samples]
+        dist = np.linalg.norm(los, axis=1)
+        nadir = -orbit[samples] / np.linalg.norm(orbit[samples], axis=1, keepdims=True)
+        off_nadir = np.degrees(np.arccos(np.clip(np.sum(los * nadir, axis=1) / dist, -1, 1)))
+        elevation = np.degrees(np.arcsin(np.clip(-np.sum(los * self.up[sites], axis=1) / dist, -1, 1)))
+
+        keep = elevation > min_elevation_deg
+        if max_off_nadir_deg is not None:
+            keep &= off_nadir <= max_off_nadir_deg
+
+        # The sun direction is only computed for samples with a candidate site
+        sun = np.full(len(samples), np.nan)
+        used = np.unique(samples[keep])
+        if len(used):
+            sun_ecef = np.zeros((len(orbit), 3))
+            sun_ecef[used] = sun_vector_ecef(np.asarray(times, dtype="datetime64[ns]")[used])
+            sun[keep] = np.degrees(np.arcsin(np.clip(np.sum(sun_ecef[samples[keep]] * self.up[sites[keep]], axis=1), -1, 1)))
+        if min_sun_elevation_deg is not None:
+            keep &= sun >= min_sun_elevation_deg
+
+        return samples[keep], sites[keep], off_nadir[keep], elevation[keep], sun[keep]
+
+    def windows(self, times, orbit, max_off_nadir_deg=30, min_elevation_deg=0, min_sun_elevation_deg=None):
+        """
+        Visibility windows of every site over an orbit as a WINDOW_DTYPE array sorted by start time.
+        A window is a run of consecutive visible samples; its pointing quaternion is taken at the
+        sample closest to nadir. Sample the orbit finely enough for the window edges you need.
+        """
+        times = np.asarray(times, dtype="datetime64[ns]")
+        orbit = np.asarray(orbit, dtype=float).reshape(-1, 3)
+        samples, sites, off_nadir, elevation, sun = self.visibility(
+            times, orbit, max_off_nadir_deg, min_elevation_deg, min_sun_elevation_deg)
+
+        if len(samples) == 0:
+            return np.empty(0, dtype=WINDOW_DTYPE)
+
+        order = np.lexsort((samples, sites))
+        samples, sites, off_nadir, elevation, sun = samples[order], sites[order], off_nadir[order], elevation[order], sun[order]
+        starts = np.flatnonzero(np.r_[True, (np.diff(sites) != 0) | (np.diff(samples) != 1)])
+        ends = np.r_[starts[1:], len(samples)]
+
+        # Smallest off-nadir angle in each window: sort by window then angle and take the first
+        window = np.repeat(np.arange(len(starts)), ends - starts)
+        peak = np.lexsort((off_nadir, window))[starts]
+
+        res = np.empty(len(starts), dtype=WINDOW_DTYPE)
+        res["site"] = sites[starts]
+        res["start_index"] = samples[starts]
+        res["stop_index"] = samples[ends - 1] + 1
+        res["peak_index"] = samples[peak]
+        res["start"] = times[res["start_index"]]
+        res["stop"] = times[res["stop_index"] - 1]
+        res["peak"] = times[res["peak_index"]]
+        res["min_off_nadir_deg"] = off_nadir[peak]
+        res["max_elevation_deg"] = np.maximum.reduceat(elevation, starts)
+        res["sun_elevation_deg"] = sun[peak]
+        res["q"] = pointing_quaternions(orbit[res["peak_index"]], self.ecef[res["site"]])
+        return res[np.argsort(res["start"], kind="stable")]
+
+
+def brute_force_visibility(catalog, times, orbit, max_off_nadir_deg=30, min_elevation_deg=0):
+    """
+    Visible (sample, site) pairs checked over the full sites x samples grid, for validating
+    SiteCatalog.visibility on small inputs.
+    """
+    orbit = np.asarray(orbit, dtype=float).reshape(-1, 3)
+    los = catalog.ecef[None, :, :] - orbit[:, None, :]
+    dist = np.linalg.norm(los, axis=2)
+    nadir = -orbit / np.linalg.norm(orbit, axis=1, keepdims=True)
+    off_nadir = np.degrees(np.arccos(np.clip(np.einsum("nmk,nk->nm", los, nadir) / dist, -1, 1)))
+    elevation = np.degrees(np.arcsin(np.clip(-np.einsum("nmk,mk->nm", los, catalog.up) / dist, -1, 1)))
+    return np.nonzero((elevation > min_elevation_deg) & (off_nadir <= max_off_nadir_deg))
+
+
+if __name__ == "__main__":
+    import time
+    from sgp4.api import Satrec
+    from .convert import datetime64_to_jd, teme2ecef
+    from .simulator import SimulatonConfig
+
+    # One day of the default TLE at 1 s against a random global catalog
+    config = SimulatonConfig("visibility", None, 0, None)
+    times = np.datetime64("2024-06-01T00:00", "ns") + np.arange(86400) * np.timedelta64(1, "s")
+    jd, fr = datetime64_to_jd(times)
+    e, r, v = Satrec.twoline2rv(config.tle_1, config.tle_2).sgp4_array(jd, fr)
+    orbit = teme2ecef(r * 1000, v * 1000, jd + fr)[0]
+
+    rng = np.random.default_rng(0)
+    for n in (1000, 10000, 100000):
+        catalog = SiteCatalog(np.degrees(np.arcsin(rng.uniform(-1, 1, n))), rng.uniform(-180, 180, n))
+        start = time.perf_counter()
+        windows = catalog.windows(times, orbit, max_off_nadir_deg=30, min_sun_elevation_deg=10)
+        print(f"{n} sites x {len(times)} samples: {len(windows)} windows in {time.perf_counter() - start:.2f} s")
+
+    # Against the brute force grid on a small problem
+    catalog = SiteCatalog(np.degrees(np.arcsin(rng.uniform(-1, 1, 500))), rng.uniform(-180, 180, 500))
+    fast = catalog.visibility(times[:6000], orbit[:6000])[:2]
+    slow = brute_force_visibility(catalog, times[:6000], orbit[:6000])
+    print("matches brute force:", set(zip(*fast)) == set(zip(*map(np.ndarray.tolist, slow))))
@@ -1,59 +1,209 @@
+import shutil
+import subprocess
 import numpy as np
+from scipy.spatial.transform import Rotation
 
-from pyquaternion import Quaternion
 from attitude_planning.classes.simulation import Simulation
+from attitude_planning.tools.instrument import count, span, traced
 
 from matplotlib import pyplot as plt
 from matplotlib import animation
 from mpl_toolkits.mplot3d import Axes3D
 
-fig = plt.figure()
-ax = fig.add_axes([0, 0, 1, 1], projection='3d')
-ax.set_xlabel('X')
-ax.set_ylabel('Y')
-ax.set_zlabel('Z')
+COLORS = ['r', 'g', 'b']
 
-colors = ['r', 'g', 'b']
 
-lines = sum([ax.plot([], [], [], c=c)
-             for c in colors], [])
+def body_axes(attitude):
+    """
+    (N,3,3) body x, y and z axes (rows) rotated by (N,4) scalar-first quaternions, in one batch.
+    """
+    # scipy is scalar-last. The columns of the rotation matrices are the rotated axes
+    return Rotation.from_quat(np.roll(np.asarray(attitude, dtype=float).reshape(-1, 4), -1, axis=1)).as_matrix().transpose(0, 2, 1)
 
-startpoints = np.array([[0, 0, 0], [0, 0, 0], [0, 0, 0]])
-endpoints = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]])
 
-ax.set_xlim((-8, 8))
-ax.set_ylim((-8, 8))
-ax.set_zlim((-8, 8))
+def frame_times(start_ns, stop_ns, fps=30, speed=60):
+    """
+    int64 nanosecond times of the frames of a playback from start_ns to stop_ns at fps frames per
+    second of video, with speed seconds of simulation per second of video.
+    """
+    return np.arange(start_ns, stop_ns + 1, max(int(speed / fps * 1e9), 1), dtype=np.int64)
 
-ax.view_init(30, 0)
 
-qs = []
+class AttitudePlayback:
+    """
+    Animated body axes of a simulation on a 3D axes. The body axes of every frame are computed up
+    front, frames are decimated to the playback rate by simulation time, and each frame only
+    updates the line artists, so playback blits and long runs cost as much as their frame count.
+    """
+    def __init__(self, simulation: Simulation, frame_ns, ax=None, title=None):
+        if ax is None:
+            ax = plt.figure().add_axes([0, 0, 1, 1], projection='3d')
+        self.ax = ax
+        self.simulation = simulation
+        self.frame_ns = frame_ns
 
-def animate(i):
-    q = qs[i]
-    q = Quaternion(q)
+        # Latest sample at or before each frame time
+        self.index = np.clip(np.searchsorted(simulation.time_ns, frame_ns, side="right") - 1, 0, len(simulation.time_ns) - 1)
+        self.axes = body_axes(simulation.attitude[self.index])
 
-    for line, start, end in zip(lines, startpoints, endpoints):
-        start = q.rotate(start)
-        end = q.rotate(end)
+        ax.set_xlabel('X')
+        ax.set_ylabel('Y')
+        ax.set_zlabel('Z')
+        ax.set_xlim((-1.2, 1.2))
+        ax.set_ylim((-1.2, 1.2))
+        ax.set_zlim((-1.2, 1.2))
+        ax.view_init(30, 0)
+        if title:
+            ax.set_title(title)
+        self.lines = [ax.plot([], [], [], c=c, animated=True)[0] for c in COLORS]
+        self.label = ax.text2D(0.02, 0.95, "", transform=ax.transAxes, animated=True)
 
-        line.set_data([start[0], end[0]], [start[1], end[1]])
-        line.set_3d_properties([start[2], end[2]])
+    def __len__(self):
+        return len(self.frame_ns)
 
-    fig.canvas.draw()
-    return lines
+    @property
+    def artists(self):
+        return [*self.lines, self.label]
 
-def plot_attitude(simulation: Simulation):
-    global qs
-    qs = simulation.attitude
-    anim = animation.FuncAnimation(fig, animate,
-                                frames=len(simulation.attitude), interval=1, blit=False)
-    # anim.save('example_attitude.mp4', fps=1)
+    def update(self, i):
+        for line, end in zip(self.lines, self.axes[i]):
+            line.set_data([0, end[0]], [0, end[1]])
+            line.set_3d_properties([0, end[2]])
+        self.label.set_text(str(np.datetime64(int(self.frame_ns[i]), "ns").astype("datetime64[ms]")))
+        return self.artists
+
+
+@traced("attitude.playbacks")
+def playbacks(simulations, fps=30, speed=60, titles=None, start=None, stop=None):
+    """
+    Side by side AttitudePlaybacks of one or more simulations on a shared timeline, in one figure.
+    """
+    if isinstance(simulations, Simulation):
+        simulations = [simulations]
+    start = min(s.time_ns[0] for s in simulations) if start is None else start
+    stop = max(s.time_ns[-1] for s in simulations) if stop is None else stop
+    frame_ns = frame_times(start, stop, fps, speed)
+
+    fig = plt.figure(figsize=(5 * len(simulations), 5))
+    titles = titles or [None] * len(simulations)
+    return fig, [
+        AttitudePlayback(s, frame_ns, fig.add_subplot(1, len(simulations), i + 1, projection='3d'), title)
+        for i, (s, title) in enumerate(zip(simulations, titles))
+    ]
+
+
+def animate(fig, players, fps=30):
+    """
+    Blitted FuncAnimation of playbacks made with playbacks().
+    """
+    def update(i):
+        return sum([p.update(i) for p in players], [])
+
+    return animation.FuncAnimation(fig, update, frames=len(players[0]), interval=1000 / fps, blit=True)
+
+
+def render_frames(fig, players):
+    """
+    Renders every frame offscreen and yields it as an (H,W,4) uint8 RGBA array, copied out of the
+    canvas so frames can be kept. The static axes are drawn once and restored under each frame's lines.
+    """
+    canvas = fig.canvas
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    for i in range(len(players[0])):
+        with span("attitude.frame"):
+            canvas.restore_region(background)
+            for p in players:
+                for artist in p.update(i):
+                    p.ax.draw_artist(artist)
+            frame = np.array(canvas.buffer_rgba())
+        count("attitude.frames")
+        yield frame
+
+
+class FrameWriter:
+    """
+    Writes RGBA frames to a video by piping raw frames to ffmpeg, or to an animated GIF with Pillow
+    when the file is a .gif or ffmpeg is not installed.
+    """
+    def __init__(self, filename, fps=30):
+        self.filename = filename
+        self.fps = fps
+        self.process = None
+        self.images = []
+
+    def write(self, frame):
+        height, width = frame.shape[:2]
+        if self.process is None and not self.images and shutil.which("ffmpeg") and not self.filename.endswith(".gif"):
+            self.process = subprocess.Popen(
+                ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{width}x{height}",
+                 "-r", str(self.fps), "-i", "-", "-pix_fmt", "yuv420p", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", self.filename],
+                stdin=subprocess.PIPE)
+        if self.process is not None:
+            self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+        else:
+            from PIL import Image
+            self.images.append(Image.fromarray(frame[..., :3].copy()))
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+        elif self.images:
+            self.images[0].save(self.filename, save_all=True, append_images=self.images[1:], duration=1000 / self.fps, loop=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@traced("visualize.save_attitude")
+def save_attitude(simulations, filename, fps=30, speed=60, titles=None, start=None, stop=None, dpi=100):
+    """
+    Renders playbacks of one or more simulations to a video file without showing them.
+    """
+    fig, players = playbacks(simulations, fps, speed, titles, start, stop)
+    fig.set_dpi(dpi)
+    with FrameWriter(filename, fps) as writer:
+        for frame in render_frames(fig, players):
+            writer.write(frame)
+    plt.close(fig)
+
+
+@traced("visualize.plot_attitude")
+def plot_attitude(simulation: Simulation, fps=30, speed=60):
+    """
+    Plays back the body axes of one or more simulations, at speed seconds of simulation per second.
+    """
+    fig, players = playbacks(simulation, fps, speed)
+    anim = animate(fig, players, fps)
     plt.show()
+    return anim
+
 
 if __name__ == "__main__":
+    import os
+    import sys
+    import tempfile
+    import time
+    import matplotlib
     from attitude_planning.tools.simulator import TensorTechSimulation
-    sim = TensorTechSimulation.from_file("fixed_attitude_june_2024.json")
+    matplotlib.use("Agg")
+
+    sim = TensorTechSimulation.from_file(sys.argv[1] if len(sys.argv) > 1 else "analysis/json/fixed_attitude_june_2024.json")
     simulation = Simulation.from_tensor_tech_sim(sim)
     simulation.derive_data()
-    plot_attitude(simulation)
\ No newline at end of file
+
+    # Offline rendering of a minute of playback, and two runs side by side
+    start = time.perf_counter()
+    fig, players = playbacks(simulation, fps=30, speed=10)
+    frames = sum(1 for _ in render_frames(fig, players))
+    elapsed = time.perf_counter() - start
+    print(f"{len(simulation.time_ns)} samples -> {frames} frames rendered in {elapsed:.2f} s ({frames / elapsed:.0f} fps)")
+
+    out = sys.argv[2] if len(sys.argv) > 2 else os.path.join(tempfile.mkdtemp(), "attitude.gif")
+    start = time.perf_counter()
+    save_attitude([simulation, simulation], out, fps=10, speed=60, titles=["a", "b"])
+    print(f"Side by side GIF in {time.perf_counter() - start:.2f} s: {out}")
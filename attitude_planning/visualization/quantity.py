@@ -1,49 +1,239 @@
 import matplotlib.pyplot as plt
+import numpy as np
 from enum import Enum
-from ..tools.calculate import dist_between_lat_lon
+from functools import cached_property
+from ..tools.calculate import apply_quat_array
+from ..tools.geodetic import lla2ecef
+from ..tools.instrument import span, traced
 from ..classes.simulation import Simulation
 
 class Quantity(Enum):
     SCANLINE_ROTATION = "Scanline Rotation (degrees)"
     SCANLINE_INTERVAL = "Point Interval (m)"
+    GROUND_SPEED = "Ground Speed (m/s)"
+    OFF_NADIR = "Off-Nadir Angle (degrees)"
+    BODY_RATE = "Body Rate (degrees/s)"
+    ATTITUDE_ERROR = "Attitude Error (degrees)"
+    WHEEL_SPEED = "Wheel Speed (rad/s)"
+    WHEEL_MOMENTUM = "Wheel Momentum (mN m s)"
+    SUNLIGHT = "Sunlight (fraction of the sun's disk)"
+    STAR_TRACKER_SUN_ANGLE = "Star Tracker Sun Angle (degrees)"
 
-def get_quantity(sim: Simulation, quantity: Quantity):
-    values = []
-    if quantity == Quantity.SCANLINE_ROTATION:
-        values = [sim.llar[i][3] if sim.llar[i] else None for i in range(len(sim.llar))]
-    elif quantity == Quantity.SCANLINE_INTERVAL:
-        values = [None]
-        for i in range(1, len(sim.llar)):
-            if sim.llar[i] and sim.llar[i-1]:
-                values.append(dist_between_lat_lon(sim.llar[i][0], sim.llar[i][1], sim.llar[i-1][0], sim.llar[i-1][1]))
-            else:
-                values.append(None)
-
-    res = []
-    for i in range(len(sim.dates)):
-        if values[i] is not None:
-            res.append((sim.dates[i], values[i]))
-    
+# Quantity -> function(arrays: RunArrays) returning (time_ns, values, mask), where values are NaN
+# wherever mask is False. Add metrics with the @quantity decorator
+QUANTITIES = {}
+
+
+def quantity(q: Quantity):
+    def register(f):
+        QUANTITIES[q] = f
+        return f
+    return register
+
+
+class RunArrays:
+    """
+    Arrays of a simulation window shared by the quantity functions, each computed once on first
+    use so many quantities can be extracted in one pass.
+    """
+    def __init__(self, sim: Simulation, start=0, stop=None):
+        self.sim = sim
+        self.start, self.stop = sim.window(start, stop)
+        # One sample of history so differences are defined at the first sample
+        self.lo = max(self.start - 1, 0)
+
+    @cached_property
+    def time_ns(self):
+        return self.sim.time_ns[self.start:self.stop]
+
+    @cached_property
+    def llar(self):
+        return self.sim.get_llar(self.lo, self.stop)
+
+    @cached_property
+    def ground(self):
+        # ECEF of each ground point. Chords between neighbouring samples equal geodesics to well under a mm
+        return lla2ecef(self.llar["lat"], self.llar["lon"])
+
+    @cached_property
+    def step(self):
+        """
+        Ground distance and time from the previous sample, and where both samples hit the Earth.
+        """
+        distance = np.linalg.norm(np.diff(self.ground, axis=0), axis=1)
+        dt = np.diff(self.sim.time_ns[self.lo:self.stop]) / 1e9
+        valid = self.llar["valid"][1:] & self.llar["valid"][:-1]
+        if self.lo == self.start:
+            distance, dt, valid = np.r_[np.nan, distance], np.r_[np.nan, dt], np.r_[False, valid]
+        return distance, dt, valid
+
+    def telemetry(self, name):
+        """
+        A telemetry series within the window, on its own time axis.
+        """
+        time_ns, columns, values = self.sim.telemetry[name]
+        if self.stop <= self.start:
+            return time_ns[:0], values[:0]
+        lo = np.searchsorted(time_ns, self.sim.time_ns[self.start])
+        hi = np.searchsorted(time_ns, self.sim.time_ns[self.stop - 1], side="right")
+        return time_ns[lo:hi], values[lo:hi]
+
+
+def masked(time_ns, values, mask):
+    return time_ns, np.where(mask, values, np.nan), mask
+
+
+def telemetry_quantity(arrays: RunArrays, name, scale=1):
+    time_ns, values = arrays.telemetry(name)
+    values = np.linalg.norm(values, axis=1) if values.shape[1] > 1 else values[:, 0]
+    return masked(time_ns, values * scale, np.isfinite(values))
+
+
+@quantity(Quantity.SCANLINE_ROTATION)
+def scanline_rotation(arrays: RunArrays):
+    llar = arrays.llar[arrays.start - arrays.lo:]
+    return masked(arrays.time_ns, llar["roll"], llar["valid"])
+
+
+@quantity(Quantity.SCANLINE_INTERVAL)
+def scanline_interval(arrays: RunArrays):
+    distance, dt, valid = arrays.step
+    return masked(arrays.time_ns, distance, valid)
+
+
+@quantity(Quantity.GROUND_SPEED)
+def ground_speed(arrays: RunArrays):
+    distance, dt, valid = arrays.step
+    valid = valid & (dt > 0)
+    return masked(arrays.time_ns, distance / np.where(valid, dt, 1), valid)
+
+
+@quantity(Quantity.OFF_NADIR)
+def off_nadir(arrays: RunArrays):
+    orbit = arrays.sim.orbit[arrays.start:arrays.stop]
+    nadir = -orbit / np.linalg.norm(orbit, axis=1, keepdims=True)
+    boresight = apply_quat_array(arrays.sim.attitude[arrays.start:arrays.stop], nadir)
+    angle = np.degrees(np.arccos(np.clip(np.sum(boresight * nadir, axis=1), -1, 1)))
+    return masked(arrays.time_ns, angle, np.isfinite(angle))
+
+
+@quantity(Quantity.BODY_RATE)
+def body_rate(arrays: RunArrays):
+    return telemetry_quantity(arrays, "omegaData", np.degrees(1))
+
+
+@quantity(Quantity.ATTITUDE_ERROR)
+def attitude_error(arrays: RunArrays):
+    return telemetry_quantity(arrays, "attitudeErrorData", np.degrees(1))
+
+
+@quantity(Quantity.WHEEL_SPEED)
+def wheel_speed(arrays: RunArrays):
+    return telemetry_quantity(arrays, "wheelVecData")
+
+
+@quantity(Quantity.WHEEL_MOMENTUM)
+def wheel_momentum(arrays: RunArrays):
+    return telemetry_quantity(arrays, "wheelVecData", arrays.sim.wheel_inertia_kgm2 * 1000)
+
+
+@quantity(Quantity.SUNLIGHT)
+def sunlight(arrays: RunArrays):
+    sun = arrays.sim.get_sun(arrays.start, arrays.stop)
+    return masked(arrays.time_ns, sun["sunlight"], np.ones(len(sun), dtype=bool))
+
+
+@quantity(Quantity.STAR_TRACKER_SUN_ANGLE)
+def star_tracker_sun_angle(arrays: RunArrays):
+    sun = arrays.sim.get_sun(arrays.start, arrays.stop)
+    return masked(arrays.time_ns, sun["star_tracker_angle"], np.isfinite(sun["star_tracker_angle"]))
+
+
+@traced("visualize.get_quantities")
+def get_quantities(sim: Simulation, quantities=None, start=0, stop=None):
+    """
+    Dict of Quantity -> (times, values, mask) for a window (every registered quantity by default).
+    times is datetime64[ns] and values are NaN wherever mask is False. Quantities derived from the
+    telemetry are on the telemetry's own time axis, the rest on the simulation's.
+    """
+    arrays = RunArrays(sim, start, stop)
+    res = {}
+    for q in quantities or QUANTITIES:
+        with span(f"quantity.{q.name.lower()}"):
+            time_ns, values, mask = QUANTITIES[q](arrays)
+        res[q] = (np.asarray(time_ns, dtype=np.int64).view("datetime64[ns]"), values, mask)
     return res
 
-def plot_quantity(sim: Simulation, quantity: Quantity):
-    values = get_quantity(sim, quantity)
-    dates = [x[0] for x in values]
-    values = [x[1] for x in values]
-    # cut first 100 values
-    dates = dates[200:]
-    values = values[200:]
-    plt.plot(dates, values)
-    plt.xlabel("Date")
-    plt.ylabel(quantity.value)
-    plt.title(f"{quantity.value} vs Date")
-    plt.show()
+
+def get_quantity(sim: Simulation, quantity: Quantity, start=0, stop=None):
+    return get_quantities(sim, [quantity], start, stop)[quantity]
+
+
+def minmax_decimate(x, values, mask=None, buckets=2000):
+    """
+    Indices of the smallest and largest valid value in each of `buckets` equal intervals of x, in
+    order. A line through them looks the same as the full series when drawn `buckets` pixels wide.
+    """
+    x = np.asarray(x).astype(float)
+    valid = np.isfinite(values) if mask is None else mask & np.isfinite(values)
+    idx = np.flatnonzero(valid)
+    if len(idx) <= 2 * buckets:
+        return idx
+    span = x[idx[-1]] - x[idx[0]]
+    bucket = np.minimum(((x[idx] - x[idx[0]]) / (span or 1) * buckets).astype(int), buckets - 1)
+    order = np.lexsort((values[idx], bucket))
+    first = np.flatnonzero(np.r_[True, np.diff(bucket[order]) != 0])
+    last = np.r_[first[1:], len(order)] - 1
+    return idx[np.unique(np.r_[order[first], order[last]])]
+
+
+def decimated_line(times, values, mask, buckets=2000):
+    """
+    Min/max decimated (times, values) with NaN breaks wherever invalid samples were dropped, so
+    lines don't bridge gaps in the data.
+    """
+    keep = minmax_decimate(times, values, mask, buckets)
+    invalid = np.cumsum(~mask)
+    gap = np.flatnonzero(invalid[keep[1:]] != invalid[keep[:-1]]) + 1
+    return np.insert(times[keep], gap, times[keep][gap]), np.insert(values[keep], gap, np.nan)
+
+
+@traced("visualize.plot_quantity")
+def plot_quantity(sim: Simulation, quantity: Quantity, start=0, stop=None, ax=None):
+    """
+    Plots a quantity over a window, decimated to the axes' width in pixels. start and stop may be
+    indices, datetimes or datetime64s.
+    """
+    show = ax is None
+    if ax is None:
+        ax = plt.figure().gca()
+    times, values, mask = get_quantity(sim, quantity, start, stop)
+    pixels = int(ax.get_window_extent().width) or 2000
+    with span("quantity.decimate"):
+        line = decimated_line(times, values, mask, pixels)
+    ax.plot(*line)
+    ax.set_xlabel("Date")
+    ax.set_ylabel(quantity.value)
+    ax.set_title(f"{quantity.value} vs Date")
+    if show:
+        plt.show()
 
 
 if __name__ == "__main__":
-    from attitude_planning.tools.simulator import TensorTechSimulation, SimulatonConfig, Maneuver, AlignmentAxis
-    sim = TensorTechSimulation.from_file("analysis/idr.json")
+    import sys
+    import time
+    from attitude_planning.tools.simulator import TensorTechSimulation
+    sim = TensorTechSimulation.from_file(sys.argv[1] if len(sys.argv) > 1 else "analysis/json/nadir_june_2024.json")
     simulation = Simulation.from_tensor_tech_sim(sim)
     simulation.derive_data()
-    # plot_quantity(simulation, Quantity.SCANLINE_ROTATION)
-    plot_quantity(simulation, Quantity.SCANLINE_INTERVAL)
\ No newline at end of file
+    simulation.llar
+
+    start = time.perf_counter()
+    quantities = get_quantities(simulation)
+    print(f"{len(quantities)} quantities over {len(simulation.time_ns)} samples in {time.perf_counter() - start:.3f} s")
+
+    times, values, mask = quantities[Quantity.SCANLINE_INTERVAL]
+    start = time.perf_counter()
+    line = decimated_line(times, values, mask)
+    print(f"Decimated {np.count_nonzero(mask)} points to {len(line[0])} in {time.perf_counter() - start:.3f} s")
+    plot_quantity(simulation, Quantity.SCANLINE_INTERVAL)
@@ -1,14 +1,21 @@
 import pandas as pd
+import numpy as np
 import folium
-from ..tools.calculate import make_scanline, add_dist_to_lat_lon
+from ..tools.calculate import make_scanline, make_scanlines
 from ..classes.simulation import Simulation
+from ..tools.instrument import span, traced
 
-def get_date_and_latlong(sim: Simulation):
-    data = [[*sim.llar[i], sim.dates[i].strftime("%Y-%m-%d %H:%M:%S")] for i in range(len(sim.llar)) if sim.llar[i] is not None]
-    data = [x for x in data if len(x) == 5]
-
-    data = pd.DataFrame(data, columns=["lat", "lon", "alt", "roll", "date"])
-    return data[["date", "lat", "lon", "roll"]]
+def get_date_and_latlong(sim: Simulation, start=0, stop=None):
+    start, stop = sim.window(start, stop)
+    llar = sim.get_llar(start, stop)
+    valid = llar["valid"]
+    dates = np.datetime_as_string(sim.times[start:stop][valid].astype("datetime64[s]"))
+    return pd.DataFrame({
+        "date": np.char.replace(dates, "T", " "),
+        "lat": llar["lat"][valid],
+        "lon": llar["lon"][valid],
+        "roll": llar["roll"][valid],
+    })
 
 def animate_sim_lla(sim: Simulation):
     data = get_date_and_latlong(sim)
@@ -33,46 +40,56 @@ def add_scanline_to_map(m, lat, lon, next_lat, next_long, rot, width, height, in
     m.add_child(int_rect)
     return m
 
-def plot_scanlines(simulation: Simulation, start_index=0, end_index=2000):
-    data = get_date_and_latlong(simulation)
-    data = data[start_index:end_index]
+def add_scanlines_to_map(m, corners, int_time_corners):
+    """
+    Adds (N,4,2) scanline and integration time rectangles from make_scanlines.
+    """
+    for rect, int_rect in zip(corners.tolist(), int_time_corners.tolist()):
+        m.add_child(make_folium_rect(rect))
+        m.add_child(make_folium_rect(int_rect, opacity=0.5))
+    return m
 
-    m = folium.Map(location=[data.iloc[0]["lat"], data.iloc[0]["lon"]], zoom_start=6, tiles='https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}', attr='Google Satellite')
-    for i in range(len(data) - 1):
-        lat = data.iloc[i]["lat"]
-        lon = data.iloc[i]["lon"]
-        next_lat = data.iloc[i+1]["lat"]
-        next_long = data.iloc[i+1]["lon"]
-        rot = data.iloc[i]["roll"]
-        int_dist = simulation.integration_time_s * simulation.orbit_speed[i]
-        m = add_scanline_to_map(m, lat, lon, next_lat, next_long, rot, simulation.scanline_width_m, simulation.scanline_height_m, int_dist)
-    
-    # Display the map
+@traced("scanlines.corners")
+def scanline_corners(simulation: Simulation, start=0, stop=None):
+    """
+    (N,4,2) scanline and integration time corners for the valid samples of a window.
+    """
+    llar = simulation.get_llar(start, stop)
+    valid = llar["valid"]
+    llar = llar[valid]
+    int_dist = simulation.integration_time_s * simulation.get_orbit_speed(start, stop)[valid]
+    # TODO: Rotation currently wrt lat/long not orbit
+    corners = make_scanlines(llar["lat"], llar["lon"], llar["roll"], simulation.scanline_width_m, simulation.scanline_height_m)
+    int_time_corners = make_scanlines(llar["lat"], llar["lon"], llar["roll"], simulation.scanline_width_m, simulation.scanline_height_m + int_dist)
+    return corners, int_time_corners
+
+def show_map(m):
     m.save("map.html")
     import webbrowser
     import os
     webbrowser.open_new_tab("file://" + os.path.join(os.getcwd(), "map.html"))
 
+@traced("visualize.plot_scanlines")
+def plot_scanlines(simulation: Simulation, start_index=0, end_index=2000):
+    """
+    Maps the scanlines of the valid samples among samples start_index:end_index. The indices
+    count all samples, valid or not; before windowed georeferencing they counted valid samples.
+    """
+    # Only the plotted window is georeferenced, and all corners are computed in one batch
+    corners, int_time_corners = scanline_corners(simulation, start_index, end_index)
+    if len(corners) == 0:
+        raise ValueError(f"No valid samples between samples {start_index} and {end_index} to plot")
+
+    m = folium.Map(location=corners[0].mean(axis=0).tolist(), zoom_start=6, tiles='https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}', attr='Google Satellite')
+    with span("scanlines.folium"):
+        m = add_scanlines_to_map(m, corners[:-1], int_time_corners[:-1])
+    
+    # Display the map
+    show_map(m)
+
 if __name__ == "__main__":
     from attitude_planning.tools.simulator import TensorTechSimulation
     sim = TensorTechSimulation.from_file("analysis/idr.json")
     simulation = Simulation.from_tensor_tech_sim(sim)
     simulation.derive_data()
-    data = get_date_and_latlong(simulation)
-    data = data[20000:22000]
-
-    m = folium.Map(location=[data.iloc[0]["lat"], data.iloc[0]["lon"]], zoom_start=6, tiles='https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}', attr='Google Satellite')
-    for i in range(len(data) - 1):
-        lat = data.iloc[i]["lat"]
-        lon = data.iloc[i]["lon"]
-        next_lat = data.iloc[i+1]["lat"]
-        next_long = data.iloc[i+1]["lon"]
-        rot = data.iloc[i]["roll"]
-        int_dist = simulation.integration_time_s * simulation.orbit_speed[i]
-        m = add_scanline_to_map(m, lat, lon, next_lat, next_long, rot, simulation.scanline_width_m, simulation.scanline_height_m, int_dist)
-    
-    # Display the map
-    m.save("map.html")
-    import webbrowser
-    import os
-    webbrowser.open_new_tab("file://" + os.path.join(os.getcwd(), "map.html"))
\ No newline at end of file
+    plot_scanlines(simulation, 20000, 22000)
@@ -0,0 +1,292 @@
+import json
+import numpy as np
+import folium
+from branca.element import MacroElement
+from jinja2 import Template
+from ..tools.calculate import make_scanlines
+from ..tools.consts import R as EARTH_RADIUS
+from ..tools.instrument import count, span, traced
+from ..classes.simulation import Simulation
+
+# (min zoom, max zoom) of each level of detail. Outlines are simplified to about a pixel at the
+# level's max zoom, and footprints closer than that are merged
+LODS = [(0, 6), (7, 9), (10, 12), (13, 22)]
+FULL_DETAIL_ZOOM = 13
+MAX_TOLERANCE_PIXELS = 4 # Coarsest simplification of a level, in pixels at its lowest zoom
+
+
+def meters_per_pixel(zoom, lat=0):
+    return 156543.03 * np.cos(np.radians(lat)) / 2**zoom
+
+
+@traced("swaths.footprints")
+def scanline_footprints(simulation: Simulation, start=0, stop=None, chunk_size=8192):
+    """
+    Sample indices, (M,4,2) corners and (M,) smeared heights of the valid scanlines of a window,
+    computed chunk by chunk.
+    """
+    start, stop = simulation.window(start, stop)
+    index, corners, heights = [], [], []
+    for lo in range(start, stop, chunk_size):
+        hi = min(lo + chunk_size, stop)
+        llar = simulation.get_llar(lo, hi)
+        valid = llar["valid"]
+        llar = llar[valid]
+        height = simulation.scanline_height_m + simulation.integration_time_s * simulation.get_orbit_speed(lo, hi)[valid]
+        index.append(np.flatnonzero(valid) + lo)
+        corners.append(make_scanlines(llar["lat"], llar["lon"], llar["roll"], simulation.scanline_width_m, height))
+        heights.append(height)
+    if not index:
+        return np.zeros(0, dtype=int), np.zeros((0, 4, 2)), np.zeros(0)
+    return np.concatenate(index), np.concatenate(corners), np.concatenate(heights)
+
+
+def _local_xy(lat, lon, lat0, lon0):
+    # Equirectangular meters around (lat0, lon0), good for distances of a few hundred km
+    return np.stack([
+        EARTH_RADIUS * np.radians((lon - lon0 + 180) % 360 - 180) * np.cos(np.radians(lat0)),
+        EARTH_RADIUS * np.radians(lat - lat0),
+    ], axis=-1)
+
+
+def swath_runs(index, corners, heights, tolerance_m=0):
+    """
+    Splits footprints into runs of consecutive samples that overlap, or leave gaps under
+    tolerance_m. Returns the (start, stop) footprint positions of each run.
+    """
+    if len(index) == 0:
+        return np.zeros((0, 2), dtype=int)
+    center = corners.mean(axis=1)
+    xy = _local_xy(center[1:, 0], center[1:, 1], center[:-1, 0], center[:-1, 1])
+    # Height axis of each footprint: from the middle of one long edge to the other
+    axis = _local_xy(corners[:-1, [0, 3]].mean(axis=1)[:, 0], corners[:-1, [0, 3]].mean(axis=1)[:, 1],
+                     center[:-1, 0], center[:-1, 1])
+    axis = axis / np.maximum(np.linalg.norm(axis, axis=1, keepdims=True), 1e-9)
+    along = np.abs(np.sum(xy * axis, axis=1))
+    across = np.abs(axis[:, 0] * xy[:, 1] - axis[:, 1] * xy[:, 0])
+
+    width = np.linalg.norm(_local_xy(corners[:-1, 0, 0], corners[:-1, 0, 1], corners[:-1, 3, 0], corners[:-1, 3, 1]), axis=1)
+    joined = (np.diff(index) == 1) & (along <= (heights[:-1] + heights[1:]) / 2 + tolerance_m) & (across < width / 2)
+    breaks = np.flatnonzero(~joined) + 1
+    return np.column_stack([np.r_[0, breaks], np.r_[breaks, len(index)]])
+
+
+def simplify(xy, tolerance):
+    """
+    Douglas-Peucker mask of the (N,2) polyline points to keep.
+    """
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[[0, -1]] = True
+    if tolerance <= 0 or len(xy) < 3:
+        keep[:] = True
+        return keep
+    stack = [(0, len(xy) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        a, b = xy[i], xy[j]
+        seg = xy[i+1:j] - a
+        ab = b - a
+        norm = np.hypot(*ab)
+        d = np.abs(ab[0] * seg[:, 1] - ab[1] * seg[:, 0]) / norm if norm > 0 else np.hypot(seg[:, 0], seg[:, 1])
+        k = int(np.argmax(d))
+        if d[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack += [(i, k), (k, j)]
+    return keep
+
+
+def swath_polygon(corners, tolerance_m=0):
+    """
+    Outline of a run of overlapping footprints as a closed (K,2) lat, long ring: the two width-end
+    edges of the run, simplified to tolerance_m, joined by the first and last footprints' caps.
+    """
+    if len(corners) == 1:
+        return np.vstack([corners[0], corners[0, :1]])
+
+    # Corners 0 and 1 are one end of the width, 2 and 3 the other; 0 and 3 lie forward along the height axis
+    center = corners.mean(axis=1)
+    motion = _local_xy(center[-1, 0], center[-1, 1], center[0, 0], center[0, 1])
+    forward = _local_xy(*corners[0, [0, 3]].mean(axis=0), *center[0])
+    a_back, a_fwd, b_fwd, b_back = (1, 0, 3, 2) if np.dot(motion, forward) >= 0 else (0, 1, 2, 3)
+
+    side_a = np.vstack([corners[0, a_back], corners[:, [0, 1]].mean(axis=1), corners[-1, a_fwd]])
+    side_b = np.vstack([corners[0, b_back], corners[:, [2, 3]].mean(axis=1), corners[-1, b_fwd]])
+    lat0, lon0 = center[len(center) // 2]
+    side_a = side_a[simplify(_local_xy(side_a[:, 0], side_a[:, 1], lat0, lon0), tolerance_m)]
+    side_b = side_b[simplify(_local_xy(side_b[:, 0], side_b[:, 1], lat0, lon0), tolerance_m)]
+    return np.vstack([side_a, side_b[::-1], side_a[:1]])
+
+
+def swath_rings(index, corners, heights, tolerance_m):
+    """
+    (start, stop) footprint positions and outline ring of every swath. Single footprints, which
+    dominate gappy runs, are outlined in one batch.
+    """
+    runs = swath_runs(index, corners, heights, tolerance_m)
+    single = runs[:, 1] - runs[:, 0] == 1
+    boxes = iter(np.concatenate([corners[runs[single, 0]], corners[runs[single, 0], :1]], axis=1))
+    rings = [next(boxes) if one else swath_polygon(corners[lo:hi], tolerance_m) for (lo, hi), one in zip(runs, single)]
+    return runs, rings
+
+
+def swath_features(simulation: Simulation, index, runs, rings):
+    features = []
+    times = simulation.times
+    for (lo, hi), ring in zip(runs, rings):
+        # GeoJSON is lon, lat. Longitudes are unwrapped along the ring so the antimeridian doesn't split it
+        lon = np.degrees(np.unwrap(np.radians(ring[:, 1])))
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [np.round(np.column_stack([lon, ring[:, 0]]), 6).tolist()]},
+            "properties": {
+                "start": str(times[index[lo]])[:23],
+                "stop": str(times[index[hi - 1]])[:23],
+                "scanlines": int(hi - lo),
+            },
+        })
+    return features
+
+
+@traced("swaths.geojson")
+def swath_geojson(simulation: Simulation, start=0, stop=None, lods=LODS, max_vertices=20000):
+    """
+    Scanline swaths of a window as one GeoJSON FeatureCollection per level of detail, with the
+    zoom range of each level in its "zoom" member.
+
+    Coarser levels merge footprints whose gaps are below a pixel and simplify outlines to a pixel.
+    A level whose outline would exceed max_vertices is simplified further until it fits, up to
+    MAX_TOLERANCE_PIXELS pixels at its lowest zoom. Footprints that can't be merged, such as
+    those between invalid samples, then keep every "decimation"th swath only, so output size stays
+    bounded however long the window is.
+    """
+    index, corners, heights = scanline_footprints(simulation, start, stop)
+    lat0 = float(np.median(corners[..., 0])) if len(corners) else 0
+    res = []
+    tolerance = 0
+    for min_zoom, max_zoom in reversed(lods):
+        # Levels only get coarser, so each starts from the tolerance the finer level settled on
+        tolerance = max(tolerance, meters_per_pixel(max_zoom, lat0) if max_zoom < FULL_DETAIL_ZOOM else 0)
+        max_tolerance = max(tolerance, MAX_TOLERANCE_PIXELS * meters_per_pixel(min_zoom, lat0))
+        while True:
+            count("swaths.simplify_passes")
+            with span("swaths.rings", zoom=max_zoom):
+                runs, rings = swath_rings(index, corners, heights, tolerance)
+            vertices = sum(len(ring) for ring in rings)
+            if vertices <= max_vertices or tolerance >= max_tolerance:
+                break
+            tolerance = min(max(tolerance * 2, 1), max_tolerance)
+
+        step = 1
+        while vertices > max_vertices and step < len(rings):
+            step = min(step * max(int(np.ceil(vertices / max_vertices)), 2), len(rings))
+            vertices = sum(len(ring) for ring in rings[::step])
+        runs, rings = runs[::step], rings[::step]
+
+        if res and res[-1]["tolerance_m"] == tolerance and res[-1]["decimation"] == step:
+            # Same outlines as the finer level, which then covers this zoom range too
+            res[-1]["zoom"][0] = min_zoom
+            continue
+        res.append({"type": "FeatureCollection", "zoom": [min_zoom, max_zoom], "tolerance_m": tolerance,
+                    "decimation": step, "features": swath_features(simulation, index, runs, rings)})
+    return res[::-1]
+
+
+def save_geojson(collections, filename):
+    """
+    Saves the levels of detail from swath_geojson, one file per level (filename_z<min>-<max>.geojson).
+    """
+    base = filename.rsplit(".", 1)[0]
+    names = []
+    for collection in collections:
+        name = f"{base}_z{collection['zoom'][0]}-{collection['zoom'][1]}.geojson"
+        with open(name, "w") as f:
+            json.dump(collection, f, separators=(",", ":"))
+        names.append(name)
+    return names
+
+
+class ZoomLevels(MacroElement):
+    """
+    Shows each layer only within its zoom range.
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var levels = [{% for layer, zoom in this.levels %}[{{ layer }}, {{ zoom[0] }}, {{ zoom[1] }}],{% endfor %}];
+                function update() {
+                    var z = map.getZoom();
+                    levels.forEach(function(l) {
+                        if (z >= l[1] && z <= l[2]) { map.addLayer(l[0]); } else { map.removeLayer(l[0]); }
+                    });
+                }
+                map.on("zoomend", update);
+                update();
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, levels):
+        super().__init__()
+        self._name = "ZoomLevels"
+        self.levels = levels
+
+
+@traced("swaths.map")
+def swath_map(simulation: Simulation, start=0, stop=None, max_vertices=20000):
+    """
+    folium Map of a window's swaths as GeoJSON layers that switch with the zoom level.
+    """
+    collections = swath_geojson(simulation, start, stop, max_vertices=max_vertices)
+    all_corners = [c["features"][0]["geometry"]["coordinates"][0][0] for c in collections if c["features"]]
+    location = [all_corners[0][1], all_corners[0][0]] if all_corners else [0, 0]
+
+    m = folium.Map(location=location, zoom_start=6, tiles='https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}', attr='Google Satellite')
+    style = {"color": "blue", "weight": 1, "fillColor": "blue", "fillOpacity": 0.5}
+    levels = []
+    for collection in collections:
+        layer = folium.GeoJson(
+            {"type": "FeatureCollection", "features": collection["features"]},
+            style_function=lambda feature: style,
+            tooltip=folium.GeoJsonTooltip(["start", "stop", "scanlines"]),
+        )
+        layer.add_to(m)
+        levels.append((layer.get_name(), collection["zoom"]))
+    m.add_child(ZoomLevels(levels))
+    return m
+
+
+@traced("visualize.plot_swaths")
+def plot_swaths(simulation: Simulation, start=0, stop=None, filename="map.html"):
+    """
+    Saves and opens a swath map of a whole run (or a window), unlike plot_scanlines which draws one
+    polygon per scanline.
+    """
+    m = swath_map(simulation, start, stop)
+    with span("swaths.save"):
+        m.save(filename)
+    import webbrowser
+    import os
+    webbrowser.open_new_tab("file://" + os.path.join(os.getcwd(), filename))
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import time
+    from attitude_planning.tools.simulator import TensorTechSimulation
+
+    sim = TensorTechSimulation.from_file(sys.argv[1] if len(sys.argv) > 1 else "analysis/json/nadir_june_2024.json")
+    simulation = Simulation.from_tensor_tech_sim(sim)
+    simulation.derive_data()
+
+    # Output size and render time against window length
+    for stop in (2000, 8000, 16000, None):
+        start = time.perf_counter()
+        swath_map(simulation, 0, stop).save("swaths.html")
+        elapsed = time.perf_counter() - start
+        print(f"{stop or len(simulation.time_ns)} samples: {elapsed:.2f} s, {os.path.getsize('swaths.html') / 1e6:.2f} MB")
+    os.remove("swaths.html")
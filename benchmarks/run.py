@@ -0,0 +1,461 @@
+"""
+Benchmarks of the derivation hot paths on the saved runs in analysis/json, with golden output
+checks and regression thresholds.
+
+    python -m benchmarks.run
+    python -m benchmarks.run --cases georef_array get_quantities --rates 60
+    python -m benchmarks.run --update-goldens
+
+Each case is timed (best of --repeat) and run once more under tracemalloc for its peak memory.
+Results are appended to the history file and compared with the median of the previous records of
+the same case on this machine; the run fails if a case is slower or uses more memory than that by
+more than --threshold, or if its outputs no longer match the goldens.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from attitude_planning.tools.simulator import TensorTechSimulation
+from attitude_planning.tools.calculate import georef, georef_ana, georef_array, make_scanline, make_scanlines
+from attitude_planning.tools.convert import ecef2lla
+from attitude_planning.tools.geodetic import ecef2lla_array, lla2ecef_array
+from attitude_planning.tools.coverage import CoverageGrid, swath_footprints
+from attitude_planning.tools.export import read_stk_attitude
+from attitude_planning.classes.simulation import Simulation
+from attitude_planning.visualization.quantity import get_quantities
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = {
+    "fixed": os.path.join(ROOT, "analysis", "json", "fixed_attitude_june_2024.json"),
+    "nadir": os.path.join(ROOT, "analysis", "json", "nadir_june_2024.json"),
+    "fine_pointing": os.path.join(ROOT, "analysis", "json", "fine_pointing_june_2024.json"),
+}
+RATES_HZ = [60, 10, 1]
+GOLDENS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "goldens")
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.jsonl")
+
+# Scalar (per-sample Python) cases run on this many samples of the run interpolated to SCALAR_RATE_HZ
+SCALAR_SAMPLES = 500
+SCALAR_RATE_HZ = 1
+# Rows of each output kept in the goldens
+GOLDEN_ROWS = 256
+RTOL, ATOL = 1e-7, 1e-9
+# Time and memory differences below these never count as regressions
+MIN_SECONDS = 0.01
+MIN_MB = 1
+
+# name -> (function(fixture) returning (items, setup, run), whether it runs at every rate, bounds).
+# setup() is untimed and its result is passed to run(), which returns a dict of output arrays.
+# Cases with bounds (output name -> largest allowed absolute value) are checked against those
+# instead of the goldens
+CASES = {}
+
+
+def case(name, per_rate=True, bounds=None):
+    def register(f):
+        CASES[name] = (f, per_rate, bounds)
+        return f
+    return register
+
+
+class Fixture:
+    """
+    A saved run at one interpolation rate, loaded once and shared by every case.
+    """
+    def __init__(self, run, rate_hz):
+        self.run = run
+        self.path = RUNS[run]
+        self.rate_hz = rate_hz
+        self.sim = TensorTechSimulation.from_file(self.path)
+        self._derived = None
+
+    def simulation(self, rate_hz=None):
+        simulation = Simulation.from_tensor_tech_sim(self.sim)
+        if rate_hz is not None:
+            simulation.interpolation_time_s = 1 / rate_hz
+        return simulation
+
+    @property
+    def derived(self):
+        if self._derived is None:
+            self._derived = self.simulation(self.rate_hz)
+            self._derived.derive_data(cache=False)
+        return self._derived
+
+    def scalar_samples(self):
+        """
+        orbit, attitude and llar of SCALAR_SAMPLES evenly spaced samples for the scalar cases.
+        """
+        simulation = self.simulation(SCALAR_RATE_HZ)
+        simulation.derive_data(cache=False)
+        i = np.unique(np.linspace(0, len(simulation.time_ns) - 1, SCALAR_SAMPLES).astype(int))
+        return simulation.orbit[i], simulation.attitude[i], simulation.llar[i]
+
+
+@case("from_file", per_rate=False)
+def from_file(fx):
+    def run(_):
+        sim = TensorTechSimulation.from_file(fx.path)
+        return {"orbit_r": sim.orbit_r, "orbit_v": sim.orbit_v}
+    return len(fx.sim.orbit_r), lambda: None, run
+
+
+@case("from_tensor_tech_sim", per_rate=False)
+def from_tensor_tech_sim(fx):
+    def run(_):
+        simulation = Simulation.from_tensor_tech_sim(fx.sim)
+        return {"attitude": simulation.attitude, "orbit": simulation.orbit}
+    return len(fx.sim.orbit_r), lambda: None, run
+
+
+@case("georef", per_rate=False)
+def georef_scalar(fx):
+    orbit, attitude, _ = fx.scalar_samples()
+    def run(_):
+        return {"llar": np.array([georef(r, q) or [np.nan] * 4 for r, q in zip(orbit.tolist(), attitude.tolist())], dtype=float)}
+    return len(orbit), lambda: None, run
+
+
+@case("georef_ana", per_rate=False)
+def georef_ana_scalar(fx):
+    orbit, attitude, _ = fx.scalar_samples()
+    def run(_):
+        return {"llar": np.array([georef_ana(r, q) or [np.nan] * 4 for r, q in zip(orbit.tolist(), attitude.tolist())], dtype=float)}
+    return len(orbit), lambda: None, run
+
+
+def geodetic_grid():
+    """
+    (N,3) lat, lon, alt over the valid altitude range, with rows at and next to the poles and the
+    equator.
+    """
+    lat = np.r_[-90, -89.9999999, -89.99, np.linspace(-89, 89, 179), 89.99, 89.9999999, 90]
+    lon = np.linspace(-180, 180, 25)
+    alt = np.r_[-5e3, 0, 1e3, 1e4, 1e5, 4e5, 6e5, 1e6, 2e6]
+    return np.stack(np.meshgrid(lat, lon, alt, indexing="ij"), axis=-1).reshape(-1, 3)
+
+
+@case("ecef2lla_accuracy", per_rate=False, bounds={
+    "position_m": 1e-6, "lat_deg": 1e-11, "lon_arc_m": 1e-6, "alt_m": 1e-6, "scalar_m": 1e-6})
+def ecef2lla_accuracy(fx):
+    # Errors against exact lla2ecef round trips, and of the scalar path against the array one
+    lla = geodetic_grid()
+    ecef = lla2ecef_array(lla)
+    def run(_):
+        res = ecef2lla_array(ecef)
+        lon = (res[:, 1] - lla[:, 1] + 180) % 360 - 180
+        scalar = np.array([ecef2lla(*p) for p in ecef[::17].tolist()])
+        return {
+            "position_m": np.linalg.norm(lla2ecef_array(res) - ecef, axis=1),
+            "lat_deg": res[:, 0] - lla[:, 0],
+            # Longitude is undefined at the poles, so compare it as a distance along the parallel
+            "lon_arc_m": np.radians(lon) * np.hypot(ecef[:, 0], ecef[:, 1]),
+            "alt_m": res[:, 2] - lla[:, 2],
+            "scalar_m": np.linalg.norm(lla2ecef_array(scalar) - lla2ecef_array(res[::17]), axis=1),
+        }
+    return len(lla), lambda: None, run
+
+
+@case("coverage_seam", per_rate=False, bounds={"covered": 1e-3, "hits": 1e-3, "scanline": 0.01})
+def coverage_seam(fx):
+    # Coverage with the projection cut under the ground track, relative to the same coverage cut
+    # on the far side of the Earth
+    simulation = fx.derived
+    corners, _ = swath_footprints(simulation.orbit, simulation.attitude, simulation.time_ns,
+                                        simulation.scanline_width_m, simulation.scanline_height_m,
+                                        simulation.integration_time_s)
+    lon = float(corners[len(corners) // 2, 0, 1])
+    scanline = make_scanlines(np.array([0.0]), np.array([179.995]), np.array([0.0]), 20000, 100)
+
+    def totals(lon0, corners, cell_m=200):
+        # Covered cells and footprint hits
+        grid = CoverageGrid(cell_m, lon0=lon0)
+        grid.add(corners)
+        tiles = grid.tiles.values()
+        return sum(int(np.count_nonzero(t)) for t in tiles), sum(int(t.sum(dtype=np.int64)) for t in tiles)
+
+    def run(_):
+        (covered, hits), (far_covered, far_hits) = totals(lon + 180, corners), totals(lon, corners)
+        # A 20 km scanline on the antimeridian, which once became a row around the whole Earth
+        line = totals(0, scanline, 100)[0] / totals(180, scanline, 100)[0]
+        return {"covered": covered / far_covered - 1, "hits": hits / far_hits - 1, "scanline": line - 1}
+    return len(corners), lambda: None, run
+
+
+@case("ecef2lla", per_rate=False)
+def ecef2lla_scalar(fx):
+    orbit, _, _ = fx.scalar_samples()
+    def run(_):
+        return {"lla": np.array([ecef2lla(*r) for r in orbit.tolist()], dtype=float)}
+    return len(orbit), lambda: None, run
+
+
+@case("make_scanline", per_rate=False)
+def make_scanline_scalar(fx):
+    _, _, llar = fx.scalar_samples()
+    llar = llar[llar["valid"]]
+    def run(_):
+        return {"corners": np.array([make_scanline(lat, lon, None, None, roll, 20000, 100)
+                                   for lat, lon, roll in zip(llar["lat"].tolist(), llar["lon"].tolist(), llar["roll"].tolist())])}
+    return len(llar), lambda: None, run
+
+
+@case("interpolate")
+def interpolate(fx):
+    def run(simulation):
+        simulation.interpolate()
+        return {"time_ns": simulation.time_ns, "attitude": simulation.attitude, "orbit": simulation.orbit}
+    return len(fx.derived.time_ns), lambda: fx.simulation(fx.rate_hz), run
+
+
+@case("interpolate_adaptive")
+def interpolate_adaptive(fx):
+    # Items are the camera rate samples the adaptive samples stand for
+    def setup():
+        simulation = fx.simulation(fx.rate_hz)
+        simulation.adaptive = True
+        return simulation
+
+    def run(simulation):
+        simulation.interpolate()
+        llar = simulation.llar
+        return {"time_ns": simulation.time_ns, "roll": llar["roll"], "valid": llar["valid"]}
+    return len(fx.derived.time_ns), setup, run
+
+
+@case("georef_array")
+def georef_batch(fx):
+    orbit, attitude = fx.derived.orbit, fx.derived.attitude
+    def run(_):
+        llar, valid = georef_array(orbit, attitude)
+        return {"llar": llar, "valid": valid}
+    return len(orbit), lambda: None, run
+
+
+@case("ecef2lla_array")
+def ecef2lla_batch(fx):
+    orbit = fx.derived.orbit
+    return len(orbit), lambda: None, lambda _: {"lla": ecef2lla_array(orbit)}
+
+
+@case("get_quantities")
+def quantities(fx):
+    def setup():
+        # Fresh caches, so every quantity is derived from the interpolated arrays
+        simulation = Simulation(fx.derived.attitude, fx.derived.orbit, fx.derived.time_ns, fx.derived.orbit_velocity_mps)
+        simulation.telemetry = fx.derived.telemetry
+        return simulation
+    def run(simulation):
+        return {q.name: values for q, (times, values, mask) in get_quantities(simulation).items()}
+    return len(fx.derived.time_ns), setup, run
+
+
+@case("make_scanlines")
+def make_scanlines_batch(fx):
+    llar = fx.derived.llar[fx.derived.llar["valid"]]
+    def run(_):
+        return {"corners": make_scanlines(llar["lat"], llar["lon"], llar["roll"], 20000, 100)}
+    return len(llar), lambda: None, run
+
+
+@case("export_quaternions")
+def export_quaternions(fx):
+    def run(_):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "attitude")
+            fx.derived.export_quaternions(filename)
+            time_ns, attitude, header = read_stk_attitude(filename + ".a")
+        return {"time_ns": time_ns, "attitude": attitude}
+    return len(fx.derived.time_ns), lambda: None, run
+
+
+def measure(setup, run, repeat):
+    """
+    Best time of repeat runs, then the peak traced memory of one more, in MB. Returns the seconds,
+    peak and outputs.
+    """
+    seconds = np.inf
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        outputs = run(state)
+        seconds = min(seconds, time.perf_counter() - start)
+        del outputs
+
+    state = setup()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        outputs = run(state)
+        peak = (tracemalloc.get_traced_memory()[1] - base) / 2**20
+    finally:
+        tracemalloc.stop()
+    return seconds, peak, outputs
+
+
+def decimate(outputs):
+    """
+    Up to GOLDEN_ROWS evenly spaced rows of every output, keyed for an npz file.
+    """
+    res = {}
+    for name, values in outputs.items():
+        values = np.asarray(values)
+        i = np.unique(np.linspace(0, len(values) - 1, GOLDEN_ROWS).astype(int)) if len(values) else []
+        res[name] = values[i]
+        res[f"{name}__len"] = np.array(len(values))
+    return res
+
+
+def golden_path(run, rate_hz):
+    return os.path.join(GOLDENS, f"{run}.npz" if rate_hz is None else f"{run}_{rate_hz:g}hz.npz")
+
+
+def compare(actual, golden):
+    """
+    Names of outputs that differ from the goldens beyond RTOL and ATOL, or are missing.
+    """
+    bad = []
+    for name, values in actual.items():
+        if name not in golden:
+            bad.append(f"{name} (no golden)")
+        elif golden[name].shape != values.shape or not np.allclose(
+                values, golden[name], rtol=RTOL, atol=ATOL, equal_nan=True):
+            bad.append(name)
+    return bad
+
+
+def check_bounds(outputs, bounds):
+    """
+    Outputs whose largest absolute value exceeds their bound, or that are not finite.
+    """
+    bad = []
+    for name, bound in bounds.items():
+        worst = np.max(np.abs(outputs[name]))
+        if not worst <= bound:
+            bad.append(f"{name} {worst:.2g} > {bound:g}")
+    return bad
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def baseline(history, record, window=5):
+    """
+    Median seconds and peak MB of the last window records of the same case, run and rate on this
+    host, or None.
+    """
+    key = ("host", "case", "run", "rate_hz")
+    same = [h for h in history if all(h.get(k) == record[k] for k in key)][-window:]
+    if not same:
+        return None
+    return float(np.median([h["seconds"] for h in same])), float(np.median([h["peak_mb"] for h in same]))
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def format_table(rows):
+    fields = ["case", "run", "rate", "items", "seconds", "items/s", "peak MB", "status"]
+    table = [fields] + [[str(r.get(f, "")) for f in fields] for r in rows]
+    widths = [max(len(r[i]) for r in table) for i in range(len(fields))]
+    return "\n".join("  ".join(c.ljust(w) for c, w in zip(r, widths)) for r in table)
+
+
+def run_benchmarks(runs=RUNS, rates=RATES_HZ, cases=None, repeat=3, threshold=0.25, history_path=HISTORY,
+                   record=True, update_goldens=False):
+    """
+    Runs the cases over every run and rate. Returns the table rows and whether everything passed.
+    """
+    cases = cases or list(CASES)
+    history = load_history(history_path)
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    meta = {"date": now, "commit": git_commit(), "host": platform.node(), "python": platform.python_version(),
+            "numpy": np.__version__}
+    rows, records, goldens, ok = [], [], {}, True
+
+    for run in runs:
+        for i, rate_hz in enumerate(rates):
+            fx = Fixture(run, rate_hz)
+            for name in cases:
+                f, per_rate, bounds = CASES[name]
+                if not per_rate and i > 0:
+                    continue
+                items, setup, work = f(fx)
+                seconds, peak, outputs = measure(setup, work, repeat)
+                key_rate = rate_hz if per_rate else None
+                rec = {**meta, "case": name, "run": run, "rate_hz": key_rate, "items": items,
+                       "seconds": seconds, "items_per_s": items / seconds, "peak_mb": peak}
+
+                status = []
+                path = golden_path(run, key_rate)
+                actual = {} if bounds else {f"{name}/{k}": v for k, v in decimate(outputs).items()}
+                if bounds:
+                    status += [f"bound: {b}" for b in check_bounds(outputs, bounds)]
+                elif update_goldens:
+                    goldens.setdefault(path, {}).update(actual)
+                elif os.path.exists(path):
+                    with np.load(path) as golden:
+                        status += [f"golden: {b}" for b in compare(actual, golden)]
+                else:
+                    status.append("golden: missing")
+
+                base = baseline(history, rec)
+                if base is not None:
+                    if seconds > base[0] * (1 + threshold) and seconds - base[0] > MIN_SECONDS:
+                        status.append(f"slower: {seconds / base[0]:.2f}x")
+                    if peak > base[1] * (1 + threshold) and peak - base[1] > MIN_MB:
+                        status.append(f"memory: {peak / max(base[1], 1e-9):.2f}x")
+                ok &= not status
+
+                records.append(rec)
+                rows.append({"case": name, "run": run, "rate": "" if key_rate is None else f"{rate_hz:g} Hz",
+                             "items": items, "seconds": f"{seconds:.4f}", "items/s": f"{items / seconds:.3g}",
+                             "peak MB": f"{peak:.1f}", "status": "; ".join(status) or "ok"})
+                print(format_table(rows[-1:]).splitlines()[1], file=sys.stderr)
+
+    if update_goldens:
+        os.makedirs(GOLDENS, exist_ok=True)
+        for path, arrays in goldens.items():
+            if os.path.exists(path):
+                # Keep the goldens of cases that weren't run
+                with np.load(path) as old:
+                    arrays = {**dict(old), **arrays}
+            np.savez_compressed(path, **arrays)
+    if record:
+        with open(history_path, "a") as f:
+            for rec in records:
+                f.write(json.dumps(rec) + "\n")
+    return rows, ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the derivation hot paths against goldens and history")
+    parser.add_argument("--runs", nargs="+", default=list(RUNS), choices=list(RUNS))
+    parser.add_argument("--rates", nargs="+", type=float, default=RATES_HZ, help="Interpolation rates (Hz)")
+    parser.add_argument("--cases", nargs="+", default=None, choices=list(CASES))
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case; the best is kept")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed slowdown or memory growth over the history median")
+    parser.add_argument("--history", default=HISTORY)
+    parser.add_argument("--no-record", action="store_true", help="Don't append the results to the history")
+    parser.add_argument("--update-goldens", action="store_true", help="Save the outputs as the new goldens")
+    args = parser.parse_args()
+
+    rows, ok = run_benchmarks({r: RUNS[r] for r in args.runs}, args.rates, args.cases, args.repeat, args.threshold,
+                              args.history, not args.no_record, args.update_goldens)
+    print(format_table(rows))
+    sys.exit(0 if ok else 1)
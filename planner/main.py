@@ -0,0 +1,77 @@
+"""
+Finds candidate imaging passes over a catalog of sites for a saved run or a TLE.
+
+    python -m planner.main sites.csv --run analysis/json/nadir_june_2024.json
+    python -m planner.main sites.csv --hours 24 --off-nadir 30 --sun-elevation 10
+    python -m planner.main sites.csv --run analysis/json/nadir_june_2024.json --optimize 3
+"""
+import argparse
+import numpy as np
+from sgp4.api import Satrec
+from attitude_planning.tools.simulator import TensorTechSimulation, SimulatonConfig
+from attitude_planning.tools.convert import datetime64_to_jd, teme2ecef
+from attitude_planning.tools.calculate import interpolation_times, interpolate_positions
+from attitude_planning.tools.visibility import SiteCatalog
+from attitude_planning.tools.optimize import PROFILES, PassGeometry, optimize_pass
+
+
+def run_orbit(filename, step_s):
+    """
+    Orbit of a saved run, interpolated to step_s.
+    """
+    sim = TensorTechSimulation.from_file(filename)
+    key_ns = sim.orbit_time.astype(np.int64)
+    steps = max(int(round(np.median(np.diff(key_ns)) / 1e9 / step_s)), 1)
+    time_ns = interpolation_times(key_ns, steps)
+    orbit = interpolate_positions((key_ns - key_ns[0]) / 1e9, sim.orbit_r, (time_ns - key_ns[0]) / 1e9, sim.orbit_v)[0]
+    return time_ns.view("datetime64[ns]"), orbit
+
+
+def tle_orbit(tle_1, tle_2, start, hours, step_s):
+    """
+    SGP4 orbit in ECEF from start for the given number of hours.
+    """
+    times = np.datetime64(start, "ns") + (np.arange(0, hours * 3600, step_s) * 1e9).astype("timedelta64[ns]")
+    jd, fr = datetime64_to_jd(times)
+    e, r, v = Satrec.twoline2rv(tle_1, tle_2).sgp4_array(jd, fr)
+    return times, teme2ecef(r * 1000, v * 1000, jd + fr)[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find imaging windows over a catalog of sites")
+    parser.add_argument("sites", help="CSV with lat, lon and optional name, alt columns")
+    parser.add_argument("--run", help="Saved run (.json or .npz) to take the orbit from")
+    parser.add_argument("--start", default="2024-06-01T00:00", help="Start time (UTC) when using the TLE")
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--step", type=float, default=1, help="Orbit sample interval (s)")
+    parser.add_argument("--off-nadir", type=float, default=30, help="Maximum off-nadir angle (deg)")
+    parser.add_argument("--elevation", type=float, default=0, help="Minimum satellite elevation at the site (deg)")
+    parser.add_argument("--sun-elevation", type=float, default=None, help="Minimum sun elevation at the site (deg)")
+    parser.add_argument("--optimize", type=int, default=0, metavar="N", help="Search attitude commands and print the best N per window")
+    parser.add_argument("--profiles", nargs="+", default=PROFILES, choices=PROFILES, help="Pointing profiles to search")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for the search (default: every core)")
+    args = parser.parse_args()
+
+    if args.run:
+        times, orbit = run_orbit(args.run, args.step)
+    else:
+        config = SimulatonConfig("planner", None, 0, None)
+        times, orbit = tle_orbit(config.tle_1, config.tle_2, args.start, args.hours, args.step)
+
+    catalog = SiteCatalog.from_csv(args.sites)
+    windows = catalog.windows(times, orbit, args.off_nadir, args.elevation, args.sun_elevation)
+
+    print(f"{len(windows)} windows over {len(catalog)} sites")
+    for w in windows:
+        duration = (w["stop"] - w["start"]) / np.timedelta64(1, "s")
+        q = " ".join(f"{x:+.5f}" for x in w["q"])
+        print(f"{catalog.names[w['site']]:24} {str(w['peak'])[:19]}  {duration:5.0f} s  "
+              f"off-nadir {w['min_off_nadir_deg']:5.1f}  sun {w['sun_elevation_deg']:5.1f}  q [{q}]")
+        if args.optimize:
+            geometry = PassGeometry.from_window(catalog, w, times, orbit)
+            for p in optimize_pass(geometry, args.profiles, top=args.optimize, workers=args.workers):
+                q = " ".join(f"{x:+.5f}" for x in p["q"])
+                params = " ".join(f"{x:+7.2f}" for x in p["params"])
+                print(f"    {p['profile']:12} [{params}]  coverage {p['coverage']:4.2f}  "
+                      f"rotation {p['mean_abs_scanline_rotation_deg']:4.1f}/{p['max_abs_scanline_rotation_deg']:4.1f}  "
+                      f"interval {p['mean_point_interval_m']:5.1f} m  q [{q}]")